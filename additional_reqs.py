@@ -3,6 +3,8 @@
 
 from filedefs import *
 from shared.pyutils.utils import *
+from cog_inst_table import CogInstTable, iterCogInstBatches
+import numpy as np
 
 
 masterDict = UtilLoad(PROK_TAXA_DICT())
@@ -20,28 +22,42 @@ with open(config.WORK_FILES_DIR() + "index_name.txt", 'w') as f:
         f.write(str(i) + '\t' + name + '\n')
         dirDict[nameDict[name]] = i
 
-print("reading COG instance set...")
-cogList = UtilLoad(COG_INST_LIST())
+print("reading COG instance table...")
+table = CogInstTable.load(COG_INST_TABLE())
 
-print("Processing cogInstList...")
-cogInstList = []
-dirExceptions = set()
-for cogInst in cogList:
-    dir = cogInst.dir
+print("Processing COG instances...")
+# Genome dir index -> 1 based index of the name, 0 for unmatched dirs
+tableDirIndex = np.zeros(len(table.getDirNames()), dtype=np.int32)
+for ind, dir in enumerate(table.getDirNames()):
     if dir in dirDict:
-        cogInstList.append((dirDict[dir], cogInst.name, cogInst.len))
+        tableDirIndex[ind] = dirDict[dir]
     else:
-        if dir not in dirExceptions:
-            print("Unmatched dir %s" % dir)
-            dirExceptions.add(dir)
-
-cogInstList = sorted(cogInstList, key = lambda x: x[2])
-cogInstList = sorted(cogInstList, key = lambda x: x[1])
-cogInstList = sorted(cogInstList, key = lambda x: x[0])
+        print("Unmatched dir %s" % dir)
+
+# Only 3 small integers per matched instance are kept in memory
+cogNameRank = np.empty(len(table.cogNames), dtype=np.int32)
+cogNameRank[np.argsort(table.cogNames)] = np.arange(len(table.cogNames))
+dirIndexList = []
+cogRankList = []
+lenList = []
+for batch in iterCogInstBatches(COG_INST_TABLE()):
+    instDirIndex = tableDirIndex[batch.getDirCode()]
+    matched = instDirIndex > 0
+    dirIndexList.append(instDirIndex[matched])
+    cogRankList.append(cogNameRank[batch.cogCode[matched]])
+    lenList.append(np.asarray(batch.len[matched]))
+instDirIndex = np.concatenate(dirIndexList)
+instCogRank = np.concatenate(cogRankList)
+instLen = np.concatenate(lenList)
+del dirIndexList, cogRankList, lenList
+
+# Sort by dir index, then by COG name, then by length
+order = np.lexsort((instLen, instCogRank, instDirIndex))
+sortedCogNames = sorted(table.cogNames)
 
 print("Dumping COG lengths to a file...")
 with open(config.WORK_FILES_DIR() + "index_cog_len.txt", 'w') as f:
-    for t in cogInstList:
-        f.write(str(t[0]) + '\t' + t[1] + '\t' + str(t[2]) + '\n')
-
-
+    for dirIndex, cogRank, length in zip(instDirIndex[order].tolist(),
+            instCogRank[order].tolist(), instLen[order].tolist()):
+        f.write(str(dirIndex) + '\t' + sortedCogNames[cogRank] + '\t' +
+                str(length) + '\n')
@@ -1,34 +1,49 @@
 # This module builds set of CogInst, and Cog objects
+# Usage: build_cogs.py [twoPass] [workers <count>] [fasta] [incremental]
+# twoPass - read COG PIDs from the PTT file first, and keep only their
+#   proteins while reading the FAA file
+# workers - process chromosomes by a pool of <count> processes. Each worker
+#   writes its own shard of the COG protein store, shards are merged in the
+#   serial order, so faLine values are the same as in a serial run
+# fasta - also export COG proteins as <COGNAME>.fa files (see cog_store.py)
+# incremental - parse only chromosomes whose PTT or FAA files are new or
+#   changed since the previous run (see COG_BUILD_MANIFEST()), and drop
+#   instances of the removed ones. A COG is dropped if its protein is bad in
+#   any FAA file, so chromosomes with COGs whose PIDs became bad or stopped
+#   being bad are parsed again too
+# check - after the build, build everything from scratch into a temporary
+#   store, and check that the result is the same
 
 import re
+import os
+import sys
+import shutil
+import hashlib
+import numpy as np
+import multiprocessing
 from filedefs import *
 import random
 from shared.pyutils.utils import *
 from genome_cls import ProkDna, ProkDnaSet, ProkGenome, CogInst, Cog
+from cog_store import CogProteinStore, CogProteinStoreWriter, \
+    mergeCogProteinStores, moveCogProteinStore, removeCogProteinStore
+from cog_inst_table import CogInstTable
 
 cogPat = re.compile(r'^COG.*')
 
-# Set of CogInst
-fullCogInstList = []
-
-# Sample list of CogInst, for debugging
-sampleCogInstList = []
-
-# Dictionary mapping COG name -> Cog
-fullCogDict = {}
-
-# Dictionary of FASTA files containing COG proteins, file name -> current
-# line number
+# Dictionary of COG name -> current line number in its FASTA file (as
+# exported from the COG protein store)
 faFileDict = {}
 
-# Dictionary of genome -> COG count
-genomeDict = {}
-
-# Use multifile to append files
-multiFile = UtilMultiFile(100, "a")
+# CogProteinStoreWriter for COG proteins
+proteinStore = None
 
 # Only proteins containing these letters are taken into consideration
-validAminoAcidSet = set("ARNDCQEGHILKMFPSTWYVBZ")
+validAminoAcids = "ARNDCQEGHILKMFPSTWYVBZ"
+
+# Byte -> True if it is not a valid amino acid letter
+invalidByteTable = np.ones(256, dtype=bool)
+invalidByteTable[[ord(x) for x in validAminoAcids]] = False
 
 # IDs of COGs which have bad protein strings
 idsOfBadProteins = set()
@@ -36,59 +51,156 @@ idsOfBadProteins = set()
 # IDs of COGs with missing protein strings
 idsOfMissingProteins = set()
 
-# Files with COG protein sequences
-def cogFastaFileName(nameBase):
-    return config.WORK_FILES_DIR() + nameBase + ".fa"
-
-# Checks protein string for validity
-def checkProtein(protein):
-    return (set(protein) <= validAminoAcidSet)
-
-def addProteinToDict(cogProteinDict, pid, protein, faaFileName, lineno):
-    if not pid:
-        return
-    if pid and checkProtein(protein):
-        cogProteinDict[pid] = protein
-    else:
-        print("File %s line %d: ignoring protein %s id %s" % (
-            faaFileName, lineno, protein, pid))
-        idsOfBadProteins.add(pid)
-
-# Returns a set of COGs contaned in this prokDna
-def getCogSet(prokDna):
-    # Dictionary of PID -> protein
-    cogProteinDict = {}
-
-    # Read all COG proteins from the corresponding faa file
-    protein = ""
+# List of per FAA file protein quality summaries (see ProteinBatchValidator)
+proteinQualityList = []
+
+class ProteinBatchValidator(object):
+    """
+    Checks proteins of one FAA file against validAminoAcids in batches, with
+    a byte lookup table over the concatenated batch. Valid proteins are
+    passed to acceptFunc(pid, protein) in the order they were added; PIDs
+    of the rejected ones go to badIdSet
+    Attributes:
+        acceptFunc - function called for every valid protein
+        batchSize - number of proteins checked at once
+        badIdSet - set the PIDs of the rejected proteins go to
+        qualityList - list the summary goes to
+        batch - list of (pid, protein, lineno) waiting to be checked
+        badByteCounts - counts of invalid bytes in the rejected proteins
+        summary - dictionary with the quality summary of the file
+    """
+
+    # How many rejected proteins are listed in the summary
+    maxExamples = 10
+
+    def __init__(self, faaFileName, acceptFunc, batchSize = 4096,
+                 badIdSet = None, qualityList = None):
+        """
+        :param badIdSet: idsOfBadProteins if None
+        :param qualityList: proteinQualityList if None
+        """
+        self.acceptFunc = acceptFunc
+        self.batchSize = batchSize
+        self.badIdSet = idsOfBadProteins if badIdSet is None else badIdSet
+        self.qualityList = proteinQualityList if qualityList is None else \
+            qualityList
+        self.batch = []
+        self.badByteCounts = np.zeros(256, dtype=np.int64)
+        self.summary = {"file": faaFileName, "proteins": 0, "residues": 0,
+            "rejected": 0, "unknownLines": 0, "rejectedExamples": []}
+
+    def add(self, pid, protein, lineno):
+        if not pid:
+            return
+        self.batch.append((pid, protein, lineno))
+        if len(self.batch) >= self.batchSize:
+            self.flush()
+
+    def addUnknownLine(self):
+        self.summary["unknownLines"] += 1
+
+    def flush(self):
+        if not self.batch:
+            return
+        lengths = np.array([len(x[1]) for x in self.batch], dtype=np.int64)
+        invalidCounts = np.zeros(len(self.batch), dtype=np.int64)
+        if lengths.sum():
+            buf = np.frombuffer("".join([x[1] for x in self.batch]),
+                                dtype=np.uint8)
+            invalid = invalidByteTable[buf]
+            invalidCum = np.concatenate(([0], np.cumsum(invalid)))
+            ends = np.cumsum(lengths)
+            invalidCounts = invalidCum[ends] - invalidCum[ends - lengths]
+            self.badByteCounts += np.bincount(buf[invalid], minlength=256)
+        self.summary["proteins"] += len(self.batch)
+        self.summary["residues"] += int(lengths.sum())
+
+        for (pid, protein, lineno), invalidCount in zip(self.batch,
+                invalidCounts.tolist()):
+            if not invalidCount:
+                self.acceptFunc(pid, protein)
+                continue
+            self.badIdSet.add(pid)
+            self.summary["rejected"] += 1
+            if len(self.summary["rejectedExamples"]) < \
+                    ProteinBatchValidator.maxExamples:
+                self.summary["rejectedExamples"].append([pid, lineno,
+                    invalidCount])
+        self.batch = []
+
+    def close(self):
+        """
+        Checks the remaining proteins, and adds the summary to qualityList
+        :return: the summary
+        """
+        self.flush()
+        self.summary["badResidues"] = dict((chr(x), int(self.badByteCounts[x]))
+            for x in np.nonzero(self.badByteCounts)[0])
+        self.qualityList.append(self.summary)
+        return self.summary
+
+# Reads the FAA file, passing every protein to validator
+def readFaaFile(faaFileName, validator):
+    proteinLines = []
     pid = None
-    faaFileName = prokDna.getFullPttName().rpartition('.')[0] + ".faa"
+    lineno = 0
     with open(faaFileName, 'r') as ffaa:
         for lineno, l in enumerate(ffaa, start = 1):
             l = l.strip()
             ll = l.split('|')
             if len(ll) >= 5:
-                addProteinToDict(cogProteinDict, pid, protein, faaFileName,
-                                 lineno)
+                validator.add(pid, "".join(proteinLines), lineno)
                 pid = ll[1]
-                protein = ""
+                proteinLines = []
                 continue
             if len(ll) == 1:
                 # Line with a protein
-                protein += l
+                proteinLines.append(l)
                 continue
             # Unknown line. Reset everything till the next descriptor
-            print("File %s unknown line %s" % (faaFileName, l))
+            validator.addUnknownLine()
             pid = None
 
-    addProteinToDict(cogProteinDict, pid, protein, faaFileName, lineno)
+    validator.add(pid, "".join(proteinLines), lineno)
+    validator.close()
 
-    return buildCogSet(prokDna, cogProteinDict)
+# Returns a set of COGs contaned in this prokDna; PIDs of the COGs missing
+# in the FAA file go to missingIdSet (idsOfMissingProteins if None)
+def getCogSet(prokDna, missingIdSet = None):
+    # Dictionary of PID -> protein
+    cogProteinDict = {}
 
-def buildCogSet(prokDna, cogProteinDict):
-    cogInstSet = set()
+    # Read all COG proteins from the corresponding faa file
+    faaFileName = prokDna.getFullPttName().rpartition('.')[0] + ".faa"
+    readFaaFile(faaFileName, ProteinBatchValidator(faaFileName,
+        cogProteinDict.__setitem__))
 
+    return buildCogSet(prokDna, cogProteinDict, missingIdSet)
+
+# Returns a set of COGs contained in this prokDna; FAA file is streamed, and
+# only proteins of the COGs listed in the PTT file are kept
+def getCogSetTwoPass(prokDna, missingIdSet = None):
+    cogPidSet = getCogPidSet(prokDna)
+    faaFileName = prokDna.getFullPttName().rpartition('.')[0] + ".faa"
+    cogProteinDict = readCogProteins(faaFileName, cogPidSet)
+    return buildCogSet(prokDna, cogProteinDict, missingIdSet)
+
+# Returns set of PIDs of the COGs in the PTT file of this prokDna
+def getCogPidSet(prokDna):
+    cogPidSet = set()
     with open(prokDna.getFullPttName(), 'r') as fptt:
+        for lineno, l in enumerate(fptt, start = 1):
+            if lineno <= 3:
+                continue
+            ll = l.strip().split('\t')
+            if (len(ll) == 9) and cogPat.match(ll[7]):
+                cogPidSet.add(ll[3])
+    return cogPidSet
+
+# Yields tuples (lineno, start, len, COG name, strand, PID) of the COG lines
+# of the PTT file
+def iterPttCogs(pttFileName):
+    with open(pttFileName, 'r') as fptt:
         # Skip first 3 lines
         for lineno, l in enumerate(fptt, start = 1):
             if lineno <= 3:
@@ -111,97 +223,527 @@ def buildCogSet(prokDna, cogProteinDict):
                 cogStrand = ll[1]
                 cogPid = ll[3]
             except:
-                print("Cant't parse file %s line %u" % (
-                    prokDna.getFullPttName(), lineno))
+                print("Cant't parse file %s line %u" % (pttFileName, lineno))
                 continue
+            yield (lineno, cogStart, cogLen, cogName, cogStrand, cogPid)
 
-            if cogPid in idsOfBadProteins:
-                # Protein has been malformatted
-                continue
+# Streams the FAA file, and returns dictionary PID -> protein for the PIDs
+# from cogPidSet. Every protein is still checked, so idsOfBadProteins is
+# the same as in getCogSet()
+def readCogProteins(faaFileName, cogPidSet):
+    cogProteinDict = {}
 
-            if cogPid not in cogProteinDict:
-                print("COG from file %s line %u pid %s not in FAA file" % (
-                    prokDna.getFullPttName(), lineno, cogPid))
-                idsOfMissingProteins.add(cogPid)
-                continue
+    def acceptProtein(pid, protein):
+        if pid in cogPidSet:
+            cogProteinDict[pid] = protein
 
-            faFileName = cogFastaFileName(cogName)
-            faLineNumber = faFileDict.get(faFileName, 1)
+    readFaaFile(faaFileName, ProteinBatchValidator(faaFileName,
+                                                   acceptProtein))
+    return cogProteinDict
 
-            cogInst = CogInst(_name = cogName, chrom = prokDna.key, pttLine =
-                lineno, strand = cogStrand, start = cogStart, _len = cogLen,
-                faLine = faLineNumber)
-            cogInstSet.add(cogInst)
+def buildCogSet(prokDna, cogProteinDict, missingIdSet = None):
+    if missingIdSet is None:
+        missingIdSet = idsOfMissingProteins
+    cogInstSet = set()
 
-            multiFile.write(faFileName, '>' + cogInst.key + '\n' +
-                            cogProteinDict[cogPid] + '\n')
-            faFileDict[faFileName] = faLineNumber + 2
+    for lineno, cogStart, cogLen, cogName, cogStrand, cogPid in \
+            iterPttCogs(prokDna.getFullPttName()):
+        if cogPid in idsOfBadProteins:
+            # Protein has been malformatted
+            continue
 
-    return cogInstSet
+        if cogPid not in cogProteinDict:
+            print("COG from file %s line %u pid %s not in FAA file" % (
+                prokDna.getFullPttName(), lineno, cogPid))
+            missingIdSet.add(cogPid)
+            continue
+
+        faLineNumber = faFileDict.get(cogName, 1)
 
+        cogInst = CogInst(_name = cogName, chrom = prokDna.key, pttLine =
+            lineno, strand = cogStrand, start = cogStart, _len = cogLen,
+            faLine = faLineNumber)
+        cogInstSet.add(cogInst)
 
-masterDict = UtilLoad(PROK_CLEAN_GENOME_DICT())
-
-for d, prokDnaSet in masterDict.iteritems():
-    for cid in prokDnaSet.getChromIdList():
-        prokDna = prokDnaSet.getChrom(cid)
-        cogInstSet = getCogSet(prokDna)
-        if cogInstSet:
-            fullCogInstList += list(cogInstSet)
-
-multiFile.closeAll()
-print ("MultiFile stat: %s" % multiFile.getStats())
-
-# Now build fullCogDict
-print("Building fullCogDict...")
-for cogInst in fullCogInstList:
-    cog = fullCogDict.get(cogInst.name, Cog(_name=cogInst.name))
-    cog.addCogInst(cogInst)
-    fullCogDict[cogInst.name] = cog
-
-# Make a sample subset of COGs, for debugging
-print("Building sampleCogInstList...")
-sampleCogNames = set()
-for cogName in fullCogDict.keys():
-    if random.randrange(40) == 0:
-        sampleCogNames.add(cogName)
-for cogInst in fullCogInstList:
-    if cogInst.name in sampleCogNames:
-        sampleCogInstList.append(cogInst)
-
-cogNamesList = fullCogDict.items()
-for name, cog in cogNamesList:
-    genomes = cog.calculate()
-    assert(cog.getGenCount() >= 1)
-    for g in genomes:
-        genomeDict[g] = genomeDict.get(g, 0) + 1
-
-print("%d Cog Instances" % len(fullCogInstList))
-print("Dumping to a file...")
-UtilStore(fullCogInstList, COG_INST_LIST())
-
-print("%d Sample Cog Instances" % len(sampleCogInstList))
-print("Dumping to a file...")
-UtilStore(sampleCogInstList, SAMPLE_COG_INST_LIST())
-
-print("%d Cogs total" % len(fullCogDict))
-print("Dumping to a file...")
-cogList = sorted(fullCogDict.values(), key = lambda x: x.instCount,
-    reverse=True)
-UtilStore(cogList, COG_LIST())
-
-print("%d genomes got COGs" % len(genomeDict))
-UtilStore(sorted(genomeDict.items(), key = lambda x: x[1]),
-    GENOME_COG_CNT_LIST())
-
-# See how many genomes got both COGs and taxa
-taxaDict = UtilLoad(PROK_TAXA_DICT())
-taxaSet = set(taxaDict.keys())
-genomeWithCogsSet = set(genomeDict.keys())
-print("%d genomes with both taxa and COGs" % len(set.intersection(taxaSet,
-    genomeWithCogsSet)))
-
-print("Bad proteins %d, missing proteins %d" % (len(idsOfBadProteins),
-                                                len(idsOfMissingProteins)))
+        proteinStore.add(cogName, cogInst.key, cogProteinDict[cogPid])
+        faFileDict[cogName] = faLineNumber + 2
 
+    return cogInstSet
 
+
+# Returns a list of CogInst of this prokDna
+def getCogInstList(prokDna, twoPass, missingIdSet = None):
+    if twoPass:
+        cogInstSet = getCogSetTwoPass(prokDna, missingIdSet)
+    else:
+        cogInstSet = getCogSet(prokDna, missingIdSet)
+    return list(cogInstSet)
+
+def buildProkDna(prokDna, twoPass, entry):
+    """
+    Builds CogInst's of the prokDna, writing their proteins into
+    proteinStore. COGs with a PID in idsOfBadProteins are skipped
+    :param entry: manifest entry of the prokDna; its "missingPids" and
+        "quality" (protein quality summary of the FAA file) are set
+    :return: list of CogInst
+    """
+    missingIdSet = set()
+    cogInstList = getCogInstList(prokDna, twoPass, missingIdSet)
+    entry["missingPids"] = sorted(missingIdSet)
+    entry["quality"] = proteinQualityList[-1]
+    return cogInstList
+
+# Base name of the COG protein store shard, written by one chunk
+def cogShardStore(chunkIndex):
+    return COG_SHARDS_DIR() + "%d/cog_protein_store" % chunkIndex
+
+# Validates the FAA file of this prokDna, and returns set of PIDs of the
+# rejected proteins
+def getBadPidSet(prokDna):
+    badIdSet = set()
+    faaFileName = prokDna.getFullPttName().rpartition('.')[0] + ".faa"
+    readFaaFile(faaFileName, ProteinBatchValidator(faaFileName,
+        lambda pid, protein: None, badIdSet = badIdSet, qualityList = []))
+    return badIdSet
+
+def setBadPids(prokDnaList, manifest, workerCount):
+    """
+    Validates FAA files of the ProkDna's, and sets "badPids" of their
+    manifest entries
+    """
+    print("Validating %d FAA files..." % len(prokDnaList))
+    if (workerCount > 1) and (len(prokDnaList) > 1):
+        pool = multiprocessing.Pool(workerCount)
+        badPidSetList = pool.map(getBadPidSet, prokDnaList)
+        pool.close()
+        pool.join()
+    else:
+        badPidSetList = [getBadPidSet(x) for x in prokDnaList]
+    for prokDna, badPidSet in zip(prokDnaList, badPidSetList):
+        manifest[prokDna.key]["badPids"] = sorted(badPidSet)
+
+# Returns set of PIDs of the bad proteins of all the manifest entries
+def manifestBadPids(manifest):
+    return set().union(*[x["badPids"] for x in manifest.values()])
+
+def processChunk(args):
+    """
+    Worker function: processes a contiguous chunk of ProkDna's, writing COG
+    proteins into its own shard of the COG protein store
+    :param args: tuple (chunk index, list of ProkDna, twoPass, set of PIDs
+        of the bad proteins of all the ProkDna's)
+    :return: tuple (chunk index, list of CogInst with faLine local to the
+        shard, faFileDict of the shard, dictionary ProkDna key -> its
+        manifest entry fields set by buildProkDna())
+    """
+    global faFileDict, proteinStore, proteinQualityList, idsOfBadProteins
+    chunkIndex, prokDnaList, twoPass, badIdSet = args
+    faFileDict = {}
+    proteinQualityList = []
+    # A worker process gets several chunks, so the set is reset here
+    idsOfBadProteins = set(badIdSet)
+    proteinStore = CogProteinStoreWriter(cogShardStore(chunkIndex))
+
+    cogInstList = []
+    entryDict = {}
+    for prokDna in prokDnaList:
+        entryDict[prokDna.key] = {}
+        cogInstList += buildProkDna(prokDna, twoPass,
+                                    entryDict[prokDna.key])
+    proteinStore.close()
+
+    return (chunkIndex, cogInstList, faFileDict, entryDict)
+
+def mergeChunk(cogInstList, chunkFaFileDict):
+    """
+    Translates faLine of the chunk CogInst's. Chunks have to be merged in
+    order.
+    """
+    for cogInst in cogInstList:
+        cogInst.faLine += faFileDict.get(cogInst.name, 1) - 1
+    for cogName, faLineNumber in chunkFaFileDict.iteritems():
+        faFileDict[cogName] = faFileDict.get(cogName, 1) + faLineNumber - 1
+
+def buildCogInstListParallel(prokDnaList, twoPass, workerCount, storeBase,
+                             manifest):
+    if not prokDnaList:
+        CogProteinStoreWriter(storeBase).close()
+        return []
+
+    # Contiguous chunks, a few per worker to balance the load
+    chunkCount = min(workerCount * 4, len(prokDnaList))
+    chunkSize = (len(prokDnaList) + chunkCount - 1) / chunkCount
+    chunkArgs = [(i, prokDnaList[i*chunkSize:(i+1)*chunkSize], twoPass,
+                  idsOfBadProteins) for i in range(chunkCount)]
+
+    cogInstList = []
+    pool = multiprocessing.Pool(workerCount)
+    for chunkIndex, chunkCogInstList, chunkFaFileDict, entryDict in \
+            pool.imap(processChunk, chunkArgs):
+        print("Merging chunk %d of %d" % (chunkIndex + 1, chunkCount))
+        mergeChunk(chunkCogInstList, chunkFaFileDict)
+        cogInstList += chunkCogInstList
+        for key, entry in entryDict.iteritems():
+            manifest[key].update(entry)
+    pool.close()
+    pool.join()
+
+    print("Merging COG protein store shards...")
+    mergeCogProteinStores([cogShardStore(i) for i in range(chunkCount)],
+                          storeBase)
+    shutil.rmtree(COG_SHARDS_DIR())
+    return cogInstList
+
+def buildCogInstTable(prokDnaList, twoPass, workerCount, storeBase,
+                      manifest):
+    """
+    Parses ProkDna's, writing their COG proteins into a new store. A COG is
+    skipped if its protein is bad in any FAA file, so idsOfBadProteins has
+    to be set from all the ProkDna's first (see setBadPids())
+    :param manifest: dictionary ProkDna key -> manifest entry, the fields
+        set by buildProkDna() are set for the ProkDna's
+    :return: CogInstTable
+    """
+    global faFileDict, proteinStore
+    faFileDict = {}
+    if (workerCount > 1) and (len(prokDnaList) > 1):
+        print("Processing %d chromosomes by %d workers" % (len(prokDnaList),
+                                                           workerCount))
+        cogInstList = buildCogInstListParallel(prokDnaList, twoPass,
+                                               workerCount, storeBase,
+                                               manifest)
+    else:
+        proteinStore = CogProteinStoreWriter(storeBase)
+        cogInstList = []
+        for prokDna in prokDnaList:
+            cogInstList += buildProkDna(prokDna, twoPass,
+                                        manifest[prokDna.key])
+        proteinStore.close()
+    return CogInstTable.fromCogInstList(cogInstList)
+
+# Returns manifest entry of an input file: [mtime, size, md5 digest]. The
+# file is not read if mtime and size are the same as in oldSignature
+def fileSignature(fileName, oldSignature):
+    st = os.stat(fileName)
+    if oldSignature and (oldSignature[0] == st.st_mtime) and \
+            (oldSignature[1] == st.st_size):
+        return oldSignature
+    md5 = hashlib.md5()
+    with open(fileName, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), ""):
+            md5.update(block)
+    return [st.st_mtime, st.st_size, md5.hexdigest()]
+
+# Returns manifest entry of a ProkDna: signatures of its PTT and FAA files
+def prokDnaSignature(prokDna, oldEntry):
+    pttFileName = prokDna.getFullPttName()
+    faaFileName = pttFileName.rpartition('.')[0] + ".faa"
+    if not oldEntry:
+        oldEntry = [None, None]
+    return [fileSignature(pttFileName, oldEntry[0]),
+            fileSignature(faaFileName, oldEntry[1])]
+
+def sameSignature(entry1, entry2):
+    return [x[1:] for x in entry1] == [x[1:] for x in entry2]
+
+def updateCogInstTable(retiredKeySet, deltaTable, deltaStoreBase):
+    """
+    Drops instances of the retired ProkDna's from the current COG instance
+    table and COG protein store, and appends the new ones. Within a COG the
+    kept proteins go first, then the new ones; faLine's are renumbered
+    accordingly.
+    :param retiredKeySet: keys of the changed and removed ProkDna's
+    :param deltaTable: CogInstTable of the new and changed ProkDna's
+    :param deltaStoreBase: COG protein store of deltaTable
+    :return: updated CogInstTable
+    """
+    oldTable = CogInstTable.load(COG_INST_TABLE(), mmap = False)
+    oldStore = CogProteinStore(COG_PROTEIN_STORE())
+
+    retiredChrom = np.array([x in retiredKeySet for x in oldTable.chromKeys],
+                            dtype=bool)
+    keepInst = ~retiredChrom[oldTable.chromCode]
+    oldRecs = oldTable.getStoreRecords(oldStore)
+    keepRec = np.zeros(len(oldStore), dtype=bool)
+    keepRec[oldRecs[keepInst]] = True
+    print("Keeping %d out of %d COG instances, adding %d" % (
+        np.count_nonzero(keepInst), len(oldTable), len(deltaTable)))
+
+    # Kept records before the COG, and kept records in the COG
+    keptCum = np.concatenate(([0], np.cumsum(keepRec)))
+    keptBeforeDict = {}
+    keptCountDict = {}
+    for cogName in oldStore.getCogNames():
+        start, end = oldStore.getCogRecordRange(cogName)
+        keptBeforeDict[cogName] = keptCum[start]
+        keptCountDict[cogName] = keptCum[end] - keptCum[start]
+
+    keptTable = oldTable.select(keepInst)
+    keptBefore = np.array([keptBeforeDict[x] for x in keptTable.cogNames],
+                          dtype=np.int64)
+    keptTable.faLine = (2 * (keptCum[oldRecs[keepInst]] -
+        keptBefore[keptTable.cogCode]) + 1).astype(np.int32)
+    keptCount = np.array([keptCountDict.get(x, 0) for x in
+                          deltaTable.cogNames], dtype=np.int64)
+    deltaTable.faLine = (deltaTable.faLine +
+        2 * keptCount[deltaTable.cogCode]).astype(np.int32)
+    oldStore.close()
+
+    print("Updating COG protein store...")
+    mergedStoreBase = COG_PROTEIN_STORE() + "_merged"
+    mergeCogProteinStores([COG_PROTEIN_STORE(), deltaStoreBase],
+                          mergedStoreBase, [keepRec, None])
+    moveCogProteinStore(mergedStoreBase, COG_PROTEIN_STORE())
+    removeCogProteinStore(deltaStoreBase)
+
+    return CogInstTable.concat([keptTable, deltaTable])
+
+def buildCogStats(cogInstTable):
+    """
+    Calculates Cog statistics with one group by over the integer
+    (COG, genome) codes of the instances
+    :return: tuple (dictionary COG name -> Cog, dictionary genome -> COG
+        count)
+    """
+    cogCount = len(cogInstTable.cogNames)
+    dirNames = cogInstTable.getDirNames()
+    dirCount = len(dirNames)
+    cogCode = np.asarray(cogInstTable.cogCode, dtype=np.int64)
+
+    # Distinct (COG, genome) pairs, and the number of instances in each
+    pairs, pairInstCount = np.unique(cogCode * dirCount +
+        cogInstTable.getDirCode(), return_counts=True)
+    pairCog = pairs // dirCount
+    pairDir = pairs % dirCount
+
+    instCount = np.bincount(cogCode, minlength=cogCount)
+    genCount = np.bincount(pairCog, minlength=cogCount)
+
+    # Pairs are sorted by COG, so the per genome instance counts of a COG
+    # are a slice. Mean and std are taken with numpy.mean() and numpy.std()
+    # of the slice, as in Cog.calculate()
+    cogEnd = np.cumsum(genCount)
+    cogDict = {}
+    for code in np.nonzero(instCount)[0].tolist():
+        instPerGen = pairInstCount[cogEnd[code] - genCount[code]:
+                                   cogEnd[code]]
+        cog = Cog(_name=cogInstTable.cogNames[code])
+        cog.setStats(int(instCount[code]), int(genCount[code]),
+                     float(np.mean(instPerGen)), float(np.std(instPerGen)))
+        cogDict[cog.name] = cog
+
+    genomeCogCnt = np.bincount(pairDir, minlength=dirCount)
+    genomeCogCntDict = dict((dirNames[x], int(genomeCogCnt[x])) for x in
+                            np.nonzero(genomeCogCnt)[0].tolist())
+    return (cogDict, genomeCogCntDict)
+
+def cogInstProteinList(cogInstTable, storeBase):
+    """
+    :return: sorted list of (COG name, chromosome, PTT line, strand, start,
+        length, protein) of all the instances; faLine is left out, it
+        depends on the order the chromosomes were built in
+    """
+    store = CogProteinStore(storeBase)
+    try:
+        return sorted((x.name, x.chrom, x.pttLine, x.strand, x.start, x.len,
+                       store.getProteinByFaLine(x.name, x.faLine)) for x in
+                      cogInstTable)
+    finally:
+        store.close()
+
+def checkFullRebuild(prokDnaList, twoPass, workerCount, cogInstTable,
+                     manifest):
+    """
+    Builds COG instances of the ProkDna's from scratch into a temporary
+    store, and compares them with cogInstTable and COG_PROTEIN_STORE():
+    instances and their proteins, COG statistics, bad and missing PIDs and
+    protein quality summaries
+    :return: True if they are the same
+    """
+    global idsOfBadProteins, proteinQualityList
+    buildBadIds = idsOfBadProteins
+    buildQualityList = proteinQualityList
+    proteinQualityList = []
+    checkManifest = dict((x.key, {"files": manifest[x.key]["files"]}) for x
+                         in prokDnaList)
+    setBadPids(prokDnaList, checkManifest, workerCount)
+    idsOfBadProteins = manifestBadPids(checkManifest)
+    checkStoreBase = COG_PROTEIN_STORE() + "_check"
+    try:
+        checkTable = buildCogInstTable(prokDnaList, twoPass, workerCount,
+                                       checkStoreBase, checkManifest)
+        checkInsts = cogInstProteinList(checkTable, checkStoreBase)
+    finally:
+        idsOfBadProteins = buildBadIds
+        proteinQualityList = buildQualityList
+        if os.path.isfile(checkStoreBase + ".dat"):
+            removeCogProteinStore(checkStoreBase)
+
+    ok = True
+    insts = cogInstProteinList(cogInstTable, COG_PROTEIN_STORE())
+    if insts != checkInsts:
+        print("COG instances differ: %d, full rebuild %d" % (len(insts),
+                                                             len(checkInsts)))
+        ok = False
+    cogDict, genomeDict = buildCogStats(cogInstTable)
+    checkCogDict, checkGenomeDict = buildCogStats(checkTable)
+    cogStats = lambda d: sorted((x.name, x.instCount, x.genCount,
+        x.meanInstPerGen, x.stdInstPerGen) for x in d.values())
+    if (cogStats(cogDict) != cogStats(checkCogDict)) or \
+            (genomeDict != checkGenomeDict):
+        print("COG statistics differ")
+        ok = False
+    for field in ["badPids", "missingPids", "quality"]:
+        diffKeys = [x.key for x in prokDnaList if manifest[x.key][field] !=
+                    checkManifest[x.key][field]]
+        if diffKeys:
+            print("%s differ in %d chromosomes, e.g. %s" % (field,
+                len(diffKeys), diffKeys[0]))
+            ok = False
+    return ok
+
+
+if __name__ == "__main__":
+
+    args = sys.argv[1:]
+    twoPass = "twoPass" in args
+    if twoPass:
+        print("Reading FAA files in two pass mode")
+    fastaExport = "fasta" in args
+    incremental = "incremental" in args
+    checkRebuild = "check" in args
+    workerCount = 1
+    if "workers" in args:
+        workerCount = int(args[args.index("workers") + 1])
+
+    masterDict = UtilLoad(PROK_CLEAN_GENOME_DICT())
+
+    prokDnaList = []
+    for d, prokDnaSet in masterDict.iteritems():
+        for cid in prokDnaSet.getChromIdList():
+            prokDnaList.append(prokDnaSet.getChrom(cid))
+
+    if incremental and not (os.path.isfile(COG_BUILD_MANIFEST()) and
+            os.path.isdir(COG_INST_TABLE())):
+        print("No previous build, building from scratch")
+        incremental = False
+    if incremental:
+        oldManifest = UtilLoad(COG_BUILD_MANIFEST())
+        if not all(isinstance(x, dict) for x in oldManifest.values()):
+            print("Previous build has no per chromosome protein data, "
+                  "building from scratch")
+            incremental = False
+
+    if incremental:
+        manifest = {}
+        changedList = []
+        for prokDna in prokDnaList:
+            oldEntry = oldManifest.get(prokDna.key)
+            files = prokDnaSignature(prokDna, oldEntry["files"] if oldEntry
+                                     else None)
+            if oldEntry and sameSignature(files, oldEntry["files"]):
+                manifest[prokDna.key] = dict(oldEntry, files = files)
+            else:
+                manifest[prokDna.key] = {"files": files}
+                changedList.append(prokDna)
+        setBadPids(changedList, manifest, workerCount)
+        idsOfBadProteins.update(manifestBadPids(manifest))
+
+        # COGs of the unchanged chromosomes are rebuilt if their PIDs became
+        # bad or stopped being bad
+        changedKeySet = set(x.key for x in changedList)
+        flippedPidSet = manifestBadPids(oldManifest) ^ idsOfBadProteins
+        affectedList = []
+        if flippedPidSet:
+            affectedList = [x for x in prokDnaList if (x.key not in
+                changedKeySet) and (getCogPidSet(x) & flippedPidSet)]
+        changedList += affectedList
+        changedKeySet.update(x.key for x in affectedList)
+
+        retiredKeySet = set(oldManifest.keys()) - \
+            (set(manifest.keys()) - changedKeySet)
+        print("%d chromosomes: %d new or changed, %d affected by bad "
+              "proteins, %d retired" % (len(prokDnaList),
+              len(changedList) - len(affectedList), len(affectedList),
+              len(retiredKeySet)))
+        deltaStoreBase = COG_PROTEIN_STORE() + "_delta"
+        deltaTable = buildCogInstTable(changedList, twoPass, workerCount,
+                                       deltaStoreBase, manifest)
+        cogInstTable = updateCogInstTable(retiredKeySet, deltaTable,
+                                          deltaStoreBase)
+    else:
+        manifest = dict((x.key, {"files": prokDnaSignature(x, None)}) for
+                        x in prokDnaList)
+        setBadPids(prokDnaList, manifest, workerCount)
+        idsOfBadProteins.update(manifestBadPids(manifest))
+        cogInstTable = buildCogInstTable(prokDnaList, twoPass, workerCount,
+                                         COG_PROTEIN_STORE(), manifest)
+
+    # Missing PIDs and quality summaries of all the current chromosomes,
+    # rebuilt or not
+    idsOfMissingProteins = set().union(*[x["missingPids"] for x in
+                                         manifest.values()])
+    proteinQualityList = [manifest[x.key]["quality"] for x in prokDnaList]
+
+    if fastaExport:
+        print("Exporting COG FASTA files...")
+        store = CogProteinStore(COG_PROTEIN_STORE())
+        store.exportFasta(config.WORK_FILES_DIR())
+        store.close()
+
+    # Now build fullCogDict
+    print("Building fullCogDict...")
+    fullCogDict, genomeDict = buildCogStats(cogInstTable)
+
+    # Make a sample subset of COGs, for debugging
+    print("Building sampleCogInstList...")
+    sampleCogCodes = [ind for ind in range(len(cogInstTable.cogNames)) if
+                      random.randrange(40) == 0]
+    sampleCogInstTable = cogInstTable.select(
+        np.in1d(cogInstTable.cogCode, sampleCogCodes))
+
+    print("%d Cog Instances" % len(cogInstTable))
+    print("Dumping to a file...")
+    cogInstTable.store(COG_INST_TABLE())
+
+    print("%d Sample Cog Instances" % len(sampleCogInstTable))
+    print("Dumping to a file...")
+    sampleCogInstTable.store(SAMPLE_COG_INST_TABLE())
+
+    print("%d Cogs total" % len(fullCogDict))
+    print("Dumping to a file...")
+    cogList = sorted(fullCogDict.values(), key = lambda x: x.instCount,
+        reverse=True)
+    UtilStore(cogList, COG_LIST())
+
+    print("%d genomes got COGs" % len(genomeDict))
+    UtilStore(sorted(genomeDict.items(), key = lambda x: x[1]),
+        GENOME_COG_CNT_LIST())
+
+    # Manifest goes last, so an interrupted run is redone next time
+    UtilStore(manifest, COG_BUILD_MANIFEST())
+
+    # See how many genomes got both COGs and taxa
+    taxaDict = UtilLoad(PROK_TAXA_DICT())
+    taxaSet = set(taxaDict.keys())
+    genomeWithCogsSet = set(genomeDict.keys())
+    print("%d genomes with both taxa and COGs" % len(set.intersection(taxaSet,
+        genomeWithCogsSet)))
+
+    print("Bad proteins %d, missing proteins %d" % (len(idsOfBadProteins),
+                                                    len(idsOfMissingProteins)))
+
+    print("Protein quality: %d proteins, %d residues, rejected %d, %d "
+          "unknown lines, %d files with rejections" % tuple(
+        [sum([x[k] for x in proteinQualityList]) for k in
+         ["proteins", "residues", "rejected", "unknownLines"]] +
+        [len([x for x in proteinQualityList if x["rejected"]])]))
+    UtilStore(proteinQualityList, PROTEIN_QUALITY_SUMMARY())
+
+    if checkRebuild:
+        print("Checking against a full rebuild...")
+        if not checkFullRebuild(prokDnaList, twoPass, workerCount,
+                                cogInstTable, manifest):
+            print("FAILED")
+            sys.exit(1)
+        print("OK")
@@ -1,6 +1,10 @@
 # This module builds PROK_GENOME_DICT() file (see utils.py)
+# Usage: build_prok_dict.py [<worker count>]
+# With worker count > 1 genome directories are parsed by a process pool
 
+import sys
 import glob
+import multiprocessing
 from filedefs import *
 from shared.pyutils.utils import *
 from genome_cls import ProkDna, ProkDnaSet, ProkGenome, CogInst, Cog
@@ -11,37 +15,90 @@ prokGenomeDict = {}
 # Dictionary ProkDna key -> ProkDna. Saved into PROK_DNA_DICT file.
 prokDnaDict = {}
 
+# List of (dir, error message) for directories failed with UtilError
+failedDirList = []
+
 inputCount = 0
 
-def newProkGenome(dir):
+def newProkGenome(dir, prokDnaList):
+    """
+    :param dir: genome directory
+    :param prokDnaList: list the non auxiliary ProkDna's of the genome are
+        appended to; they are there even if the genome fails verification
+    :return: ProkGenome
+    """
     prokGenome = ProkGenome(_dir = dir)
     fullDir = config.PROKARYOTS_DIR() + dir + '/'
-    pttFiles = glob.glob(fullDir + "*.ptt")
+    pttFiles = sorted(glob.glob(fullDir + "*.ptt"))
     for pttFileName in pttFiles:
         prokDna = ProkDna(fullPttName = pttFileName)
         if prokDna.isAuxiliary():
             continue
-        prokDnaDict[prokDna.key] = prokDna
+        prokDnaList.append(prokDna)
         prokGenome.add(prokDna)
     prokGenome.verify()
     return prokGenome
 
-with open(PROKARYOT_DIRS_FILE(), 'r') as fdirs:
-    for dir in fdirs:
-        inputCount += 1
-        dir = dir.strip()
-        try:
-            prokGenome = newProkGenome(dir)
-        except UtilError as e:
-            print("UtilError: %s" % e)
+def processDir(dir):
+    """
+    Worker function, safe to run in a separate process
+    :return: tuple (dir, ProkGenome, list of ProkDna, error message); in case
+        of UtilError ProkGenome is None, error message is set, and the list
+        has the ProkDna's created before the error
+    """
+    prokDnaList = []
+    try:
+        prokGenome = newProkGenome(dir, prokDnaList)
+    except UtilError as e:
+        return (dir, None, prokDnaList, str(e))
+    return (dir, prokGenome, prokDnaList, None)
+
+if __name__ == "__main__":
+
+    workerCount = 1
+    if len(sys.argv) == 2:
+        workerCount = int(sys.argv[1])
+
+    with open(PROKARYOT_DIRS_FILE(), 'r') as fdirs:
+        dirList = [x.strip() for x in fdirs]
+    inputCount = len(dirList)
+
+    if workerCount > 1:
+        print("Parsing %d directories by %d workers..." % (inputCount,
+                                                            workerCount))
+        pool = multiprocessing.Pool(workerCount)
+        # imap keeps the input order, so the merge is deterministic
+        resultIter = pool.imap(processDir, dirList, chunksize = 16)
+    else:
+        pool = None
+        resultIter = (processDir(x) for x in dirList)
+
+    for ind, (dir, prokGenome, prokDnaList, error) in \
+            enumerate(resultIter, start = 1):
+        print("\r%d. %s" % (ind, dir)),
+        # ProkDna's of the failed directories are kept in PROK_DNA_DICT too
+        for prokDna in prokDnaList:
+            prokDnaDict[prokDna.key] = prokDna
+        if error is not None:
+            failedDirList.append((dir, error))
             continue
         prokGenomeDict[dir] = prokGenome
+    print
+
+    if pool:
+        pool.close()
+        pool.join()
+
+    if failedDirList:
+        print("UtilError in %d directories:" % len(failedDirList))
+        for dir, error in failedDirList:
+            print("%s: %s" % (dir, error))
 
-UtilStore(prokGenomeDict, PROK_GENOME_DICT())
+    UtilStore(prokGenomeDict, PROK_GENOME_DICT())
 
-print("Input %d entries, output %d entries" % (inputCount,
-                                               len(prokGenomeDict)))
+    print("Input %d entries, output %d entries" % (inputCount,
+                                                   len(prokGenomeDict)))
 
-UtilStore(prokDnaDict, PROK_DNA_DICT())
+    UtilStore(prokDnaDict, PROK_DNA_DICT())
 
-print("ProkDna dictionary: %d entries" % len(prokDnaDict))
+    print("ProkDna dictionary: %d entries" % len(prokDnaDict))
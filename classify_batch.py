@@ -0,0 +1,81 @@
+# This module classifies a batch of external (query) genomes against the
+# fixed reference set (see reference_model.py). Queries do not go into
+# cogFreq or the reference statistics, so the result for a query does not
+# depend on the other queries of the batch.
+# Usage: classify_batch.py <query list file> <output dir> [workers <n>]
+# Query list file has one query per line: a PTT file (with the FAA file
+# next to it), or a genome directory with PTT and FAA files.
+# Output: <output dir>/<query>.txt - Reclassify.txt style report of every
+#   query; <output dir>/Reclassify.txt - reports of the reclassified
+#   queries, the best fit first; <output dir>/batch_results.json - results
+#   of all the queries
+
+import sys
+import json
+from reference_model import *
+
+
+def queryName(query):
+    """
+    :return: name of the query for the reports: genome directory, or
+        directory and base name of the PTT file
+    """
+    query = os.path.normpath(query)
+    if os.path.isdir(query):
+        return os.path.basename(query)
+    head, tail = os.path.split(query)
+    return os.path.basename(head) + "_" + tail.rpartition('.')[0]
+
+
+if __name__ == "__main__":
+
+    args = sys.argv[1:]
+    workerCount = 1
+    if "workers" in args:
+        ind = args.index("workers")
+        workerCount = int(args[ind + 1])
+        del args[ind:ind + 2]
+    if len(args) != 2:
+        print("Usage: classify_batch.py <query list file> <output dir> "
+              "[workers <n>]")
+        sys.exit(1)
+    queryListFileName, outDir = args
+
+    with open(queryListFileName, 'r') as f:
+        queryList = [l.strip() for l in f if l.strip()]
+    if not os.path.isdir(outDir):
+        os.makedirs(outDir)
+
+    model = ReferenceModel()
+    resultList = model.classifyBatch(queryList, workerCount)
+
+    reclassTextList = []
+    resultDictList = []
+    nameSet = set()
+    for ind, (query, result) in enumerate(zip(queryList, resultList)):
+        name = queryName(query)
+        if name in nameSet:
+            name += "_%d" % ind
+        nameSet.add(name)
+        if result is None:
+            resultDictList.append({"query": query, "name": name,
+                                   "error": "Could not be read"})
+            continue
+        s = queryText(name, result)
+        with open(os.path.join(outDir, name + ".txt"), "w") as f:
+            f.write(s)
+        if result.reclassified:
+            reclassTextList.append((result.bestFit, s))
+        d = resultDict(result)
+        d["query"] = query
+        d["name"] = name
+        resultDictList.append(d)
+
+    with open(os.path.join(outDir, "Reclassify.txt"), "w") as f:
+        for t in sorted(reclassTextList, reverse = True):
+            f.write(t[1])
+    with open(os.path.join(outDir, "batch_results.json"), "w") as f:
+        json.dump(resultDictList, f, indent = 1)
+
+    print("%d queries, %d could not be read, %d reclassified" % (
+        len(queryList), resultList.count(None), len(reclassTextList)))
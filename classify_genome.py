@@ -1,10 +1,12 @@
 # Place a genome (identified by its directory name) into a Taxonomy
 # Classification tree, based on the hierarchical algorithm: average
 # COG distances for domain, phylum, etc.
+# Usage: classify_genome.py [histograms]
+# histograms - draw histograms of the distances within the taxons of every
+#   depth
 
 import sys
 from taxonomy import *
-from collections import defaultdict as DefDict
 import common_cogs_method as commonCogsMethod
 from shared.algorithms.kendall import calculateWeightedKendall
 from shared.pyutils.utils import *
@@ -13,121 +15,256 @@ import config
 import operator
 import math
 import itertools
+import numpy as np
+import scipy.sparse
 
 CutOffDiff = 0.
 CutOffBestFit = 0.00001 # To account for rounding errors
 
 
-_, _, taxaDict, _ = \
-    commonCogsMethod.buildCogTaxaDict(noWeights = True)
-print ("taxaDict len %d" % len(taxaDict))
-
-print("Reading COG distances...")
-cogDist = UtilLoad(COG_DIST_DICT())
-
-# Build a tree of TaxaTypes
-taxaTypeTree = TaxaTypeTree(taxaDict)
-
-# Set of all Taxa types on all levels
-allTaxaTypes = taxaTypeTree.getAllTypesSet()
-print("Length of allTaxaTypes %d" % len(allTaxaTypes))
-
-# Build a dictionary: [dir][taxaType] -> UtilObject(mean, std,
-# isAncest, distList), where
-# mean - mean distance between this dir and all [other] dirs in this taxaType
-# std - standard deviation, if applicable
-# distList - list of all the distances
-print("Building taxaTypeDistDict...")
-taxaTypeDistDict = DefDict(dict)
-taxaTypeAncDistDict = DefDict(lambda: [None] * (TaxaType.hierarchySize()+1))
-for ind, dir in enumerate(taxaDict, start = 1):
-    print("\r%u. %s" % (ind, dir)),
-    d = taxaTypeDistDict[dir]
-    listAnc = taxaTypeAncDistDict[dir]
-    cogDistForDir = cogDist[dir]
-    for currType in allTaxaTypes:
-        dirs = taxaTypeTree.getDirSet(currType)
-        if dir in dirs:
-            ancestorList = True
-            dirs.remove(dir)
-        else:
-            ancestorList = False
-        distList = [cogDistForDir[x] for x in dirs]
-        meanVal = 0.0
-        stdVal = 0.0
-        if len(distList) > 0:
-            meanVal = np.mean(distList)
-        if len(distList) > 1:
-            stdVal = np.std(distList, ddof = 1.0)
-        if ancestorList:
-            listAnc[currType.depth()] = UtilObject(mean=meanVal, std=stdVal,
-                distList=distList)
-        else:
-            d[currType] = UtilObject(mean=meanVal, std=stdVal,
-                distList=distList)
-print
-
-# Build lists of distances for each level
-print("Build globDistList...")
-globDistList = []
-for i in range(TaxaType.hierarchySize() + 1):
-    globDistList.append([])
-for listAnc in taxaTypeAncDistDict.values():
-    for ind, obj in enumerate(listAnc):
-        if obj is None:
-            continue
-        globDistList[ind].extend(obj.distList)
-
-# Build list of UtilObject(mean, std, count)
-globStdList = []
-for l in globDistList:
-    UtilDrawHistogram(l, show = False)
-    if len(l) >= 2:
-        std = std=np.std(l, ddof=1.0)
-    else:
-        std = None
-    globStdList.append(std)
-UtilDrawHistogram(show = True)
-print globStdList
-
-bestFitHistogram = []
-reclassTextList = []
-reclassObjList = []
-print("RECLASSIFICATIONS...")
-for ind, (dir, taxa) in enumerate(taxaDict.iteritems(), start=1):
-    typeOrig = taxa.type
-    distObjAnc = taxaTypeAncDistDict[dir]
-    taxaTypeToObj = taxaTypeDistDict[dir]
+class TaxonStats(object):
+    """
+    Statistics of COG distances between every genome and the other genomes
+    of every taxon
+    Attributes:
+        dirs - list of genome dirs, rows
+        dirIndex - dictionary genome dir -> row
+        types - list of TaxaType's of all the tree nodes, columns; columns
+            are the TaxaTypeTree node ids
+        typeIndex - dictionary TaxaType key -> column
+        mean - float array N x T, mean distance between the genome and the
+            [other] genomes of the taxon
+        std - float array N x T, standard deviation, if applicable
+        count - int array N x T, number of the [other] genomes of the taxon
+        ancestors - int array N x (hierarchySize+1), column of the taxon of
+            every depth the genome belongs to, -1 if none
+        depthCount, depthMean, depthM2 - per depth number, mean and sum of
+            squared deviations from the mean of the distances of all
+            genomes to their ancestor taxons
+    """
+
+    def __init__(self, dirs, types):
+        self.dirs = list(dirs)
+        self.dirIndex = dict((d, i) for i, d in enumerate(self.dirs))
+        self.types = list(types)
+        self.typeIndex = dict((t.key, i) for i, t in enumerate(self.types))
+        n = len(self.dirs)
+        t = len(self.types)
+        self.mean = np.zeros((n, t))
+        self.std = np.zeros((n, t))
+        self.count = np.zeros((n, t), dtype=np.int32)
+        self.ancestors = np.full((n, TaxaType.hierarchySize() + 1), -1,
+                                 dtype=np.int32)
+        self.depthCount = np.zeros(TaxaType.hierarchySize() + 1,
+                                   dtype=np.int64)
+        self.depthMean = np.zeros(TaxaType.hierarchySize() + 1)
+        self.depthM2 = np.zeros(TaxaType.hierarchySize() + 1)
+
+    def getColumn(self, type):
+        return self.typeIndex[type.key]
+
+    def globalStdList(self):
+        """
+        :return: list, per depth, of standard deviations of the distances
+            of all genomes to their ancestor taxons, None if not applicable
+        """
+        stdList = []
+        for cnt, m2 in zip(self.depthCount, self.depthM2):
+            if cnt >= 2:
+                stdList.append(math.sqrt(max(0., m2 / (cnt - 1))))
+            else:
+                stdList.append(None)
+        return stdList
+
+    def addDepthGroups(self, depths, count, mean, m2):
+        """
+        Adds groups of distances to the per depth statistics. Groups are
+        combined through their means and sums of squared deviations
+        (Chan et al.), without the sums of squares, which lose precision
+        :param depths, count, mean, m2: per group depth, number of the
+            distances, their mean and sum of squared deviations
+        """
+        size = len(self.depthCount)
+        blockCount = np.bincount(depths, weights=count, minlength=size)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            blockMean = np.where(blockCount > 0, np.bincount(depths,
+                weights=count * mean, minlength=size) / blockCount, 0.)
+        dev = mean - blockMean[depths]
+        blockM2 = np.bincount(depths, weights=m2 + count * dev * dev,
+                              minlength=size)
+        total = self.depthCount + blockCount
+        with np.errstate(divide='ignore', invalid='ignore'):
+            delta = blockMean - self.depthMean
+            self.depthM2 += np.where(total > 0, blockM2 + delta * delta *
+                self.depthCount * blockCount / total, 0.)
+            self.depthMean += np.where(total > 0,
+                                       delta * blockCount / total, 0.)
+        self.depthCount += blockCount.astype(np.int64)
+
+
+def distRows(cogDist, start, end):
+    """
+    :return: dense rows [start, end) of SymMatrix or TiledSymMatrix
+    """
+    return np.array([cogDist.rowArray(i) for i in range(start, end)])
+
+def membershipMatrix(taxaTypeTree, dirIndex):
+    """
+    :return: tuple (list of TaxaType's of all the tree nodes, sparse
+        genome x taxon matrix, 1 if the genome is in the taxon or in its
+        descendants)
+    """
+    types = taxaTypeTree.nodeTypes
+    rows = []
+    cols = []
+    for col, type in enumerate(types):
+        dirs = taxaTypeTree.getDirSet(type)
+        rows.extend(dirIndex[x] for x in dirs)
+        cols.extend([col] * len(dirs))
+    m = scipy.sparse.csr_matrix((np.ones(len(rows)), (rows, cols)),
+                                shape=(len(dirIndex), len(types)))
+    return (types, m)
+
+def buildTaxonStats(cogDist, taxaTypeTree, blockSize = 256):
+    """
+    Calculates TaxonStats for all (genome, taxon) pairs at once, out of
+    sums and sums of squares of the distances, D * M and D^2 * M, where M is
+    the genome x taxon membership matrix. Distances of every genome are
+    shifted by their mean first, so the sums of squares do not cancel out.
+    For the taxons the genome is in, its distance to itself is subtracted
+    :param cogDist: SymMatrix or TiledSymMatrix of COG distances
+    """
+    types, membership = membershipMatrix(taxaTypeTree, cogDist.dirIndex)
+    stats = TaxonStats(cogDist.dirs, types)
+    typeDepth = np.array([x.depth() for x in types], dtype=np.int64)
+    memberCount = np.asarray(membership.sum(axis=0)).ravel()
+    membershipT = membership.T.tocsr()
+    n = len(stats.dirs)
+    for start in range(0, n, blockSize):
+        end = min(start + blockSize, n)
+        print("\r%u. %s" % (end, stats.dirs[end-1])),
+        dist = distRows(cogDist, start, end)
+        shift = dist.mean(axis=1)
+        dist = dist - shift[:, None]
+        isMember = membership[start:end].toarray()
+        selfDist = dist[np.arange(end - start), np.arange(start, end)]
+        sums = membershipT.dot(dist.T).T - selfDist[:, None] * isMember
+        sumSqs = membershipT.dot((dist * dist).T).T - \
+            (selfDist * selfDist)[:, None] * isMember
+        count = memberCount[None, :] - isMember
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = np.where(count > 0, sums / count, 0.)
+            m2 = np.maximum(sumSqs - sums * mean, 0.)
+            var = np.where(count > 1, m2 / (count - 1), 0.)
+        stats.mean[start:end] = np.where(count > 0, mean + shift[:, None],
+                                         0.)
+        stats.std[start:end] = np.sqrt(var)
+        stats.count[start:end] = count
+
+        rowInd, colInd = np.nonzero(isMember)
+        depths = typeDepth[colInd]
+        stats.ancestors[start + rowInd, depths] = colInd
+        stats.addDepthGroups(depths, count[rowInd, colInd],
+            stats.mean[start + rowInd, colInd], m2[rowInd, colInd])
+    print
+    return stats
+
+def drawDepthHistograms(stats, cogDist):
+    """
+    Draws, per depth, histogram of the distances between the genomes of
+    the same taxon of that depth. COG distances are read row by row, and
+    only the distances to the other genomes of the row's taxons are kept
+    """
+    depthCount = stats.ancestors.shape[1]
+    # Per depth, taxon column -> rows of its genomes
+    memberRows = []
+    for depth in range(depthCount):
+        cols = stats.ancestors[:, depth]
+        order = np.argsort(cols, kind='mergesort')
+        uniq, starts = np.unique(cols[order], return_index=True)
+        memberRows.append(dict(zip(uniq.tolist(),
+            np.split(order, starts[1:]))))
+
+    distList = [[] for _ in range(depthCount)]
+    for i in range(len(stats.dirs)):
+        row = cogDist.rowArray(i)
+        for depth in range(depthCount):
+            col = stats.ancestors[i, depth]
+            if col < 0:
+                continue
+            rows = memberRows[depth][col]
+            distList[depth].append(row[rows[rows != i]])
+    for depth in range(depthCount):
+        UtilDrawHistogram(np.concatenate(distList[depth]).tolist() if
+                          distList[depth] else [], show = False)
+        distList[depth] = None
+    UtilDrawHistogram(show = True)
+
+def candidateTypes(typeList, taxaTypeTree):
+    """
+    :return: int array of the node ids of the distinct types, in the order
+        of their first appearance
+    """
+    seen = set()
+    ids = []
+    for type in typeList:
+        id = taxaTypeTree.getNodeId(type)
+        if id not in seen:
+            seen.add(id)
+            ids.append(id)
+    return np.array(ids, dtype=np.int32)
+
+def classifyGenome(dir, typeOrig, candidateIds, taxaTypeTree, stats,
+    globStdList):
+    """
+    Finds the best fit taxonomy for a genome
+    :param candidateIds: node ids of the TaxaType's to try, see
+        candidateTypes()
+    :return: tuple (bestFit, bestFitType, bestFitComparedTaxons)
+    """
+    row = stats.dirIndex[dir]
+    return scoreCandidates(stats.mean[row], stats.count[row],
+        stats.ancestors[row], typeOrig, candidateIds, taxaTypeTree,
+        globStdList)
+
+def scoreCandidates(mean, count, ancestors, typeOrig, candidateIds,
+    taxaTypeTree, globStdList):
+    """
+    Best fit scoring of one genome
+    :param mean, count: the genome row of TaxonStats.mean and count
+    :param ancestors: columns of the taxons of typeOrig by depth, see
+        TaxonStats.ancestors
+    :return: tuple (bestFit, bestFitType, bestFitComparedTaxons)
+    """
+    nodeDepth = taxaTypeTree.nodeDepth
+    nodeParent = taxaTypeTree.nodeParent
+    origId = taxaTypeTree.getNodeId(typeOrig)
+    lcaIds = taxaTypeTree.lcaArray(origId, candidateIds)
 
     bestFit = -1.0
     bestFitType = None
     bestFitComparedTaxons = None
-    for taxaOther in taxaDict.values():
-        typeOther = taxaOther.type
-        commonAncestor = typeOrig.commonAncestor(typeOther)
-        commonDepth = commonAncestor.depth()
-        if (commonAncestor == typeOrig) or (commonAncestor == typeOther):
+    for otherId, lcaId in zip(candidateIds.tolist(), lcaIds.tolist()):
+        if (lcaId == origId) or (lcaId == otherId):
             continue
-        distObjOther = [None] * (TaxaType.hierarchySize() + 1)
-        currType = typeOther
-        while currType.depth() > commonDepth:
-            distObjOther[currType.depth()] = taxaTypeToObj[currType]
-            currType = currType.parent()
+        commonDepth = nodeDepth[lcaId]
+        colOther = [-1] * (TaxaType.hierarchySize() + 1)
+        currId = otherId
+        while nodeDepth[currId] > commonDepth:
+            colOther[nodeDepth[currId]] = currId
+            currId = nodeParent[currId]
         sum = 0.0
-        worstDiff = 1000000. # Very large number
-        compCount = 0
         comparedTaxons = []
         prevDistAnc = None
         prevDistOther = None
         for i in range(TaxaType.hierarchySize(), commonDepth, -1):
-            objAnc = distObjAnc[i]
-            objOther = distObjOther[i]
-            calcAnc = bool(objAnc) and bool(objAnc.distList)
-            calcOther = bool(objOther) and bool(objOther.distList)
+            colAnc = ancestors[i]
+            calcAnc = (colAnc >= 0) and (count[colAnc] > 0)
+            calcOther = (colOther[i] >= 0) and (count[colOther[i]] > 0)
             if calcAnc:
-                prevDistAnc = objAnc.mean
+                prevDistAnc = mean[colAnc]
             if calcOther:
-                prevDistOther = objOther.mean
+                prevDistOther = mean[colOther[i]]
             if (calcAnc or calcOther) and \
                 (prevDistAnc is not None) and (prevDistOther is not None):
                 diff = (prevDistAnc - prevDistOther) / globStdList[i]
@@ -138,35 +275,80 @@ for ind, (dir, taxa) in enumerate(taxaDict.iteritems(), start=1):
                 comparedTaxons.append((TaxaType.hierarchy()[i-1], diff))
         if sum > bestFit:
             bestFit = sum
-            bestFitType = typeOther
+            bestFitType = taxaTypeTree.nodeTypes[otherId]
             bestFitComparedTaxons = comparedTaxons
+    return (bestFit, bestFitType, bestFitComparedTaxons)
+
+def reclassText(dir, typeOrig, bestFitType, bestFit, comparedTaxons):
+    return ("\n%s\nOriginal: %s\nReclassified: %s\nTaxonomy distance: %d" +\
+        "\nSigmas: %f\nCompared taxons: %s\nSigmas per compare: %f\n")%\
+        (dir, repr(typeOrig), repr(bestFitType),
+        typeOrig.distance(bestFitType), bestFit,
+        ", ".join([":".join((str(y) for y in x)) for x in \
+        comparedTaxons]),
+        bestFit/len(comparedTaxons))
+
+
+if __name__ == "__main__":
+
+    # Histograms of the distances within the taxons of every depth, off by
+    # default: they keep the distances of all the genome pairs of a taxon
+    drawHistograms = "histograms" in sys.argv[1:]
+
+    _, _, taxaDict, _ = \
+        commonCogsMethod.buildCogTaxaDict(noWeights = True)
+    print ("taxaDict len %d" % len(taxaDict))
+
+    print("Reading COG distances...")
+    cogDist = commonCogsMethod.loadCogDist()
+
+    # Build a tree of TaxaTypes
+    taxaTypeTree = TaxaTypeTree(taxaDict)
+
+    print("Building taxon statistics...")
+    stats = buildTaxonStats(cogDist, taxaTypeTree)
+    print("Length of allTaxaTypes %d" % len(stats.types))
+
+    if drawHistograms:
+        print("Drawing distance histograms...")
+        drawDepthHistograms(stats, cogDist)
+    globStdList = stats.globalStdList()
+    print globStdList
+
+    bestFitHistogram = []
+    reclassTextList = []
+    reclassObjList = []
+    # Genomes of the same type give the same fit, so every type is tried once
+    candidateIds = candidateTypes([x.type for x in taxaDict.values()],
+                                  taxaTypeTree)
+    print("RECLASSIFICATIONS...")
+    for ind, (dir, taxa) in enumerate(taxaDict.iteritems(), start=1):
+        typeOrig = taxa.type
+        bestFit, bestFitType, bestFitComparedTaxons = \
+            classifyGenome(dir, typeOrig, candidateIds, taxaTypeTree, stats,
+                           globStdList)
 
-    print("\r%u. %s bestFit %f" % (ind, dir, bestFit)),
-    bestFitHistogram.append(bestFit)
-    if bestFit > CutOffBestFit:
+        print("\r%u. %s bestFit %f" % (ind, dir, bestFit)),
+        bestFitHistogram.append(bestFit)
+        if bestFit > CutOffBestFit:
 
-        s = ("\n%s\nOriginal: %s\nReclassified: %s\nTaxonomy distance: %d" +\
-            "\nSigmas: %f\nCompared taxons: %s\nSigmas per compare: %f\n")%\
-            (dir, repr(typeOrig), repr(bestFitType),
-            typeOrig.distance(bestFitType), bestFit,
-            ", ".join([":".join((str(y) for y in x)) for x in \
-            bestFitComparedTaxons]),
-            bestFit/len(bestFitComparedTaxons))
-        print s
-        reclassTextList.append((bestFit, s))
+            s = reclassText(dir, typeOrig, bestFitType, bestFit,
+                            bestFitComparedTaxons)
+            print s
+            reclassTextList.append((bestFit, s))
 
-        reclassObjList.append(UtilObject(dir=dir, orig=typeOrig, bestFit= \
-            bestFitType, taxDist=typeOrig.distance(bestFitType), \
-            comparedTaxons=bestFitComparedTaxons, sigmas=bestFit, \
-            sigmPerComp=bestFit/len(bestFitComparedTaxons)))
+            reclassObjList.append(UtilObject(dir=dir, orig=typeOrig,
+                bestFit=bestFitType, taxDist=typeOrig.distance(bestFitType),
+                comparedTaxons=bestFitComparedTaxons, sigmas=bestFit,
+                sigmPerComp=bestFit/len(bestFitComparedTaxons)))
 
-UtilDrawHistogram(bestFitHistogram, show=True)
+    UtilDrawHistogram(bestFitHistogram, show=True)
 
-UtilStore(sorted(reclassObjList, key = lambda x: x.bestFit, reverse=True),
-    RECLASSIFIED_DIR_LIST())
+    UtilStore(sorted(reclassObjList, key = lambda x: x.bestFit,
+                     reverse=True), RECLASSIFIED_DIR_LIST())
 
-reclassList = sorted(reclassTextList, reverse = True)
+    reclassList = sorted(reclassTextList, reverse = True)
 
-with open(config.WORK_FILES_DIR() + "Reclassify.txt", "w") as f:
-    for t in reclassList:
-        f.write(t[1])
+    with open(config.WORK_FILES_DIR() + "Reclassify.txt", "w") as f:
+        for t in reclassList:
+            f.write(t[1])
@@ -0,0 +1,195 @@
+# This module runs a resident classification service for new genomes. The
+# reference model (see reference_model.py) is loaded once, then genomes,
+# given by their PTT and FAA files, are classified on request over local
+# HTTP, without rebuilding anything.
+# Usage:
+#   classify_service.py serve [port <n>] - loads the references, and serves
+#       POST /classify with JSON {"ptt": <PTT file>, "faa": <FAA file>};
+#       "faa" is optional, by default the FAA file next to the PTT file.
+#       GET /status returns the number of references and the parameters
+#   classify_service.py query <PTT file> [<FAA file>] [port <n>] - sends a
+#       genome to the running service, and prints the result
+#   classify_service.py classify <PTT file> [<FAA file>] - loads the
+#       references, and classifies one genome without the service
+#   classify_service.py check [port <n>] - loads the references, starts the
+#       service, and checks that malformed requests get JSON errors
+
+import sys
+import time
+import json
+import threading
+import traceback
+import urllib2
+import BaseHTTPServer
+from reference_model import *
+
+ServiceHost = "127.0.0.1"
+ServicePort = 8765
+
+# ReferenceModel of the running service
+_model = None
+
+
+class ClassifyRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def sendJson(self, code, obj):
+        body = json.dumps(obj)
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path != "/status":
+            self.sendJson(404, {"error": "Unknown path %s" % self.path})
+            return
+        self.sendJson(200, {"references": len(_model.dirs),
+                            "params": _model.params})
+
+    def do_POST(self):
+        if self.path != "/classify":
+            self.sendJson(404, {"error": "Unknown path %s" % self.path})
+            return
+        startTime = time.time()
+        try:
+            request = json.loads(self.rfile.read(
+                int(self.headers.getheader("Content-Length", 0))))
+            if not isinstance(request, dict):
+                raise ValueError("Request is not a JSON object")
+            pttFileName = request["ptt"]
+            faaFileName = request.get("faa")
+            if not all(isinstance(x, basestring) for x in
+                       [pttFileName, faaFileName or ""]):
+                raise ValueError("File names are not strings")
+            cogSet = _model.readQueryCogs(pttFileName, faaFileName)
+        except (ValueError, KeyError, IOError, UtilError) as e:
+            # Malformed query, the same errors as in classifyBatch()
+            self.sendJson(400, {"error": str(e)})
+            return
+        except Exception as e:
+            traceback.print_exc()
+            self.sendJson(500, {"error": "%s: %s" % (type(e).__name__, e)})
+            return
+        try:
+            result = _model.classify(cogSet)
+            response = resultDict(result)
+            response["ptt"] = pttFileName
+            response["cogCount"] = len(cogSet)
+            response["text"] = queryText(pttFileName, result)
+            response["seconds"] = time.time() - startTime
+        except Exception as e:
+            traceback.print_exc()
+            self.sendJson(500, {"error": "%s: %s" % (type(e).__name__, e)})
+            return
+        self.sendJson(200, response)
+
+
+def serve(port):
+    global _model
+    _model = ReferenceModel()
+    server = BaseHTTPServer.HTTPServer((ServiceHost, port),
+                                       ClassifyRequestHandler)
+    print("Serving on %s:%d" % (ServiceHost, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+def query(pttFileName, faaFileName, port):
+    """
+    :return: result dictionary of the running service
+    """
+    request = {"ptt": os.path.abspath(pttFileName)}
+    if faaFileName:
+        request["faa"] = os.path.abspath(faaFileName)
+    try:
+        response = urllib2.urlopen(urllib2.Request(
+            "http://%s:%d/classify" % (ServiceHost, port),
+            json.dumps(request), {"Content-Type": "application/json"}))
+    except urllib2.HTTPError as e:
+        raise UtilError("Service error %d: %s" % (e.code, e.read()))
+    return json.loads(response.read())
+
+def postRaw(body, port):
+    """
+    :return: tuple (HTTP code, response dictionary) of POST /classify with
+        the given body
+    """
+    try:
+        response = urllib2.urlopen(urllib2.Request(
+            "http://%s:%d/classify" % (ServiceHost, port), body,
+            {"Content-Type": "application/json"}))
+        return (response.getcode(), json.loads(response.read()))
+    except urllib2.HTTPError as e:
+        return (e.code, json.loads(e.read()))
+
+def check(port):
+    """
+    Starts the service in a thread, and sends it malformed requests
+    :return: True if all of them got JSON errors with code 400
+    """
+    global _model
+    _model = ReferenceModel()
+    server = BaseHTTPServer.HTTPServer((ServiceHost, port),
+                                       ClassifyRequestHandler)
+    thread = threading.Thread(target = server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    badRequests = [
+        ("not JSON", "{ptt"),
+        ("not an object", json.dumps(["a.ptt"])),
+        ("no ptt", json.dumps({"faa": "a.faa"})),
+        ("ptt not a string", json.dumps({"ptt": 5})),
+        ("no such file", json.dumps({"ptt": "/nonexistent/a.ptt"})),
+        ("ptt is a directory", json.dumps({"ptt": os.getcwd()}))]
+    ok = True
+    for name, body in badRequests:
+        code, response = postRaw(body, port)
+        print("%s: %d %s" % (name, code, response.get("error")))
+        if (code != 400) or ("error" not in response):
+            ok = False
+    server.shutdown()
+    server.server_close()
+    return ok
+
+
+if __name__ == "__main__":
+
+    args = sys.argv[1:]
+    port = ServicePort
+    if "port" in args:
+        ind = args.index("port")
+        port = int(args[ind + 1])
+        del args[ind:ind + 2]
+
+    if (len(args) == 1) and (args[0] == "serve"):
+        serve(port)
+        sys.exit(0)
+
+    if (len(args) == 1) and (args[0] == "check"):
+        if not check(port):
+            print("FAILED")
+            sys.exit(1)
+        print("OK")
+        sys.exit(0)
+
+    if (len(args) in [2, 3]) and (args[0] in ["query", "classify"]):
+        pttFileName = args[1]
+        faaFileName = args[2] if len(args) == 3 else None
+        if args[0] == "query":
+            print(json.dumps(query(pttFileName, faaFileName, port),
+                             indent = 2))
+        else:
+            model = ReferenceModel()
+            startTime = time.time()
+            result = model.classifyFiles(pttFileName, faaFileName)
+            print(queryText(pttFileName, result))
+            print("Classified in %f seconds" % (time.time() - startTime))
+        sys.exit(0)
+
+    print("Usage: classify_service.py serve [port <n>] | query <PTT file> "
+          "[<FAA file>] [port <n>] | classify <PTT file> [<FAA file>] | "
+          "check [port <n>]")
+    sys.exit(1)
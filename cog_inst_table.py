@@ -0,0 +1,316 @@
+# This module defines columnar storage of CogInst's: one NumPy array per
+# attribute, with COG names, chromosomes and strands kept as integer codes
+# into string tables.
+# Files of a table in the directory <dir>:
+#   <dir>/<attribute>.npy - one array per attribute (see CogInstTable)
+#   <dir>/strings.json - string tables
+# Usage: cog_inst_table.py convert - converts COG_INST_LIST() and
+#   SAMPLE_COG_INST_LIST() JSON files into the tables
+
+import os
+import sys
+import numpy as np
+from filedefs import *
+from shared.pyutils.utils import *
+from genome_cls import ProkDna
+
+
+class CogInstView(object):
+    """
+    Lightweight read only counterpart of CogInst, for the code that needs
+    objects. Attributes are the same as in CogInst
+    """
+
+    __slots__ = ("_name", "chrom", "pttLine", "strand", "start", "_len",
+                 "faLine")
+
+    def __init__(self, _name, chrom, pttLine, strand, start, _len, faLine):
+        self._name = _name
+        self.chrom = chrom
+        self.pttLine = pttLine
+        self.strand = strand
+        self.start = start
+        self._len = _len
+        self.faLine = faLine
+
+    @property
+    def key(self):
+        return str(self.pttLine) + ":" + self.chrom
+
+    @property
+    def dir(self):
+        return ProkDna.getDirFromKey(self.chrom)
+
+    @property
+    def name(self):
+        return self._name
+
+    def getChrom(self):
+        return self.chrom
+
+    @property
+    def len(self):
+        return self._len
+
+
+class CogInstTable(object):
+    """
+    Columnar set of COG instances
+    Attributes:
+        cogNames - list of COG names
+        chromKeys - list of ProkDna keys
+        strands - list of strand strings
+        cogCode - int32 array, index into cogNames
+        chromCode - int32 array, index into chromKeys
+        strandCode - int8 array, index into strands
+        pttLine - int32 array, line in the PTT file
+        start - int64 array, starting position in the chromosome
+        len - int32 array, length in terms of proteins
+        faLine - int32 array, line number in the <COGNAME>.fa file
+    """
+
+    arrayNames_ = [("cogCode", np.int32), ("chromCode", np.int32),
+                   ("strandCode", np.int8), ("pttLine", np.int32),
+                   ("start", np.int64), ("len", np.int32),
+                   ("faLine", np.int32)]
+
+    def __init__(self, cogNames, chromKeys, strands, **arrays):
+        self.cogNames = cogNames
+        self.chromKeys = chromKeys
+        self.strands = strands
+        for name, dtype in CogInstTable.arrayNames_:
+            setattr(self, name, arrays[name])
+        self._dirNames = None
+        self._chromDirCode = None
+
+    def __len__(self):
+        return len(self.cogCode)
+
+    def getInst(self, ind):
+        return CogInstView(self.cogNames[self.cogCode[ind]],
+            self.chromKeys[self.chromCode[ind]], int(self.pttLine[ind]),
+            self.strands[self.strandCode[ind]], int(self.start[ind]),
+            int(self.len[ind]), int(self.faLine[ind]))
+
+    def __iter__(self):
+        for ind in xrange(len(self)):
+            yield self.getInst(ind)
+
+    def getDirNames(self):
+        """
+        :return: sorted list of genome dirs
+        """
+        self._buildDirs()
+        return self._dirNames
+
+    def getDirCode(self):
+        """
+        :return: int32 array of per instance indices into getDirNames()
+        """
+        self._buildDirs()
+        return self._chromDirCode[self.chromCode]
+
+    def _buildDirs(self):
+        if self._dirNames is not None:
+            return
+        chromDirs = [ProkDna.getDirFromKey(x) for x in self.chromKeys]
+        self._dirNames = sorted(set(chromDirs))
+        dirIndex = dict((d, i) for i, d in enumerate(self._dirNames))
+        self._chromDirCode = np.array([dirIndex[x] for x in chromDirs],
+                                      dtype=np.int32)
+
+    def getBatch(self, start, end, mask = None):
+        """
+        :param mask: optional boolean array of the instances [start, end)
+            to take
+        :return: CogInstTable with instances [start, end), sharing string
+            tables with this one. Arrays are views if mask is None
+        """
+        self._buildDirs()
+        arrays = {}
+        for name, _ in CogInstTable.arrayNames_:
+            arr = getattr(self, name)[start:end]
+            arrays[name] = arr if mask is None else np.asarray(arr)[mask]
+        batch = CogInstTable(self.cogNames, self.chromKeys, self.strands,
+                             **arrays)
+        batch._dirNames = self._dirNames
+        batch._chromDirCode = self._chromDirCode
+        return batch
+
+    def store(self, dirName):
+        if not os.path.isdir(dirName):
+            os.makedirs(dirName)
+        for name, dtype in CogInstTable.arrayNames_:
+            np.save(os.path.join(dirName, name + ".npy"),
+                    np.asarray(getattr(self, name), dtype=dtype))
+        UtilStore({"cogNames": self.cogNames, "chromKeys": self.chromKeys,
+                   "strands": self.strands},
+                  os.path.join(dirName, "strings.json"))
+
+    @staticmethod
+    def load(dirName, mmap = True):
+        """
+        :param mmap: if True, arrays are memory mapped, not read
+        """
+        strings = UtilLoad(os.path.join(dirName, "strings.json"))
+        arrays = {}
+        for name, dtype in CogInstTable.arrayNames_:
+            arrays[name] = np.load(os.path.join(dirName, name + ".npy"),
+                                   mmap_mode='r' if mmap else None)
+        return CogInstTable(strings["cogNames"], strings["chromKeys"],
+                            strings["strands"], **arrays)
+
+    def select(self, mask):
+        """
+        :param mask: boolean array, or array of indices, of the instances
+        :return: new CogInstTable, with unused strings dropped
+        """
+        arrays = dict((name, np.asarray(getattr(self, name))[mask])
+                      for name, _ in CogInstTable.arrayNames_)
+        strings = {}
+        for table, codeName in [("cogNames", "cogCode"),
+                                ("chromKeys", "chromCode"),
+                                ("strands", "strandCode")]:
+            used, codes = np.unique(arrays[codeName], return_inverse=True)
+            strings[table] = [getattr(self, table)[x] for x in used]
+            arrays[codeName] = codes.astype(arrays[codeName].dtype)
+        return CogInstTable(strings["cogNames"], strings["chromKeys"],
+                            strings["strands"], **arrays)
+
+    @staticmethod
+    def concat(tableList):
+        """
+        :return: new CogInstTable with instances of all the tables, in order
+        """
+        strings = {}
+        arrays = dict((name, []) for name, _ in CogInstTable.arrayNames_)
+        for table, codeName in [("cogNames", "cogCode"),
+                                ("chromKeys", "chromCode"),
+                                ("strands", "strandCode")]:
+            codeDict = {}
+            for t in tableList:
+                remap = np.array([codeDict.setdefault(x, len(codeDict))
+                                  for x in getattr(t, table)], dtype=np.int32)
+                arrays[codeName].append(remap[np.asarray(getattr(t,
+                    codeName))] if len(remap) else
+                    np.zeros(0, dtype=np.int32))
+            l = [None] * len(codeDict)
+            for val, code in codeDict.iteritems():
+                l[code] = val
+            strings[table] = l
+        for name, dtype in CogInstTable.arrayNames_:
+            if not arrays[name]:
+                arrays[name] = [np.asarray(getattr(t, name)) for t in
+                                tableList]
+            arrays[name] = np.concatenate(arrays[name]).astype(dtype)
+        return CogInstTable(strings["cogNames"], strings["chromKeys"],
+                            strings["strands"], **arrays)
+
+    def getStoreRecords(self, cogProteinStore):
+        """
+        :param cogProteinStore: CogProteinStore these instances are in
+        :return: int64 array of the store record of every instance
+        """
+        cogStart = np.array([cogProteinStore.getCogRecordRange(x)[0] for x
+                             in self.cogNames], dtype=np.int64)
+        return cogStart[np.asarray(self.cogCode)] + \
+            (np.asarray(self.faLine, dtype=np.int64) - 1) // 2
+
+    @staticmethod
+    def fromCogInstList(cogInstList):
+        builder = CogInstTableBuilder()
+        for cogInst in cogInstList:
+            builder.add(cogInst)
+        return builder.build()
+
+
+def iterCogInstBatches(dirName, batchSize = 1000000, cogNames = None,
+                       dirs = None):
+    """
+    Streams the COG instance table in batches. Arrays are memory mapped, so
+    memory use does not depend on the table size
+    :param dirName: directory of the table, e.g. COG_INST_TABLE()
+    :param cogNames: optional collection of COG names to take
+    :param dirs: optional collection of genome dirs to take
+    :return: generator of CogInstTable batches, sharing string tables
+    """
+    table = CogInstTable.load(dirName)
+    cogCodes = None
+    if cogNames is not None:
+        cogNames = set(cogNames)
+        cogCodes = [i for i, x in enumerate(table.cogNames) if x in cogNames]
+    chromCodes = None
+    if dirs is not None:
+        dirs = set(dirs)
+        chromCodes = [i for i, x in enumerate(table.chromKeys) if
+                      ProkDna.getDirFromKey(x) in dirs]
+    for start in xrange(0, len(table), batchSize):
+        end = min(start + batchSize, len(table))
+        mask = None
+        if cogCodes is not None:
+            mask = np.in1d(table.cogCode[start:end], cogCodes)
+        if chromCodes is not None:
+            chromMask = np.in1d(table.chromCode[start:end], chromCodes)
+            mask = chromMask if mask is None else (mask & chromMask)
+        yield table.getBatch(start, end, mask)
+
+def iterCogInsts(dirName, batchSize = 1000000, cogNames = None, dirs = None):
+    """
+    Streams the COG instance table as CogInstView's. Parameters are the
+    same as in iterCogInstBatches()
+    """
+    for batch in iterCogInstBatches(dirName, batchSize, cogNames, dirs):
+        for cogInst in batch:
+            yield cogInst
+
+
+class CogInstTableBuilder(object):
+    """
+    Accumulates CogInst's, and builds CogInstTable out of them
+    """
+
+    def __init__(self):
+        self.codeDicts = {"cogNames": {}, "chromKeys": {}, "strands": {}}
+        self.lists = dict((name, []) for name, _ in
+                          CogInstTable.arrayNames_)
+
+    def _code(self, table, val):
+        d = self.codeDicts[table]
+        return d.setdefault(val, len(d))
+
+    def add(self, cogInst):
+        self.lists["cogCode"].append(self._code("cogNames", cogInst.name))
+        self.lists["chromCode"].append(self._code("chromKeys",
+                                                  cogInst.chrom))
+        self.lists["strandCode"].append(self._code("strands",
+                                                   cogInst.strand))
+        self.lists["pttLine"].append(cogInst.pttLine)
+        self.lists["start"].append(cogInst.start)
+        self.lists["len"].append(cogInst.len)
+        self.lists["faLine"].append(cogInst.faLine)
+
+    def build(self):
+        strings = {}
+        for table, d in self.codeDicts.iteritems():
+            l = [None] * len(d)
+            for val, code in d.iteritems():
+                l[code] = val
+            strings[table] = l
+        arrays = dict((name, np.array(self.lists[name], dtype=dtype))
+                      for name, dtype in CogInstTable.arrayNames_)
+        return CogInstTable(strings["cogNames"], strings["chromKeys"],
+                            strings["strands"], **arrays)
+
+
+if __name__ == "__main__":
+
+    if (len(sys.argv) == 2) and (sys.argv[1] == "convert"):
+        for src, dst in [(COG_INST_LIST(), COG_INST_TABLE()),
+                         (SAMPLE_COG_INST_LIST(), SAMPLE_COG_INST_TABLE())]:
+            print("Converting %s..." % src)
+            table = CogInstTable.fromCogInstList(UtilLoad(src))
+            print("%d COG instances" % len(table))
+            table.store(dst)
+        sys.exit(0)
+
+    print("WRONG COMMAND LINE")
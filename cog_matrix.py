@@ -0,0 +1,168 @@
+# This module defines genome x COG presence matrix, built out of cogDict
+# (genome dir -> set of COG names, see create_cog_dict.py). Pairwise common
+# COG counts of all genomes come from one matrix product, and the distance
+# functions of common_cogs_method.py are calculated for all pairs at once.
+
+import multiprocessing
+import numpy as np
+import scipy.sparse
+from shared.pyutils.utils import *
+
+# CogMatrix of the weight stack workers, inherited through fork
+_workerCogMatrix = None
+
+# Byte -> number of bits set
+_popCountTable = np.array([bin(x).count("1") for x in range(256)],
+                          dtype=np.int32)
+
+
+class CogMatrix(object):
+    """
+    Genome x COG presence matrix
+    Attributes:
+        dirs - list of genome dirs, in the row order
+        cogNames - list of COG names, in the column order
+        dirIndex - dictionary genome dir -> row
+        cogIndex - dictionary COG name -> column
+        matrix - scipy.sparse CSR matrix, 1 if the genome has the COG
+        cogCounts - int array, number of COGs of every genome
+        cogFreq - int array, number of genomes with every COG
+    """
+
+    def __init__(self, cogDict, dirs = None, cogFreq = None):
+        """
+        :param cogDict: dictionary genome dir -> set of COG names
+        :param dirs: optional list of dirs, defines the row order (sorted
+            cogDict keys by default)
+        :param cogFreq: optional dictionary COG name -> frequency; if not
+            given, frequencies are counted over the rows
+        """
+        self.dirs = list(dirs) if dirs is not None else sorted(cogDict)
+        self.dirIndex = dict((d, i) for i, d in enumerate(self.dirs))
+        if cogFreq is not None:
+            self.cogNames = sorted(cogFreq)
+        else:
+            self.cogNames = sorted(set().union(*[cogDict[x] for x in
+                                                 self.dirs]))
+        self.cogIndex = dict((c, i) for i, c in enumerate(self.cogNames))
+
+        rowList = []
+        colList = []
+        for row, dir in enumerate(self.dirs):
+            cols = [self.cogIndex[x] for x in cogDict[dir]]
+            rowList.append(np.full(len(cols), row, dtype=np.int32))
+            colList.append(np.array(cols, dtype=np.int32))
+        rows = np.concatenate(rowList) if rowList else np.zeros(0, np.int32)
+        cols = np.concatenate(colList) if colList else np.zeros(0, np.int32)
+        self.matrix = scipy.sparse.csr_matrix(
+            (np.ones(len(rows), dtype=np.int8), (rows, cols)),
+            shape=(len(self.dirs), len(self.cogNames)))
+
+        self.cogCounts = np.asarray(self.matrix.sum(axis=1)).ravel()
+        if cogFreq is not None:
+            self.cogFreq = np.array([cogFreq[x] for x in self.cogNames])
+        else:
+            self.cogFreq = np.asarray(self.matrix.sum(axis=0)).ravel()
+        self._packed = None
+
+    def __len__(self):
+        return len(self.dirs)
+
+    def dense(self, dtype = np.float32, rows = None):
+        """
+        :param rows: optional slice or index array of rows
+        :return: dense presence matrix
+        """
+        m = self.matrix if rows is None else self.matrix[rows]
+        return m.toarray().astype(dtype)
+
+    def packed(self):
+        """
+        :return: bit packed dense matrix, uint8 array of N x ceil(C/8)
+        """
+        if self._packed is None:
+            self._packed = np.packbits(self.dense(np.uint8), axis=1)
+        return self._packed
+
+    def commonCount(self, dir1, dir2):
+        """
+        :return: number of common COGs of two genomes, from the bit packed
+            matrix
+        """
+        packed = self.packed()
+        return int(_popCountTable[packed[self.dirIndex[dir1]] &
+                                  packed[self.dirIndex[dir2]]].sum())
+
+    def commonCounts(self, rows = None):
+        """
+        :param rows: optional slice or index array of rows
+        :return: int array of common COG counts, rows x N
+        """
+        # float32 sums of 0/1 are exact as long as there are less than
+        # 2^24 COGs
+        a = self.dense(np.float32)
+        left = a if rows is None else a[rows]
+        return np.rint(np.dot(left, a.T)).astype(np.int32)
+
+    def commonCogsDistMatrix(self):
+        """
+        :return: N x N array of commonCogsDist() for all the pairs
+        """
+        c = self.commonCounts().astype(np.float64)
+        n = self.cogCounts.astype(np.float64) + 1.
+        return np.log(np.outer(n, n) / ((c + 1.) * (c + 1.)))
+
+    def commonCogsDistAdjMatrix(self):
+        """
+        :return: N x N array of commonCogsDistAdj() for all the pairs; the
+            total number of COGs is the number of columns
+        """
+        c = self.commonCounts().astype(np.float64)
+        na = self.cogCounts.astype(np.float64)[:, None]
+        nb = self.cogCounts.astype(np.float64)[None, :]
+        t = float(len(self.cogNames))
+        assert(t >= self.cogCounts.max())
+        denom = t + c - na - nb
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ec = np.where(denom != 0., (t * c - na * nb) / denom, -1.)
+        ec[ec < 0.] = 0.
+        ec += 1.
+        return np.log((na + 1.) * (nb + 1.) / (ec * ec))
+
+    def weightStack(self, expCogRegList, rows = None):
+        """
+        COG weights of the common COGs of all the pairs, for a list of COG
+        regularizations. Step k is the product
+        A * diag(1 / (cogFreq + expCogRegList[k])) * A.T of the presence
+        matrix A, i.e. cogSetWeight() of every intersection
+        :param rows: optional slice or index array of rows
+        :return: float64 array steps x rows x N
+        """
+        a = self.dense(np.float64)
+        left = a if rows is None else a[rows]
+        stack = np.empty((len(expCogRegList), left.shape[0], len(self.dirs)))
+        for k, expCogReg in enumerate(expCogRegList):
+            stack[k] = np.dot(left / (self.cogFreq + expCogReg), a.T)
+        return stack
+
+    def weightStackParallel(self, expCogRegList, workerCount):
+        """
+        Same as weightStack(), with row blocks calculated by a pool of
+        workers
+        """
+        global _workerCogMatrix
+        if workerCount <= 1:
+            return self.weightStack(expCogRegList)
+        _workerCogMatrix = self
+        bounds = np.linspace(0, len(self.dirs), workerCount + 1).astype(int)
+        pool = multiprocessing.Pool(workerCount)
+        blocks = pool.map(_weightStackBlock, [(expCogRegList, bounds[i],
+            bounds[i+1]) for i in range(workerCount)])
+        pool.close()
+        pool.join()
+        _workerCogMatrix = None
+        return np.concatenate(blocks, axis=1)
+
+def _weightStackBlock(args):
+    expCogRegList, start, end = args
+    return _workerCogMatrix.weightStack(expCogRegList, slice(start, end))
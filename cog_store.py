@@ -0,0 +1,293 @@
+# This module defines the packed store of COG proteins. It replaces the
+# per COG <COGNAME>.fa files: all proteins are kept in one data file, grouped
+# by COG, plus index files with the protein offsets.
+# Files of a store with the base name <base>:
+#   <base>.dat - concatenated proteins, grouped by COG name
+#   <base>_offset.npy - offset of every protein in the data file
+#   <base>_len.npy - length of every protein
+#   <base>_keys.npy - CogInst key of every record
+#   <base>_sortedkeys.npy - sorted CogInst keys
+#   <base>_keyrec.npy - record indices of the sorted CogInst keys
+#   <base>_cogs.json - COG names and their first record index
+# Proteins of a COG are kept in the order they were added, so record
+# (cogStart + i) corresponds to faLine (2 * i + 1) of the old <COGNAME>.fa
+
+import os
+import mmap
+import numpy as np
+from shared.pyutils.utils import *
+
+
+_storeSuffixes = [".dat", "_offset.npy", "_len.npy", "_keys.npy",
+                  "_sortedkeys.npy", "_keyrec.npy", "_cogs.json"]
+
+def _storeFileName(fileBase, suffix):
+    return fileBase + suffix
+
+def _writeIndex(fileBase, cogNames, cogStarts, offsets, lengths, keys):
+    np.save(_storeFileName(fileBase, "_offset.npy"),
+            np.asarray(offsets, dtype=np.int64))
+    np.save(_storeFileName(fileBase, "_len.npy"),
+            np.asarray(lengths, dtype=np.int32))
+    keys = np.asarray(keys, dtype=np.bytes_)
+    keyRec = np.argsort(keys, kind='mergesort')
+    np.save(_storeFileName(fileBase, "_keys.npy"), keys)
+    np.save(_storeFileName(fileBase, "_sortedkeys.npy"), keys[keyRec])
+    np.save(_storeFileName(fileBase, "_keyrec.npy"),
+            keyRec.astype(np.int64))
+    UtilStore({"names": list(cogNames),
+               "starts": [int(x) for x in cogStarts]},
+              _storeFileName(fileBase, "_cogs.json"))
+
+
+class CogProteinStoreWriter(object):
+    """
+    Writes COG proteins into a new store. Proteins are written in the order
+    they come, and regrouped by COG name in close()
+    Attributes:
+        fileBase - base name of the store files
+        fdata - temporary data file
+        offset - current offset in the temporary data file
+        cogCodeDict - COG name -> integer code
+        cogCodes, offsets, lengths, keys - per record data
+    """
+
+    def __init__(self, fileBase):
+        self.fileBase = fileBase
+        dirName = os.path.dirname(fileBase)
+        if dirName and not os.path.isdir(dirName):
+            os.makedirs(dirName)
+        self.fdata = open(_storeFileName(fileBase, ".tmp"), 'wb')
+        self.offset = 0
+        self.cogCodeDict = {}
+        self.cogCodes = []
+        self.offsets = []
+        self.lengths = []
+        self.keys = []
+
+    def add(self, cogName, key, protein):
+        self.fdata.write(protein)
+        self.cogCodes.append(self.cogCodeDict.setdefault(cogName,
+            len(self.cogCodeDict)))
+        self.offsets.append(self.offset)
+        self.lengths.append(len(protein))
+        self.keys.append(key)
+        self.offset += len(protein)
+
+    def close(self):
+        self.fdata.close()
+        tmpFileName = _storeFileName(self.fileBase, ".tmp")
+
+        # Sort records by COG name, keeping the order within a COG
+        cogNames = sorted(self.cogCodeDict.keys())
+        cogRank = np.empty(len(cogNames), dtype=np.int32)
+        for rank, name in enumerate(cogNames):
+            cogRank[self.cogCodeDict[name]] = rank
+        recRank = cogRank[np.asarray(self.cogCodes, dtype=np.int32)]
+        order = np.argsort(recRank, kind='mergesort')
+        cogStarts = np.searchsorted(recRank[order],
+                                    np.arange(len(cogNames)))
+        offsets = np.asarray(self.offsets, dtype=np.int64)[order]
+        lengths = np.asarray(self.lengths, dtype=np.int32)[order]
+        keys = np.asarray(self.keys, dtype=np.bytes_)[order]
+        del self.cogCodes, self.offsets, self.lengths, self.keys
+
+        newOffsets = np.zeros(len(order), dtype=np.int64)
+        with open(_storeFileName(self.fileBase, ".dat"), 'wb') as fout:
+            if self.offset:
+                with open(tmpFileName, 'rb') as fin:
+                    data = mmap.mmap(fin.fileno(), 0,
+                                     access=mmap.ACCESS_READ)
+                    pos = 0
+                    for i, (off, l) in enumerate(zip(offsets.tolist(),
+                                                     lengths.tolist())):
+                        fout.write(data[off:off+l])
+                        newOffsets[i] = pos
+                        pos += l
+                    data.close()
+        os.remove(tmpFileName)
+
+        _writeIndex(self.fileBase, cogNames, cogStarts, newOffsets, lengths,
+                    keys)
+
+
+class CogProteinStore(object):
+    """
+    Read only access to a COG protein store. Data and index files are memory
+    mapped, so opening a store does not read it, and several processes
+    share the pages
+    Attributes:
+        cogNames - sorted list of COG names
+        cogStartDict - COG name -> (first record, last record + 1)
+        offsets, lengths, keys - per record arrays
+        sortedKeys, keyRec - sorted CogInst keys, and their records
+        data - memory mapped data file
+    """
+
+    def __init__(self, fileBase):
+        self.fileBase = fileBase
+        cogs = UtilLoad(_storeFileName(fileBase, "_cogs.json"))
+        self.offsets = np.load(_storeFileName(fileBase, "_offset.npy"),
+                               mmap_mode='r')
+        self.lengths = np.load(_storeFileName(fileBase, "_len.npy"),
+                               mmap_mode='r')
+        self.keys = np.load(_storeFileName(fileBase, "_keys.npy"),
+                            mmap_mode='r')
+        self.sortedKeys = np.load(_storeFileName(fileBase,
+            "_sortedkeys.npy"), mmap_mode='r')
+        self.keyRec = np.load(_storeFileName(fileBase, "_keyrec.npy"),
+                              mmap_mode='r')
+        self.cogNames = cogs["names"]
+        ends = list(cogs["starts"][1:]) + [len(self.offsets)]
+        self.cogStartDict = dict(zip(cogs["names"],
+                                     zip(cogs["starts"], ends)))
+        with open(_storeFileName(fileBase, ".dat"), 'rb') as f:
+            if os.fstat(f.fileno()).st_size:
+                self.data = mmap.mmap(f.fileno(), 0,
+                                      access=mmap.ACCESS_READ)
+            else:
+                self.data = b""
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def close(self):
+        """
+        Unmaps the data and index files; the store can not be used after
+        that
+        """
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self.data = b""
+        self.offsets = self.lengths = self.keys = None
+        self.sortedKeys = self.keyRec = None
+
+    def getCogNames(self):
+        return self.cogNames
+
+    def getCogRecordRange(self, cogName):
+        return self.cogStartDict[cogName]
+
+    def getProtein(self, rec):
+        off = int(self.offsets[rec])
+        return self.data[off:off+int(self.lengths[rec])]
+
+    def getRecordByKey(self, key):
+        """
+        :param key: CogInst key
+        :return: record index, or None if key is not in the store
+        """
+        ind = np.searchsorted(self.sortedKeys, key)
+        if (ind < len(self.sortedKeys)) and (self.sortedKeys[ind] == key):
+            return int(self.keyRec[ind])
+        return None
+
+    def getProteinByKey(self, key):
+        rec = self.getRecordByKey(key)
+        if rec is None:
+            return None
+        return self.getProtein(rec)
+
+    def getProteinByFaLine(self, cogName, faLine):
+        start, end = self.cogStartDict[cogName]
+        rec = start + (faLine - 1) // 2
+        assert(rec < end)
+        return self.getProtein(rec)
+
+    def getCogBlock(self, cogName):
+        """
+        :return: all proteins of the COG, concatenated
+        """
+        start, end = self.cogStartDict[cogName]
+        if start == end:
+            return b""
+        return self.data[int(self.offsets[start]):
+            int(self.offsets[end-1] + self.lengths[end-1])]
+
+    def getCogProteins(self, cogName):
+        """
+        :return: list of proteins of the COG, in the faLine order
+        """
+        start, end = self.cogStartDict[cogName]
+        block = self.getCogBlock(cogName)
+        if start == end:
+            return []
+        offsets = np.asarray(self.offsets[start:end]) - self.offsets[start]
+        return [block[off:off+l] for off, l in
+                zip(offsets.tolist(), self.lengths[start:end].tolist())]
+
+    def getKeys(self, start, end):
+        """
+        :return: CogInst keys of records [start, end)
+        """
+        return self.keys[start:end].tolist()
+
+    def exportFasta(self, dirName):
+        """
+        Writes <COGNAME>.fa files of the old layout into the directory
+        """
+        for cogName in self.cogNames:
+            start, end = self.cogStartDict[cogName]
+            keys = self.getKeys(start, end)
+            proteins = self.getCogProteins(cogName)
+            with open(dirName + cogName + ".fa", 'w') as f:
+                for key, protein in zip(keys, proteins):
+                    f.write('>' + key + '\n' + protein + '\n')
+
+
+def mergeCogProteinStores(fileBaseList, outFileBase, recordMaskList = None):
+    """
+    Merges stores into a new one. Within every COG proteins of the first
+    store go first, then proteins of the second store, and so on.
+    :param recordMaskList: optional list of per store boolean arrays (or
+        None) of the records to keep
+    """
+    if recordMaskList is None:
+        recordMaskList = [None] * len(fileBaseList)
+    cogStarts = []
+    offsets = []
+    lengths = []
+    keys = []
+    pos = 0
+    storeList = []
+    try:
+        for fileBase in fileBaseList:
+            storeList.append(CogProteinStore(fileBase))
+        cogNames = sorted(set().union(*[x.getCogNames() for x in
+                                        storeList]))
+        with open(_storeFileName(outFileBase, ".dat"), 'wb') as fout:
+            for cogName in cogNames:
+                cogStarts.append(len(lengths))
+                for store, mask in zip(storeList, recordMaskList):
+                    if cogName not in store.cogStartDict:
+                        continue
+                    start, end = store.getCogRecordRange(cogName)
+                    if (mask is None) or mask[start:end].all():
+                        block = store.getCogBlock(cogName)
+                        cogLengths = store.lengths[start:end]
+                        cogKeys = store.getKeys(start, end)
+                    else:
+                        recs = np.nonzero(mask[start:end])[0] + start
+                        block = b"".join([store.getProtein(x) for x in
+                                          recs])
+                        cogLengths = store.lengths[recs]
+                        cogKeys = store.keys[recs].tolist()
+                    fout.write(block)
+                    offsets.extend((pos + np.cumsum(cogLengths,
+                        dtype=np.int64) - cogLengths).tolist())
+                    lengths.extend(cogLengths.tolist())
+                    keys.extend(cogKeys)
+                    pos += len(block)
+    finally:
+        for store in storeList:
+            store.close()
+    _writeIndex(outFileBase, cogNames, cogStarts, offsets, lengths, keys)
+
+def moveCogProteinStore(srcFileBase, dstFileBase):
+    for suffix in _storeSuffixes:
+        os.rename(_storeFileName(srcFileBase, suffix),
+                  _storeFileName(dstFileBase, suffix))
+
+def removeCogProteinStore(fileBase):
+    for suffix in _storeSuffixes:
+        os.remove(_storeFileName(fileBase, suffix))
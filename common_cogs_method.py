@@ -13,14 +13,20 @@ import math
 import sys
 import os.path
 import operator
+import hashlib
 from collections import defaultdict as DefDict
 from shared.pyutils.utils import *
 from shared.pyutils.distance_matrix import *
 from shared.algorithms.kendall import calculateWeightedKendall
-from scipy.optimize import anneal
+from cog_matrix import CogMatrix
+from sym_matrix import *
+from param_optimizer import ParamSearch, EvalCache
+from tiled_matrix import *
 
+# Default parameters, used until optimize stores COG_DIST_PARAMS()
 CogDistOptimalParams = \
     {"cogReg" : 5.44122751, "genReg" : -5.85405896, "mixReg" : 0.17919745}
+CogDistParamNames = ["cogReg", "genReg", "mixReg"]
 
 # Unit of quantization of COG weight regularization
 COG_REG_STEP = 0.5
@@ -78,6 +84,56 @@ def commonCogsDistAdj(dir1, dir2, cogDict, cogFreq):
     ec += 1.
     return math.log((na + 1) * (nb + 1) / (ec * ec))
 
+def buildCogFreq(cogDict):
+    """
+    :return: dictionary COG name -> number of genomes having it
+    """
+    cogFreq = DefDict(int)
+    for dir, cogs in cogDict.iteritems():
+        for cname in cogs:
+            cogFreq[cname] += 1
+    return cogFreq
+
+def commonCogsDistAll(cogDict, cogFreq, adjusted = False):
+    """
+    Calculates commonCogsDist (or commonCogsDistAdj if adjusted) for all the
+    pairs of genomes at once, out of the genome x COG presence matrix
+    :return: tuple (list of dirs, N x N numpy array of distances)
+    """
+    cogMatrix = CogMatrix(cogDict, cogFreq = cogFreq)
+    if adjusted:
+        return (cogMatrix.dirs, cogMatrix.commonCogsDistAdjMatrix())
+    return (cogMatrix.dirs, cogMatrix.commonCogsDistMatrix())
+
+def buildTaxDist(taxaDict, dirs, blockSize = 256):
+    """
+    Calculates Taxa.distance() for all the pairs of genomes, by blocks of
+    rows of encoded taxonomies
+    :return: int8 SymMatrix of taxonomy distances over dirs
+    """
+    codes = encodeTaxaTypes([taxaDict[x].type for x in dirs])
+    taxDist = SymMatrix(dirs, dtype=np.int8)
+    rowStarts = taxDist.rowStarts
+    for blockStart in range(0, len(dirs), blockSize):
+        blockEnd = min(blockStart + blockSize, len(dirs))
+        block = taxaTypeDistances(codes[blockStart:blockEnd],
+                                  codes[blockStart:])
+        for i in range(blockStart, blockEnd):
+            taxDist.data[rowStarts[i]:rowStarts[i+1]] = \
+                block[i - blockStart, i - blockStart:]
+    return taxDist
+
+def taxDistCounts(taxDist):
+    """
+    :return: int array N x (TaxaType.maxDistance()+1), counts of every
+        taxonomy distance of every genome, itself included
+    """
+    width = TaxaType.maxDistance() + 1
+    counts = np.empty((len(taxDist), width), dtype=np.int64)
+    for i in range(len(taxDist)):
+        counts[i] = np.bincount(taxDist.rowArray(i), minlength=width)
+    return counts
+
 MaxRegDist = 10
 ExpMaxRegDist = math.exp(MaxRegDist)
 def commonCogsDistReg(dir1, dir2, cogDict, cogWeightDict, expGenReg, mixReg):
@@ -100,10 +156,79 @@ def commonCogsDistReg(dir1, dir2, cogDict, cogWeightDict, expGenReg, mixReg):
     return math.log((ExpMaxRegDist + 1.0) * setWeight /
         (ExpMaxRegDist * commonSetWeight + setWeight))
 
+def commonCogsDistRegArray(commonWeights, weights1, weights2, lens1, lens2,
+    expGenReg, mixReg):
+    """
+    commonCogsDistReg() of arrays of pairs; arguments are broadcast
+    :param commonWeights: COG weights of the pairs, [dir1][dir2]
+    :param weights1, weights2: COG weights [dir1][dir1] and [dir2][dir2]
+    :param lens1, lens2: numbers of COGs of dir1 and dir2
+    :return: array of distances
+    """
+    # Ties in the COG counts take dir1 as the smaller set, the way
+    # list.index(min(...)) does in commonCogsDistReg()
+    dir1IsMin = lens1 <= lens2
+    minSetWeight = np.where(dir1IsMin, weights1, weights2) + expGenReg
+    maxSetWeight = np.where(dir1IsMin, weights2, weights1) + expGenReg
+    setWeight = minSetWeight + mixReg * maxSetWeight
+    commonSetWeight = commonWeights * (1. + mixReg)
+    return np.log((ExpMaxRegDist + 1.0) * setWeight /
+        (ExpMaxRegDist * commonSetWeight + setWeight))
+
+def equalCountPairs(lens):
+    """
+    :param lens: numbers of COGs of the genomes
+    :return: tuple (rows, cols) of int64 arrays, the pairs of genomes with
+        the same COG count, rows > cols
+    """
+    order = np.argsort(lens, kind='mergesort')
+    uniq, starts, counts = np.unique(np.asarray(lens)[order],
+                                     return_index=True, return_counts=True)
+    rowList = [np.zeros(0, dtype=np.int64)]
+    colList = [np.zeros(0, dtype=np.int64)]
+    for start, count in zip(starts[counts > 1], counts[counts > 1]):
+        members = order[start:start+count]
+        ii, jj = np.tril_indices(count, -1)
+        rowList.append(members[ii])
+        colList.append(members[jj])
+    return (np.concatenate(rowList).astype(np.int64),
+            np.concatenate(colList).astype(np.int64))
+
+def commonCogsDistRegMatrix(cogDict, cogWeightDict, expGenReg, mixReg):
+    """
+    Calculates commonCogsDistReg() for all the pairs at once
+    :param cogWeightDict: SymMatrix of COG weights
+    :return: SymMatrix of distances, element [dir1][dir2] is
+        commonCogsDistReg(dir1, dir2) for both orders: the condensed storage
+        has the pairs with dir1 going first in the dirs order, and the
+        pairs of genomes with equal COG counts, whose distance depends on
+        the order, have the other order in the lower triangle
+    """
+    dirs = cogWeightDict.dirs
+    rowStarts = cogWeightDict.rowStarts
+    weights = np.asarray(cogWeightDict.data)
+    lens = np.array([len(cogDict[x]) for x in dirs])
+    diagWeights = weights[rowStarts[:-1]]
+    cogDist = SymMatrix(dirs)
+    for i in range(len(dirs)):
+        start, end = rowStarts[i], rowStarts[i+1]
+        cogDist.data[start:end] = commonCogsDistRegArray(weights[start:end],
+            diagWeights[i], diagWeights[i:], lens[i], lens[i:], expGenReg,
+            mixReg)
+
+    rows, cols = equalCountPairs(lens)
+    pairWeights = weights[rowStarts[cols] + rows - cols]
+    cogDist.setLower(rows * len(dirs) + cols, commonCogsDistRegArray(
+        pairWeights, diagWeights[rows], diagWeights[cols], lens[rows],
+        lens[cols], expGenReg, mixReg))
+    return cogDist
 
-def buildCogTaxaDict(noWeights = False, showCogFreqHist = False,
-    interpolationRange = None):
 
+def loadCogTaxaDicts(showCogFreqHist = False):
+    """
+    :return: tuple (cogDict, cogFreq, taxaDict), dictionaries reduced to the
+        genomes present in both; cogFreq is counted over all the genomes
+    """
     print("reading taxa dictionary...")
     taxaDict = UtilLoad(PROK_TAXA_DICT())
     print("Read %d organisms" % len(taxaDict))
@@ -112,10 +237,7 @@ def buildCogTaxaDict(noWeights = False, showCogFreqHist = False,
     cogDict = UtilLoad(COG_DICT())
 
     print("Building COG frequncies...")
-    cogFreq = DefDict(int)
-    for dir, cogs in cogDict.iteritems():
-        for cname in cogs:
-            cogFreq[cname] += 1
+    cogFreq = buildCogFreq(cogDict)
 
     if showCogFreqHist:
         print("Sowing cogFreq histogram...")
@@ -130,39 +252,46 @@ def buildCogTaxaDict(noWeights = False, showCogFreqHist = False,
         if dir not in taxaDict:
             del cogDict[dir]
     print("Valid set contains %d organisms" % len(cogDict))
+    return (cogDict, cogFreq, taxaDict)
+
+
+def buildCogTaxaDict(noWeights = False, showCogFreqHist = False,
+    interpolationRange = None, workerCount = 1):
+
+    cogDict, cogFreq, taxaDict = loadCogTaxaDicts(showCogFreqHist)
 
     print("\nBuilding Taxonomy distances...")
-    taxDist = DefDict(dict)
-    for dir1, taxa1 in taxaDict.items():
-        for dir2, taxa2 in taxaDict.items():
-            d = taxa1.distance(taxa2)
-            taxDist[dir1][dir2] = d
+    dirs = sorted(cogDict)
+    taxDist = buildTaxDist(taxaDict, dirs)
 
     # Optimization
     if noWeights:
         return (cogDict, None, taxaDict, taxDist)
 
-    fname = COG_WEIGHTS_DICT_LIST()
-    if os.path.isfile(fname):
+    if not interpolationRange:
+        interpolationRange = range(0, COG_REG_STEP_COUNT+1)
+    cogWeightDictList = None
+    fileBase = COG_WEIGHTS_MATRIX()
+    if symMatrixExists(fileBase):
         print("Loading cogWeightDictList...")
-        cogWeightDictList = UtilLoad(fname, progrIndPeriod=100)
-    else:
+        cogWeightDictList = loadSymMatrixStack(fileBase)
+        present = [x for x in cogWeightDictList if x is not None]
+        if (present[0].dirs != dirs) or \
+            any(cogWeightDictList[i] is None for i in interpolationRange):
+            print("Stored COG weights do not match, rebuilding...")
+            cogWeightDictList = None
+    if cogWeightDictList is None:
         print("Building cogWeightsDict...")
-        cogWeightDictList = [DefDict(dict) for i \
-            in range(0, COG_REG_STEP_COUNT+1)]
-        if not interpolationRange:
-            interpolationRange = range(0, COG_REG_STEP_COUNT+1)
-        for i in interpolationRange:
-            expCogReg = math.exp(COG_REG_LOWER + float(i) * COG_REG_STEP)
-            print("\nexpCogReg %f" % expCogReg)
-            cogWeightDict = cogWeightDictList[i]
-            for ind, (dir1, cogs1) in enumerate(cogDict.iteritems(), start=1):
-                print("\r%d.%d. %s" % (i, ind, dir1)),
-                for dir2, cogs2 in cogDict.iteritems():
-                    cogWeightDict[dir1][dir2] = \
-                        cogSetWeight(cogs1 & cogs2, cogFreq, expCogReg)
-            print
-        UtilStore(cogWeightDictList, fname)
+        cogWeightDictList = [None] * (COG_REG_STEP_COUNT+1)
+        # Every step is one weighted product of the genome x COG matrix
+        cogMatrix = CogMatrix(cogDict, cogFreq = cogFreq)
+        weightStack = cogMatrix.weightStackParallel([CogRegExpSteps[i] for i
+            in interpolationRange], workerCount)
+        for i, weights in zip(interpolationRange, weightStack):
+            cogWeightDictList[i] = SymMatrix.fromDense(cogMatrix.dirs,
+                                                       weights)
+        del weightStack
+        storeSymMatrixStack(cogWeightDictList, fileBase)
 
     return (cogDict, cogWeightDictList, taxaDict, taxDist)
 
@@ -174,120 +303,290 @@ def calculateCogRegInt(cogReg):
         cogRegInt = COG_REG_STEP_COUNT-1
     return cogRegInt
 
+def cogRegInterpolation(cogReg):
+    """
+    :return: tuple (cogRegInt, fraction): COG weights at cogReg are the
+        weights of the step cogRegInt, plus fraction of the difference to
+        the next step
+    """
+    cogRegInt = calculateCogRegInt(cogReg)
+    fraction = (math.exp(cogReg) - CogRegExpSteps[cogRegInt]) / \
+        (CogRegExpSteps[cogRegInt+1] - CogRegExpSteps[cogRegInt])
+    return (cogRegInt, fraction)
+
 
 def buildCogDistances(cogDict, cogWeightDictList, cogReg, genReg, mixReg):
 
     expGenReg = math.exp(genReg)
 
-    cogRegInt = calculateCogRegInt(cogReg)
-
-    expCogReg = math.exp(cogReg)
-    fraction = (expCogReg - CogRegExpSteps[cogRegInt]) / \
-        (CogRegExpSteps[cogRegInt+1] - CogRegExpSteps[cogRegInt])
+    cogRegInt, fraction = cogRegInterpolation(cogReg)
     print("Building COG weights interpolation from %d fraction %f" %
           (cogRegInt, fraction))
     cogWeightDictLow = cogWeightDictList[cogRegInt]
     cogWeightDictUpper = cogWeightDictList[cogRegInt+1]
-    cogWeightDict = DefDict(dict)
-    for dir1, dd in cogWeightDictLow.iteritems():
-        for dir2, wl in dd.iteritems():
-            wu = cogWeightDictUpper[dir1][dir2]
-            cogWeightDict[dir1][dir2] = wl + (wu - wl) * fraction
-
-    print("\nBuilding COG distances...")
-    cogDist = DefDict(dict)
-    for ordinal, dir1 in enumerate(cogDict, start = 1):
-        print("\r%d. %s" % (ordinal, dir1)),
-        for dir2 in cogDict:
-            cogDist[dir1][dir2] = commonCogsDistReg(dir1, dir2, cogDict,
-                cogWeightDict, expGenReg, mixReg)
+    cogWeightDict = SymMatrix(cogWeightDictLow.dirs, cogWeightDictLow.data +
+        (cogWeightDictUpper.data - cogWeightDictLow.data) * fraction)
 
-    return cogDist
+    print("Building COG distances...")
+    return commonCogsDistRegMatrix(cogDict, cogWeightDict, expGenReg, mixReg)
+
+def buildCogDistancesTiled(cogDict, cogWeightsLow, cogWeightsUpper, cogReg,
+    genReg, mixReg, fileBase, memoryBudget):
+    """
+    Out of core buildCogDistances()
+    :param cogWeightsLow, cogWeightsUpper: TiledSymMatrix's of the COG
+        weights of the steps calculateCogRegInt(cogReg) and the next one
+    :return: TiledSymMatrix of distances, stored with the base fileBase;
+        element [dir1][dir2] is commonCogsDistReg(dir1, dir2) for both
+        orders, as in commonCogsDistRegMatrix()
+    """
+    expGenReg = math.exp(genReg)
+    cogRegInt, fraction = cogRegInterpolation(cogReg)
+    dirs = cogWeightsLow.dirs
+    lens = np.array([len(cogDict[x]) for x in dirs])
+    diagLow = cogWeightsLow.diagonal()
+    diagWeights = diagLow + (cogWeightsUpper.diagonal() - diagLow) * fraction
+
+    def tileFunc(i0, i1, j0, j1):
+        low = np.asarray(cogWeightsLow.data[i0:i1, j0:j1])
+        upper = np.asarray(cogWeightsUpper.data[i0:i1, j0:j1])
+        return commonCogsDistRegArray(low + (upper - low) * fraction,
+            diagWeights[i0:i1, None], diagWeights[None, j0:j1],
+            lens[i0:i1, None], lens[None, j0:j1], expGenReg, mixReg)[None]
+
+    computeTiled(fileBase, dirs, [0], np.float64, tileFunc, memoryBudget)
+
+    # Tiles are written with their mirror; pairs with equal COG counts get
+    # the other order in the lower triangle
+    rows, cols = equalCountPairs(lens)
+    low = np.asarray(cogWeightsLow.data[rows, cols])
+    upper = np.asarray(cogWeightsUpper.data[rows, cols])
+    return setTiledElements(fileBase, 0, rows, cols, commonCogsDistRegArray(
+        low + (upper - low) * fraction, diagWeights[rows], diagWeights[cols],
+        lens[rows], lens[cols], expGenReg, mixReg))
+
+def buildTiled(cogReg, genReg, mixReg, memoryBudget):
+    """
+    Calculates taxonomy distances, the two needed COG weight steps and COG
+    distances out of core, into TAX_DIST_TILED(), COG_WEIGHTS_TILED() and
+    COG_DIST_TILED(). Stored matrices over the same genomes are reused
+    :param memoryBudget: bytes of memory per tile
+    :return: tuple (taxDist, cogDist) TiledSymMatrix's
+    """
+    cogDict, cogFreq, taxaDict = loadCogTaxaDicts()
+    dirs = sorted(cogDict)
+
+    taxDist = None
+    if tiledMatrixExists(TAX_DIST_TILED()):
+        taxDist = loadTiledMatrix(TAX_DIST_TILED())
+    if (taxDist is None) or (taxDist.dirs != dirs):
+        print("Building Taxonomy distances...")
+        taxDist = tiledTaxDist(encodeTaxaTypes([taxaDict[x].type for x in
+            dirs]), dirs, TAX_DIST_TILED(), memoryBudget)
+
+    cogRegInt = calculateCogRegInt(cogReg)
+    steps = [cogRegInt, cogRegInt+1]
+    weights = None
+    if tiledMatrixExists(COG_WEIGHTS_TILED()):
+        storedSteps, weights = loadTiledMatrices(COG_WEIGHTS_TILED())
+        if (storedSteps != steps) or (weights[0].dirs != dirs):
+            weights = None
+    if weights is None:
+        print("Building COG weights...")
+        weights = tiledWeightStack(CogMatrix(cogDict, cogFreq = cogFreq),
+            [CogRegExpSteps[x] for x in steps], steps, COG_WEIGHTS_TILED(),
+            memoryBudget)
+
+    print("Building COG distances...")
+    cogDist = buildCogDistancesTiled(cogDict, weights[0], weights[1], cogReg,
+        genReg, mixReg, COG_DIST_TILED(), memoryBudget)
+    storeCogDistFormat("tiled")
+    return (taxDist, cogDist)
+
+def storeCogDistFormat(format):
+    """
+    Records which COG distances loadCogDist() reads
+    :param format: "matrix" or "tiled"
+    """
+    UtilStore({"format": format}, COG_DIST_FORMAT())
+
+def loadCogDist():
+    """
+    :return: COG distances in the format recorded in COG_DIST_FORMAT(),
+        COG_DIST_TILED() or COG_DIST_MATRIX(), memory mapped;
+        COG_DIST_MATRIX() if no format is recorded
+    """
+    format = "matrix"
+    if os.path.isfile(COG_DIST_FORMAT()):
+        format = UtilLoad(COG_DIST_FORMAT())["format"]
+    if format == "tiled":
+        return loadTiledMatrix(COG_DIST_TILED())
+    return loadSymMatrix(COG_DIST_MATRIX())
 
 def calculateCorrelation(cogDist, taxDist):
+    """
+    :return: tuple (mean, std) of per genome calculateWeightedKendall()
+        correlations
+    """
+    # Matrices over the same dirs are consumed row by row
+    sameDirs = (cogDist.dirs == taxDist.dirs)
     corrList = []
     for dir, cogDirDist in cogDist.iteritems():
         taxDirDist = taxDist[dir]
-        corrList.append(calculateWeightedKendall( \
-            [taxDirDist[x] for x in cogDirDist.keys()], cogDirDist.values()))
+        corrList.append(calculateWeightedKendall(taxDirDist.values()
+            if sameDirs else [taxDirDist[x] for x in cogDirDist.keys()],
+            cogDirDist.values()))
 
     mean = np.mean(corrList)
     std = np.std(corrList, ddof = 1.)
     print("Result: mean %f std %f" % (mean, std))
     return(mean, std)
 
-bestCorr = 0.909499
-bestParamVector = [ 5.44122751, -5.85405896,  0.17919745]
-def optimizingFunction(taxDist, cogDict, cogWeightDictList, lowerBounds,
-    upperBounds, paramVector):
-    global bestCorr, bestParamVector
+def cogDistOptimalParams():
+    """
+    :return: dictionary of COG distance parameters found by optimize, or
+        CogDistOptimalParams if it has not been run. Parameters stored
+        without the target were optimized for Kendall tau-b, and are ignored
+    """
+    if os.path.isfile(COG_DIST_PARAMS()):
+        params = UtilLoad(COG_DIST_PARAMS())
+        if params.get("target") == "weightedKendall":
+            return dict((x, params[x]) for x in CogDistParamNames)
+        print("%s was optimized for %s, not the weighted Kendall "
+              "correlation, using the default parameters" %
+              (COG_DIST_PARAMS(), params.get("target", "kendallTauB")))
+    return dict(CogDistOptimalParams)
+
+
+def dataFingerprint(cogDict, cogWeightDictList, taxDist):
+    """
+    :return: md5 hex digest of everything evaluateParams() results depend
+        on: genome dirs, their COG counts, COG weights and taxonomy distances
+    """
+    md5 = hashlib.md5()
+    md5.update(repr(taxDist.dirs).encode())
+    md5.update(np.array([len(cogDict[x]) for x in taxDist.dirs]).tobytes())
+    md5.update(np.ascontiguousarray(taxDist.data).tobytes())
+    for ind, cogWeightDict in enumerate(cogWeightDictList):
+        if cogWeightDict is None:
+            continue
+        md5.update(str(ind).encode())
+        data = cogWeightDict.data
+        for start in range(0, len(data), 1 << 22):
+            md5.update(np.ascontiguousarray(data[start:start+(1<<22)]).
+                       tobytes())
+    return md5.hexdigest()
+
+
+# Data of evaluateParams(), set by findOptimum() before the workers fork
+_evalArgs = None
+
+def evaluateParams(paramVector):
+    """
+    :param paramVector: list of cogReg, genReg, mixReg
+    :return: tuple (mean, std) of per genome correlations
+    """
+    cogDict, cogWeightDictList, taxDist = _evalArgs
     cogReg, genReg, mixReg = paramVector
-    print("Optimizing function cogReg=%f genReg=%f mixReg=%f" %
-        (cogReg, genReg, mixReg))
-    for ind, val in enumerate(paramVector):
-        if (val < lowerBounds[ind]) or (val > upperBounds[ind]):
-            print("Out of bounds index %d" % ind)
-            return 1000.
     cogDist = buildCogDistances(cogDict, cogWeightDictList,
         cogReg, genReg, mixReg)
-    corr, std = calculateCorrelation(cogDist, taxDist)
-    print("CORRELATION: %f STD: %f" % (corr, std))
-    if corr > bestCorr:
-        bestCorr = corr
-        bestParamVector = paramVector
-    print("BEST SO FAR: corr %f paramVector %s" % (bestCorr,
-        repr(bestParamVector)))
-    return 1. / (corr - 1.)
+    return calculateCorrelation(cogDist, taxDist)
 
 
-def findOptimum(cogDict, cogWeightDictList, taxDist):
+def findOptimum(cogDict, cogWeightDictList, taxDist, workerCount = 1,
+    populationSize = 32, cycleCount = 20, shrink = 0.2, lowerBounds = None,
+    upperBounds = None, restart = False):
     """
     Finds values of cogReg, genReg, mixReg achieving maximum
-    correlation between cogDist and taxDist
-    :return: None
+    correlation between cogDist and taxDist. The best values are stored in
+    COG_DIST_PARAMS() after every cycle. Evaluations are cached in
+    COG_DIST_EVAL_CACHE(), and the search is checkpointed into
+    COG_DIST_SEARCH_CHECKPOINT(), so an interrupted search resumes where it
+    stopped
+    :param restart: if True, the checkpoint is ignored
+    :return: ParamSearch
     """
-
-    lowerBounds = [COG_REG_LOWER, -7., 0.12]
-    upperBounds = [COG_REG_LOWER + COG_REG_STEP * COG_REG_STEP_COUNT, -1.0,
-        0.26]
-    cycleCount = 0
-
-    while True:
-        initParamVector = bestParamVector
-        for i in range(len(lowerBounds)):
-            lowerBounds[i] += (bestParamVector[i] - lowerBounds[i]) * 0.2
-            upperBounds[i] += (bestParamVector[i] - upperBounds[i]) * 0.2
-
-        cycleCount += 1
-        print "CYCLE ", cycleCount
-        print "initParamVector ", initParamVector
-        print "BOUNDS ", lowerBounds, upperBounds
-        func = UtilCaller(optimizingFunction, taxDist, cogDict,
-            cogWeightDictList, lowerBounds, upperBounds)
-        result = anneal(func, initParamVector, schedule='boltzmann',
-            full_output=True, maxiter=80, lower=lowerBounds,
-            upper=upperBounds, disp=True)
-        print result
+    global _evalArgs
+
+    if lowerBounds is None:
+        lowerBounds = [COG_REG_LOWER, -7., 0.12]
+    if upperBounds is None:
+        upperBounds = [COG_REG_LOWER + COG_REG_STEP * COG_REG_STEP_COUNT,
+            -1.0, 0.26]
+    # Recorded in the stored parameters, see cogDistOptimalParams()
+    target = "weightedKendall"
+    _evalArgs = (cogDict, cogWeightDictList, taxDist)
+
+    print("Calculating data fingerprint...")
+    fingerprint = target + ":" + dataFingerprint(cogDict, cogWeightDictList,
+                                                 taxDist)
+    params = cogDistOptimalParams()
+    search = ParamSearch(evaluateParams, lowerBounds, upperBounds,
+        [params[x] for x in CogDistParamNames], populationSize, shrink,
+        workerCount, cache = EvalCache(COG_DIST_EVAL_CACHE(), fingerprint))
+    if not restart:
+        search.resume(COG_DIST_SEARCH_CHECKPOINT(), fingerprint)
+
+    def storeBest(search):
+        search.storeCheckpoint(COG_DIST_SEARCH_CHECKPOINT(), fingerprint)
+        result = dict(zip(CogDistParamNames, search.bestParamVector))
+        result.update(corr = search.bestScore, std = search.bestStd,
+            cycle = search.cycle, target = target)
+        UtilStore(result, COG_DIST_PARAMS())
+
+    search.run(cycleCount, storeBest)
+    return search
 
 
 if __name__ == "__main__":
 
     """
     Takes the following command line options:
-    buildWeights - building COG weights dictionary
-    optimize - find optimal parameters for COG weights
+    buildWeights [<worker count>] - building COG weights dictionary
+    optimize [workers <count>] [population <size>] [cycles <count>]
+        [shrink <share>] [lower <cogReg>,<genReg>,<mixReg>]
+        [upper <cogReg>,<genReg>,<mixReg>] [restart yes] - find optimal
+        parameters for COG weights, stores them in COG_DIST_PARAMS(); resumes
+        an interrupted search unless restart is given
     store <cogReg> <genReg> <mixReg> - stores COG distance dictionary
     distCounts - buils taxonomy distance dictionaries
+    tiledStore <memory MB> [<cogReg> <genReg> <mixReg>] - calculates
+        taxonomy distances, COG weights and COG distances out of core, with
+        tiles fitting the memory; optimal parameters by default.
+        COG_DIST_FORMAT() records which of the COG distances, tiled or
+        store/optimalStore ones, were stored last; loadCogDist() reads those
+    convert - converts COG_WEIGHTS_DICT_LIST() and COG_DIST_DICT() JSON
+        files into COG_WEIGHTS_MATRIX() and COG_DIST_MATRIX()
+    commonDists - correlation of commonCogsDist and commonCogsDistAdj with
+        the taxonomy distances
     """
 
-    if (len(sys.argv) == 2) and (sys.argv[1] == "buildWeights"):
-        cogDict, cogWeightDictList, taxaDict, taxDist = buildCogTaxaDict()
+    if (len(sys.argv) in [2, 3]) and (sys.argv[1] == "buildWeights"):
+        workerCount = int(sys.argv[2]) if len(sys.argv) == 3 else 1
+        cogDict, cogWeightDictList, taxaDict, taxDist = \
+            buildCogTaxaDict(workerCount = workerCount)
         # Done
         sys.exit(0)
 
-    if (len(sys.argv) == 2) and (sys.argv[1] == "optimize"):
+    if (len(sys.argv) >= 2) and (len(sys.argv) % 2 == 0) and \
+        (sys.argv[1] == "optimize"):
+        options = dict(zip(sys.argv[2::2], sys.argv[3::2]))
+        kwargs = {}
+        for name, key, conv in [("workers", "workerCount", int),
+            ("population", "populationSize", int),
+            ("cycles", "cycleCount", int), ("shrink", "shrink", float),
+            ("lower", "lowerBounds", lambda x: [float(y) for y in
+                x.split(",")]),
+            ("upper", "upperBounds", lambda x: [float(y) for y in
+                x.split(",")]),
+            ("restart", "restart", lambda x: x == "yes")]:
+            if name in options:
+                kwargs[key] = conv(options.pop(name))
+        if options:
+            print("Unknown options %s" % ", ".join(options))
+            sys.exit(-1)
         cogDict, cogWeightDictList, taxaDict, taxDist = buildCogTaxaDict()
-        findOptimum(cogDict, cogWeightDictList, taxDist)
+        findOptimum(cogDict, cogWeightDictList, taxDist, **kwargs)
         sys.exit(0)
 
     if (len(sys.argv) == 5) and (sys.argv[1] == "store"):
@@ -300,31 +599,69 @@ if __name__ == "__main__":
         corr, std = calculateCorrelation(cogDist, taxDist)
         print("CORRELATION: %f STD: %f" % (corr, std))
         print("\nStoring COG distance dictionary...")
-        UtilStore(cogDist, COG_DIST_DICT())
+        storeSymMatrix(cogDist, COG_DIST_MATRIX())
+        storeCogDistFormat("matrix")
         sys.exit(0)
 
     if (len(sys.argv) == 2) and (sys.argv[1] == "optimalStore"):
-        cogReg = CogDistOptimalParams["cogReg"]
+        params = cogDistOptimalParams()
+        cogReg = params["cogReg"]
         cogRegInt = calculateCogRegInt(cogReg)
         cogDict, cogWeightDictList, taxaDict, taxDist = \
             buildCogTaxaDict(interpolationRange=range(cogRegInt, cogRegInt+2))
-        cogDist = buildCogDistances(cogDict, cogWeightDictList,
-            **CogDistOptimalParams)
+        cogDist = buildCogDistances(cogDict, cogWeightDictList, **params)
         corr, std = calculateCorrelation(cogDist, taxDist)
         print("CORRELATION: %f STD: %f" % (corr, std))
         print("\nStoring COG distance dictionary...")
-        UtilStore(cogDist, COG_DIST_DICT())
+        storeSymMatrix(cogDist, COG_DIST_MATRIX())
+        storeCogDistFormat("matrix")
+        sys.exit(0)
+
+    if (len(sys.argv) in [3, 6]) and (sys.argv[1] == "tiledStore"):
+        params = cogDistOptimalParams()
+        if len(sys.argv) == 6:
+            params = dict(zip(CogDistParamNames,
+                              [float(x) for x in sys.argv[3:6]]))
+        taxDist, cogDist = buildTiled(memoryBudget =
+            int(float(sys.argv[2]) * (1 << 20)), **params)
+        corr, std = calculateCorrelation(cogDist, taxDist)
+        print("CORRELATION: %f STD: %f" % (corr, std))
+        sys.exit(0)
+
+    if (len(sys.argv) == 2) and (sys.argv[1] == "convert"):
+        if os.path.isfile(COG_WEIGHTS_DICT_LIST()):
+            print("Converting %s..." % COG_WEIGHTS_DICT_LIST())
+            cogWeightDictList = UtilLoad(COG_WEIGHTS_DICT_LIST(),
+                progrIndPeriod=100)
+            dirs = sorted(next(x for x in cogWeightDictList if x))
+            storeSymMatrixStack([SymMatrix.fromDictOfDicts(dirs, x) if x
+                else None for x in cogWeightDictList], COG_WEIGHTS_MATRIX())
+            del cogWeightDictList
+        if os.path.isfile(COG_DIST_DICT()):
+            print("Converting %s..." % COG_DIST_DICT())
+            cogDist = UtilLoad(COG_DIST_DICT())
+            storeSymMatrix(SymMatrix.fromDictOfDicts(sorted(cogDist),
+                cogDist), COG_DIST_MATRIX())
+            storeCogDistFormat("matrix")
+        sys.exit(0)
+
+    if (len(sys.argv) == 2) and (sys.argv[1] == "commonDists"):
+        cogFreq = buildCogFreq(UtilLoad(COG_DICT()))
+        cogDict, _, taxaDict, taxDist = buildCogTaxaDict(noWeights = True)
+        for adjusted in [False, True]:
+            print("\nBuilding %s distances..." % ("commonCogsDistAdj" if
+                adjusted else "commonCogsDist"))
+            dirs, distMatrix = commonCogsDistAll(cogDict, cogFreq, adjusted)
+            calculateCorrelation(SymMatrix.fromDense(dirs, distMatrix),
+                                 taxDist)
         sys.exit(0)
 
     if (len(sys.argv) == 2) and (sys.argv[1] == "distCounts"):
         print("Building dict of taxonomy dist counts...")
         _, _, taxaDict, taxDist = \
             buildCogTaxaDict(noWeights = True)
-        genTaxDistCntDict = DefDict(lambda: [0] *
-            (TaxaType.maxDistance() + 1))
-        for dir, tdd in taxDist.items():
-            for d in tdd.values():
-                genTaxDistCntDict[dir][d] += 1
+        genTaxDistCntDict = dict(zip(taxDist.dirs,
+            taxDistCounts(taxDist).tolist()))
         UtilStore(genTaxDistCntDict, GENOME_TAX_DIST_CNT_DICT())
         ttTaxDistCntDict = {}
         for dir, l in genTaxDistCntDict.items():
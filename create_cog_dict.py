@@ -1,47 +1,56 @@
 from taxonomy import *
 import sys
 from shared.pyutils.distance_matrix import *
+from cog_inst_table import CogInstTable, iterCogInstBatches
 
 
 def createCogDict(cogLengthFilter):
 
-    cogLengthDict = DefDict(list)
+    print("reading COG instance table...")
+    table = CogInstTable.load(COG_INST_TABLE())
+    print("Read %d COG instances" % len(table))
+    cogCount = len(table.cogNames)
+    dirNames = table.getDirNames()
 
-    print("reading COG instance list...")
-    cogList = UtilLoad(COG_INST_LIST())
-    print("Read %d COG instances" % len(cogList))
-
-    print ("Building cogLengthDict...")
-    for cogInst in cogList:
-        cogLengthDict[cogInst.name].append(cogInst.len)
-    print("COGs read from file: %d" % len(cogLengthDict))
-
-    print ("Translating cogLengthDict...")
-    temp = cogLengthDict.keys()
-    for cogName in temp:
-        lengthList = cogLengthDict[cogName]
-        cogLengthDict[cogName] = (np.mean(lengthList), np.std(lengthList))
+    print ("Building COG length statistics...")
+    instCount = np.zeros(cogCount)
+    lenSum = np.zeros(cogCount)
+    for batch in iterCogInstBatches(COG_INST_TABLE()):
+        instCount += np.bincount(batch.cogCode, minlength=cogCount)
+        lenSum += np.bincount(batch.cogCode, weights=batch.len,
+                              minlength=cogCount)
+    lenMean = lenSum / instCount
+    devSum = np.zeros(cogCount)
+    for batch in iterCogInstBatches(COG_INST_TABLE()):
+        dev = batch.len - lenMean[batch.cogCode]
+        devSum += np.bincount(batch.cogCode, weights=dev * dev,
+                              minlength=cogCount)
+    lenStd = np.sqrt(devSum / instCount)
+    print("COGs read from file: %d" % cogCount)
 
     print ("Building cogDict...")
-    cogDict = DefDict(set)
+    # Genome x COG presence of the COG instances passing the length filter
+    present = np.zeros((len(dirNames), cogCount), dtype=bool)
     validCogInstances = 0
-    for cogInst in cogList:
-        name = cogInst.name
-        assert(name in cogLengthDict)
-        length = cogInst.len
-        lenMean, lenStd = cogLengthDict[name]
-        if (length < (lenMean - cogLengthFilter * lenStd)) or \
-                (length > (lenMean + cogLengthFilter * lenStd)):
-            continue
-        validCogInstances += 1
-        dir = cogInst.dir
-        cogDict[dir].add(name)
+    for batch in iterCogInstBatches(COG_INST_TABLE()):
+        instMean = lenMean[batch.cogCode]
+        instStd = lenStd[batch.cogCode]
+        valid = (batch.len >= instMean - cogLengthFilter * instStd) & \
+            (batch.len <= instMean + cogLengthFilter * instStd)
+        validCogInstances += int(np.count_nonzero(valid))
+        present[batch.getDirCode()[valid], batch.cogCode[valid]] = True
+    cogDict = DefDict(set)
+    for dirInd, cogInd in zip(*[x.tolist() for x in np.nonzero(present)]):
+        cogDict[dirNames[dirInd]].add(table.cogNames[cogInd])
     print("Got %d organisms with COGS" % len(cogDict))
     print("Read %d COG instances, selected %d out of them" %
-        (len(cogList), validCogInstances))
+        (len(table), validCogInstances))
 
     print("Storing cogDict...")
     UtilStore(cogDict, COG_DICT())
+    UtilStore({"cogNames": list(table.cogNames), "lenMean": lenMean.tolist(),
+               "lenStd": lenStd.tolist(), "cogLengthFilter": cogLengthFilter},
+              COG_LENGTH_STATS())
 
 if __name__ == "__main__":
 
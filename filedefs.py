@@ -26,18 +26,54 @@ def PROK_CLEAN_GENOME_DICT():
 def COG_INST_LIST():
     return config.WORK_FILES_DIR() + "cog_inst_list.json"
 
+# Base name of the packed COG protein store files (see cog_store.py)
+def COG_PROTEIN_STORE():
+    return config.WORK_FILES_DIR() + "cog_protein_store"
+
+# Directory for the per worker shards of the COG protein store
+def COG_SHARDS_DIR():
+    return config.WORK_FILES_DIR() + "cog_shards/"
+
+# Directory of the columnar CogInst table (see cog_inst_table.py)
+def COG_INST_TABLE():
+    return config.WORK_FILES_DIR() + "cog_inst_table/"
+
+# Directory of the columnar sample CogInst table
+def SAMPLE_COG_INST_TABLE():
+    return config.WORK_FILES_DIR() + "sample_cog_inst_table/"
+
+# ProkDna key -> signatures of its PTT and FAA files, PIDs of its bad
+# proteins and of its missing COG proteins, and the protein quality summary
+# of its FAA file, as of the last build_cogs.py run
+def COG_BUILD_MANIFEST():
+    return config.WORK_FILES_DIR() + "cog_build_manifest.json"
+
+# List of per FAA file protein quality summaries of the last build_cogs.py
+# run: protein and rejection counts, invalid residues, rejected examples
+def PROTEIN_QUALITY_SUMMARY():
+    return config.WORK_FILES_DIR() + "protein_quality_summary.json"
+
 # Genome dir -> set of COG names
 def COG_DICT():
     return config.WORK_FILES_DIR() + "cog_dict.json"
 
+# COG length statistics and the length filter COG_DICT() was built with:
+# COG names, mean and standard deviation of the instance lengths
+def COG_LENGTH_STATS():
+    return config.WORK_FILES_DIR() + "cog_length_stats.json"
+
 # Dump of sample CogInst list
 def SAMPLE_COG_INST_LIST():
     return config.WORK_FILES_DIR() + "sample_cog_inst_list.json"
 
-# dir1, dir2 -> COG distance
+# dir1, dir2 -> COG distance, old JSON format (see COG_DIST_MATRIX)
 def COG_DIST_DICT():
     return config.WORK_FILES_DIR() + "cog_dist_dict.json"
 
+# Base name of SymMatrix of COG distances (see sym_matrix.py)
+def COG_DIST_MATRIX():
+    return config.WORK_FILES_DIR() + "cog_dist_matrix"
+
 # Dump of Cog list
 def COG_LIST():
     return config.WORK_FILES_DIR() + "cog_list.json"
@@ -72,9 +108,44 @@ def GENOME_TAX_DIST_CNT_DICT():
 def TAXTYPE_TAX_DIST_CNT_DICT():
     return config.WORK_FILES_DIR() + "taxtype_tax_dist_cnt_dict.json"
 
+# Base names of the out of core (tiled) taxonomy distances, COG weights and
+# COG distances (see tiled_matrix.py)
+def TAX_DIST_TILED():
+    return config.WORK_FILES_DIR() + "tax_dist_tiled"
+
+def COG_WEIGHTS_TILED():
+    return config.WORK_FILES_DIR() + "cog_weights_tiled"
+
+def COG_DIST_TILED():
+    return config.WORK_FILES_DIR() + "cog_dist_tiled"
+
+# Format of the COG distances stored last, "matrix" (COG_DIST_MATRIX) or
+# "tiled" (COG_DIST_TILED)
+def COG_DIST_FORMAT():
+    return config.WORK_FILES_DIR() + "cog_dist_format.json"
+
+# Best COG distance parameters (cogReg, genReg, mixReg) found by
+# common_cogs_method.py optimize, with their correlation
+def COG_DIST_PARAMS():
+    return config.WORK_FILES_DIR() + "cog_dist_params.json"
+
+# Cache of the COG distance parameter evaluations, one JSON line each
+def COG_DIST_EVAL_CACHE():
+    return config.WORK_FILES_DIR() + "cog_dist_eval_cache.jsonl"
+
+# Checkpoint of the COG distance parameter search
+def COG_DIST_SEARCH_CHECKPOINT():
+    return config.WORK_FILES_DIR() + "cog_dist_search_checkpoint.json"
+
+# List of dir1, dir2 -> COG weights, old JSON format (see COG_WEIGHTS_MATRIX)
 def COG_WEIGHTS_DICT_LIST():
     return config.WORK_FILES_DIR() + "cog_weights_dict_list.json"
 
+# Base name of the stack of COG weight SymMatrix's, one per COG
+# regularization step (see sym_matrix.py)
+def COG_WEIGHTS_MATRIX():
+    return config.WORK_FILES_DIR() + "cog_weights_matrix"
+
 # List of UtilObject's for reclassified genomes with old neighbors
 # in the taxonomy classification
 def RECLASSIFIED_DIR_LIST():
@@ -83,3 +154,7 @@ def RECLASSIFIED_DIR_LIST():
 # List of 16S rRNAs for each prokaryote organism
 #def FASTA_FILE_16S():
     #return config.WORK_FILES_DIR() + "16s_rrna.fa"
+
+# State of pipeline.py: per stage input hashes and wall times of the last run
+def PIPELINE_STATE():
+    return config.WORK_FILES_DIR() + "pipeline_state.json"
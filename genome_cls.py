@@ -262,7 +262,9 @@ class CogInst(UtilObject):
         start - strating position in the chromosome
         _len - length, in terms of proteins
         faLine - chain of aminiacids in the protein, as a line number in
-            the <COGNAME>.fa file in the work files directory
+            the <COGNAME>.fa file in the work files directory; the same
+            protein is record (faLine - 1) / 2 of this COG in the COG
+            protein store (see cog_store.py)
     """
 
     def __init__(self, **kwargs):
@@ -333,6 +335,17 @@ class Cog(UtilObject):
         del self.tempDict
         return dirNames
 
+    def setStats(self, instCount, genCount, meanInstPerGen, stdInstPerGen):
+        """
+        Sets statistics calculated elsewhere, instead of addCogInst() and
+        calculate()
+        """
+        self.instCount = instCount
+        self.genCount = genCount
+        self.meanInstPerGen = meanInstPerGen
+        self.stdInstPerGen = stdInstPerGen
+        del self.tempDict
+
     def getGenCount(self):
         return self.genCount
 
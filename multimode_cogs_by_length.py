@@ -10,6 +10,7 @@ from sklearn import mixture
 from scipy import stats
 import matplotlib.pyplot as plt
 from shared.pyutils.utils import *
+from cog_inst_table import iterCogInsts
 
 def modeCount(input, thresholdMax, thresholdValley, minPoints):
     """
@@ -64,11 +65,8 @@ def clusterizeOneDimension(input, clusterCount, thresh):
 if __name__ == "__main__":
 
     print("reading COG instance set...")
-    cogInstList = UtilLoad(SAMPLE_COG_INST_LIST())
-    print("Read %d COG instances" % len(cogInstList))
-
     cogLenDict = {}
-    for cogInst in cogInstList:
+    for cogInst in iterCogInsts(SAMPLE_COG_INST_TABLE()):
         l = cogLenDict.get(cogInst.name, [])
         l.append(cogInst.len)
         cogLenDict[cogInst.name] = l
@@ -0,0 +1,223 @@
+# This module defines a parallel population based search for the maximum of
+# a function over a box of parameter vectors. Every cycle the box shrinks
+# towards the best point found so far, then a population of random points in
+# the box (plus the best point itself) is evaluated by a pool of worker
+# processes. Workers are forked, so large read only data the evaluation
+# function uses (e.g. memory mapped matrices) is shared, not copied.
+# Evaluations can be cached on disk (EvalCache), and the search state can
+# be checkpointed after every cycle and resumed.
+
+import os
+import json
+import multiprocessing
+import numpy as np
+from shared.pyutils.utils import *
+
+
+class EvalCache(object):
+    """
+    On disk cache of evaluations, one JSON line per evaluated point.
+    Points are quantized, and only the lines with the same fingerprint of
+    the input data are used
+    Attributes:
+        fileName - cache file
+        fingerprint - fingerprint of the input data
+        quantum - quantization step of the parameters
+        resultDict - quantized parameter tuple -> result
+    """
+
+    def __init__(self, fileName, fingerprint, quantum = 1e-6):
+        self.fileName = fileName
+        self.fingerprint = fingerprint
+        self.quantum = quantum
+        self.resultDict = {}
+        if os.path.isfile(fileName):
+            with open(fileName, 'r') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Line cut by an interruption
+                        continue
+                    if (entry["fingerprint"] == fingerprint) and \
+                        (entry["quantum"] == quantum):
+                        self.resultDict[tuple(entry["key"])] = \
+                            tuple(entry["result"])
+        print("Evaluation cache: %d points" % len(self.resultDict))
+
+    def __len__(self):
+        return len(self.resultDict)
+
+    def key(self, paramVector):
+        return tuple(int(round(x / self.quantum)) for x in paramVector)
+
+    def get(self, paramVector):
+        """
+        :return: cached result, or None
+        """
+        return self.resultDict.get(self.key(paramVector))
+
+    def add(self, paramVector, result):
+        key = self.key(paramVector)
+        self.resultDict[key] = tuple(result)
+        with open(self.fileName, 'a') as f:
+            f.write(json.dumps({"fingerprint": self.fingerprint,
+                "quantum": self.quantum, "key": list(key),
+                "params": list(paramVector), "result": list(result)}) + "\n")
+
+
+class ParamSearch(object):
+    """
+    State of the search
+    Attributes:
+        evaluate - function paramVector -> (score, std), picklable (module
+            level), larger score is better
+        lowerBounds, upperBounds - current search box
+        populationSize - number of points evaluated per cycle
+        shrink - share of the distance to the best point the box bounds move
+            by at the start of every cycle
+        workerCount - number of worker processes
+        bestScore, bestStd, bestParamVector - best point found so far
+        cycle - number of cycles done
+        random - np.random.RandomState of the search
+        cache - optional EvalCache
+    """
+
+    def __init__(self, evaluate, lowerBounds, upperBounds,
+                 initParamVector, populationSize = 32, shrink = 0.2,
+                 workerCount = 1, seed = None, cache = None):
+        self.evaluate = evaluate
+        self.lowerBounds = [float(x) for x in lowerBounds]
+        self.upperBounds = [float(x) for x in upperBounds]
+        self.populationSize = populationSize
+        self.shrink = shrink
+        self.workerCount = workerCount
+        self.bestScore = None
+        self.bestStd = None
+        self.bestParamVector = [float(x) for x in initParamVector]
+        self.cycle = 0
+        self.random = np.random.RandomState(seed)
+        self.cache = cache
+
+    def shrinkBounds(self):
+        for i, best in enumerate(self.bestParamVector):
+            self.lowerBounds[i] += (best - self.lowerBounds[i]) * self.shrink
+            self.upperBounds[i] += (best - self.upperBounds[i]) * self.shrink
+
+    def population(self):
+        """
+        :return: list of parameter vectors of the next cycle, the best point
+            goes first
+        """
+        lower = np.array(self.lowerBounds)
+        upper = np.array(self.upperBounds)
+        points = lower + self.random.random_sample(
+            (self.populationSize - 1, len(lower))) * (upper - lower)
+        return [list(self.bestParamVector)] + points.tolist()
+
+    def evaluatePopulation(self, pool, paramVectorList):
+        """
+        :return: list of (score, std) of the parameter vectors; points
+            found in the cache are not evaluated
+        """
+        if self.cache is None:
+            todo = paramVectorList
+        else:
+            todoDict = {}
+            for x in paramVectorList:
+                if self.cache.get(x) is None:
+                    todoDict.setdefault(self.cache.key(x), x)
+            todo = todoDict.values()
+            print("%d points cached, %d to evaluate" % (len(paramVectorList)
+                - len(todo), len(todo)))
+        if pool is None:
+            results = [self.evaluate(x) for x in todo]
+        else:
+            results = pool.map(self.evaluate, todo, chunksize = 1)
+        if self.cache is None:
+            return results
+        for x, result in zip(todo, results):
+            self.cache.add(x, result)
+        return [self.cache.get(x) for x in paramVectorList]
+
+    def runCycle(self, pool):
+        self.shrinkBounds()
+        self.cycle += 1
+        print("CYCLE %d BOUNDS %s %s" % (self.cycle, repr(self.lowerBounds),
+            repr(self.upperBounds)))
+        paramVectorList = self.population()
+        for paramVector, (score, std) in zip(paramVectorList,
+                self.evaluatePopulation(pool, paramVectorList)):
+            print("%s: correlation %f std %f" % (repr(paramVector), score,
+                                                 std))
+            if (self.bestScore is None) or (score > self.bestScore):
+                self.bestScore = score
+                self.bestStd = std
+                self.bestParamVector = paramVector
+        print("BEST SO FAR: corr %f paramVector %s" % (self.bestScore,
+            repr(self.bestParamVector)))
+
+    def getState(self):
+        """
+        :return: JSON serializable state of the search
+        """
+        name, keys, pos, hasGauss, cachedGauss = self.random.get_state()
+        return {"lowerBounds": self.lowerBounds,
+                "upperBounds": self.upperBounds,
+                "bestScore": self.bestScore, "bestStd": self.bestStd,
+                "bestParamVector": self.bestParamVector, "cycle": self.cycle,
+                "random": [name, keys.tolist(), pos, hasGauss, cachedGauss]}
+
+    def setState(self, state):
+        for name in ["lowerBounds", "upperBounds", "bestScore", "bestStd",
+                     "bestParamVector", "cycle"]:
+            setattr(self, name, state[name])
+        name, keys, pos, hasGauss, cachedGauss = state["random"]
+        self.random.set_state((str(name), np.array(keys, dtype=np.uint32),
+                               pos, hasGauss, cachedGauss))
+
+    def storeCheckpoint(self, fileName, fingerprint):
+        """
+        Stores the state atomically: a crash leaves either the old or the new
+        checkpoint
+        """
+        tmpFileName = fileName + ".tmp"
+        UtilStore({"fingerprint": fingerprint, "state": self.getState()},
+                  tmpFileName)
+        os.rename(tmpFileName, fileName)
+
+    def resume(self, fileName, fingerprint):
+        """
+        Restores the state from the checkpoint, if it exists and was made
+        for the same input data
+        :return: True if resumed
+        """
+        if not os.path.isfile(fileName):
+            return False
+        checkpoint = UtilLoad(fileName)
+        if checkpoint["fingerprint"] != fingerprint:
+            print("Checkpoint is for different data, starting anew")
+            return False
+        self.setState(checkpoint["state"])
+        print("Resumed after cycle %d, best corr %s paramVector %s" %
+            (self.cycle, repr(self.bestScore), repr(self.bestParamVector)))
+        return True
+
+    def run(self, cycleCount, onCycle = None):
+        """
+        :param cycleCount: total number of cycles, cycles done before a
+            resume included
+        :param onCycle: optional function ParamSearch -> None, called after
+            every cycle
+        """
+        pool = multiprocessing.Pool(self.workerCount) \
+            if self.workerCount > 1 else None
+        try:
+            while self.cycle < cycleCount:
+                self.runCycle(pool)
+                if onCycle:
+                    onCycle(self)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
@@ -0,0 +1,228 @@
+# This module runs the whole workflow: build_prok_dict -> build_clean_prok_dict
+# -> build_cogs -> create_cog_dict -> common_cogs_method -> classify_genome.
+# Every stage is described by its command, input and output files. A stage
+# is skipped if all its outputs exist, and either they are newer than all
+# its inputs, or the inputs have the same content hashes as when the stage
+# was run last time. Stages reading the genome tree (config.PROKARYOTS_DIR())
+# always run: the tree is too big to hash, and build_cogs.py incremental
+# finds the new and changed genomes itself. Their outputs are then checked
+# by the content hashes of the next stages. Stages whose inputs are ready run
+# concurrently.
+# Usage: pipeline.py [<stage> ...] [jobs <count>] [force]
+# <stage> - run only these stages, and the stages they depend on
+# jobs - how many stages may run at the same time (default 2)
+# force - run the stages even if they are up to date
+
+import os
+import sys
+import time
+import hashlib
+import subprocess
+from filedefs import *
+from shared.pyutils.utils import *
+
+
+class Stage(object):
+    """
+    One step of the workflow
+    Attributes:
+        name - name of the stage
+        args - script and its command line arguments
+        inputs - list of input files (or directories)
+        outputs - list of output files (or directories)
+        cleanOutputs - remove outputs before running, for the scripts that
+            do not rebuild existing outputs
+        alwaysRun - run even if up to date, for the stages reading the
+            genome tree, which is not among the inputs
+    """
+
+    def __init__(self, name, args, inputs, outputs, cleanOutputs = False,
+                 alwaysRun = False):
+        self.name = name
+        self.args = args
+        self.inputs = inputs
+        self.outputs = outputs
+        self.cleanOutputs = cleanOutputs
+        self.alwaysRun = alwaysRun
+
+
+def pipelineStages():
+    return [
+        Stage("prok_dict", ["build_prok_dict.py"],
+              [PROKARYOT_DIRS_FILE()],
+              [PROK_GENOME_DICT(), PROK_DNA_DICT()], alwaysRun = True),
+        Stage("clean_prok_dict", ["build_clean_prok_dict.py"],
+              [PROK_GENOME_DICT(), config.MANUAL_TAXA_MATCH(),
+               config.TAXONOMY_DIR()],
+              [PROK_CLEAN_GENOME_DICT(), TAXONOMY_FILE(), PROK_TAXA_DICT(),
+               NAME_DIR_DICT()]),
+        Stage("cogs", ["build_cogs.py", "incremental"],
+              [PROK_CLEAN_GENOME_DICT(), PROK_TAXA_DICT()],
+              [COG_INST_TABLE(), COG_PROTEIN_STORE() + ".dat", COG_LIST(),
+               GENOME_COG_CNT_LIST()], alwaysRun = True),
+        Stage("cog_dict", ["create_cog_dict.py"],
+              [COG_INST_TABLE()],
+              [COG_DICT(), COG_LENGTH_STATS()]),
+        Stage("cog_weights", ["common_cogs_method.py", "buildWeights"],
+              [PROK_TAXA_DICT(), COG_DICT()],
+              [COG_WEIGHTS_MATRIX() + ".npy"], cleanOutputs = True),
+        Stage("tax_dist_counts", ["common_cogs_method.py", "distCounts"],
+              [PROK_TAXA_DICT(), COG_DICT()],
+              [GENOME_TAX_DIST_CNT_DICT(), TAXTYPE_TAX_DIST_CNT_DICT()]),
+        Stage("cog_dist", ["common_cogs_method.py", "optimalStore"],
+              [PROK_TAXA_DICT(), COG_DICT(), COG_WEIGHTS_MATRIX() + ".npy"],
+              [COG_DIST_MATRIX() + ".npy", COG_DIST_FORMAT()]),
+        Stage("classify", ["classify_genome.py"],
+              [PROK_TAXA_DICT(), COG_DICT(), COG_DIST_MATRIX() + ".npy",
+               COG_DIST_FORMAT()],
+              [RECLASSIFIED_DIR_LIST()]),
+    ]
+
+# List of all files under a file or a directory name
+def _fileList(name):
+    if not os.path.isdir(name):
+        return [name]
+    fileList = []
+    for root, dirs, files in os.walk(name):
+        fileList += [os.path.join(root, x) for x in files]
+    return sorted(fileList)
+
+def contentHash(name):
+    md5 = hashlib.md5()
+    for fileName in _fileList(name):
+        md5.update(os.path.relpath(fileName, name))
+        with open(fileName, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), ""):
+                md5.update(block)
+    return md5.hexdigest()
+
+def _mtimes(name):
+    return [os.path.getmtime(x) for x in _fileList(name)]
+
+def isUpToDate(stage, stageState):
+    """
+    :param stageState: dictionary stored after the last run of the stage
+    :return: tuple (bool, dictionary input -> content hash or None)
+    """
+    if not all(os.path.exists(x) for x in stage.outputs + stage.inputs):
+        return (False, None)
+    outMtime = min(sum([_mtimes(x) for x in stage.outputs], []) or [0.])
+    inMtime = max(sum([_mtimes(x) for x in stage.inputs], []) or [0.])
+    if outMtime >= inMtime:
+        return (True, None)
+    inputHashes = dict((x, contentHash(x)) for x in stage.inputs)
+    if stageState and (stageState.get("inputHashes") == inputHashes):
+        return (True, inputHashes)
+    return (False, inputHashes)
+
+def removeOutputs(stage):
+    for name in stage.outputs:
+        for fileName in _fileList(name):
+            if os.path.exists(fileName):
+                os.remove(fileName)
+
+def selectStages(stages, names):
+    """
+    :return: list of the stages with the given names, and all stages they
+        depend on, in the original order
+    """
+    producerDict = dict((out, s) for s in stages for out in s.outputs)
+    selected = set()
+    todo = [s for s in stages if s.name in names]
+    while todo:
+        stage = todo.pop()
+        if stage.name in selected:
+            continue
+        selected.add(stage.name)
+        todo += [producerDict[x] for x in stage.inputs if x in producerDict]
+    return [s for s in stages if s.name in selected]
+
+def runPipeline(stages, jobCount, force):
+    state = UtilLoad(PIPELINE_STATE()) if os.path.isfile(PIPELINE_STATE()) \
+        else {}
+    producerDict = dict((out, s.name) for s in stages for out in s.outputs)
+    depDict = dict((s.name, set(producerDict[x] for x in s.inputs if
+        x in producerDict)) for s in stages)
+    scriptDir = os.path.dirname(os.path.abspath(__file__))
+
+    pending = list(stages)
+    running = {}
+    done = set()
+    failed = set()
+    wallTimeDict = {}
+    while pending or running:
+        # Start the stages whose dependencies are done
+        for stage in list(pending):
+            deps = depDict[stage.name]
+            if deps & failed:
+                print("%s: not run, dependency failed" % stage.name)
+                failed.add(stage.name)
+                pending.remove(stage)
+                continue
+            if not deps <= done:
+                continue
+            if len(running) >= jobCount:
+                break
+            pending.remove(stage)
+            upToDate, inputHashes = isUpToDate(stage, state.get(stage.name))
+            if upToDate and not force and not stage.alwaysRun:
+                print("%s: up to date" % stage.name)
+                done.add(stage.name)
+                continue
+            if stage.cleanOutputs:
+                removeOutputs(stage)
+            print("%s: running %s" % (stage.name, " ".join(stage.args)))
+            proc = subprocess.Popen([sys.executable] + stage.args,
+                                    cwd = scriptDir)
+            running[stage.name] = (stage, proc, time.time(), inputHashes)
+
+        # Collect finished stages
+        for name, (stage, proc, startTime, inputHashes) in running.items():
+            if proc.poll() is None:
+                continue
+            del running[name]
+            wallTimeDict[name] = time.time() - startTime
+            if proc.returncode:
+                print("%s: FAILED with code %d after %.1f sec" % (name,
+                    proc.returncode, wallTimeDict[name]))
+                failed.add(name)
+                continue
+            print("%s: done in %.1f sec" % (name, wallTimeDict[name]))
+            done.add(name)
+            if inputHashes is None:
+                inputHashes = dict((x, contentHash(x)) for x in stage.inputs
+                                   if os.path.exists(x))
+            state[name] = {"inputHashes": inputHashes,
+                "wallTime": wallTimeDict[name], "finished": time.time()}
+            UtilStore(state, PIPELINE_STATE())
+        time.sleep(1.)
+
+    print("Stage wall times:")
+    for stage in stages:
+        if stage.name in wallTimeDict:
+            print("%s: %.1f sec" % (stage.name, wallTimeDict[stage.name]))
+    return not failed
+
+
+if __name__ == "__main__":
+
+    args = sys.argv[1:]
+    jobCount = 2
+    if "jobs" in args:
+        ind = args.index("jobs")
+        jobCount = int(args[ind + 1])
+        del args[ind:ind+2]
+    force = "force" in args
+    if force:
+        args.remove("force")
+
+    stages = pipelineStages()
+    unknown = set(args) - set(s.name for s in stages)
+    if unknown:
+        print("Unknown stages %s, known stages: %s" % (", ".join(unknown),
+            ", ".join(s.name for s in stages)))
+        sys.exit(-1)
+    if args:
+        stages = selectStages(stages, set(args))
+
+    sys.exit(0 if runPipeline(stages, jobCount, force) else 1)
@@ -0,0 +1,302 @@
+# This module keeps the reference genomes in memory for classification of
+# new (query) genomes: genome x COG matrix of the references, their COG
+# weights at the optimal COG distance parameters, taxonomy tree and per
+# taxon statistics of the stored COG distances (see classify_genome.py).
+# A query genome, given by its PTT and FAA files, is compared with all the
+# references at once, and placed by the best fit scoring of
+# classify_genome.py. Queries do not change the references: their COGs go
+# neither into cogFreq, nor into the taxon statistics. Batches of queries
+# are read and scored by a pool of workers (see classify_batch.py).
+
+import os
+import glob
+import math
+import multiprocessing
+import numpy as np
+from filedefs import *
+from shared.pyutils.utils import *
+from taxonomy import *
+import common_cogs_method as commonCogsMethod
+from common_cogs_method import CogRegExpSteps, commonCogsDistRegArray
+from cog_matrix import CogMatrix
+from build_cogs import iterPttCogs, readFaaFile, ProteinBatchValidator
+from classify_genome import buildTaxonStats, membershipMatrix, \
+    candidateTypes, scoreCandidates, reclassText, CutOffBestFit
+
+# ReferenceModel of the batch workers, inherited through fork
+_workerModel = None
+
+def defaultFaaFileName(pttFileName):
+    """
+    :return: name of the FAA file next to the PTT file, as in build_cogs.py
+    """
+    return pttFileName.rpartition('.')[0] + ".faa"
+
+
+class ReferenceModel(object):
+    """
+    Reference genomes, loaded once for any number of queries
+    Attributes:
+        dirs - reference genome dirs, in the COG distance matrix order
+        taxaDict - dictionary genome dir -> Taxa
+        cogMatrix - CogMatrix of the references; cogFreq is counted over
+            all the genomes of COG_DICT(), as for the stored COG distances
+        params - COG distance parameters, see cogDistOptimalParams()
+        expGenReg, mixReg - COG distance regularizations
+        invFreq - per COG weight 1/(cogFreq+cogReg), interpolated between
+            the COG regularization steps the same way as the weights are
+        unknownWeight - weight of a COG none of the genomes has
+        diagWeights - COG weights of the references with themselves
+        lengthStats - dictionary COG name -> (mean, std) of the instance
+            lengths, None if COG_LENGTH_STATS() has not been stored
+        cogLengthFilter - length filter of create_cog_dict.py
+        taxaTypeTree - TaxaTypeTree of the references
+        stats - TaxonStats of the references
+        globStdList - stats.globalStdList()
+        candidateIds - node ids of the distinct reference types
+        membershipT - sparse taxon x reference membership matrix
+        memberCount - number of references of every taxon
+    """
+
+    def __init__(self):
+        cogDict, cogFreq, self.taxaDict = \
+            commonCogsMethod.loadCogTaxaDicts()
+        self.cogMatrix = CogMatrix(cogDict, cogFreq = cogFreq)
+        self.dirs = self.cogMatrix.dirs
+
+        self.params = commonCogsMethod.cogDistOptimalParams()
+        print("COG distance parameters %s" % repr(self.params))
+        self.expGenReg = math.exp(self.params["genReg"])
+        self.mixReg = self.params["mixReg"]
+        cogRegInt, fraction = commonCogsMethod.cogRegInterpolation(
+            self.params["cogReg"])
+        low = CogRegExpSteps[cogRegInt]
+        upper = CogRegExpSteps[cogRegInt+1]
+        freq = self.cogMatrix.cogFreq.astype(np.float64)
+        self.invFreq = (1. - fraction) / (freq + low) + \
+            fraction / (freq + upper)
+        self.unknownWeight = (1. - fraction) / low + fraction / upper
+        self.diagWeights = np.asarray(self.cogMatrix.matrix.dot(
+            self.invFreq), dtype=np.float64)
+
+        self.lengthStats = None
+        self.cogLengthFilter = None
+        if os.path.isfile(COG_LENGTH_STATS()):
+            lengthStats = UtilLoad(COG_LENGTH_STATS())
+            self.lengthStats = dict(zip(lengthStats["cogNames"],
+                zip(lengthStats["lenMean"], lengthStats["lenStd"])))
+            self.cogLengthFilter = lengthStats["cogLengthFilter"]
+        else:
+            print("No %s, query COGs are not filtered by length" %
+                  COG_LENGTH_STATS())
+
+        print("Reading COG distances...")
+        cogDist = commonCogsMethod.loadCogDist()
+        if cogDist.dirs != self.dirs:
+            raise UtilError("Stored COG distances are not over the reference "
+                            "genomes, run common_cogs_method.py optimalStore")
+        self.taxaTypeTree = TaxaTypeTree(self.taxaDict)
+        print("Building taxon statistics...")
+        self.stats = buildTaxonStats(cogDist, self.taxaTypeTree)
+        self.globStdList = self.stats.globalStdList()
+        self.candidateIds = candidateTypes([x.type for x in
+            self.taxaDict.values()], self.taxaTypeTree)
+        _, membership = membershipMatrix(self.taxaTypeTree,
+                                         self.stats.dirIndex)
+        self.membershipT = membership.T.tocsr()
+        self.memberCount = np.asarray(membership.sum(axis=0)).ravel()
+        print("%d reference genomes, %d taxons" % (len(self.dirs),
+                                                   len(self.memberCount)))
+
+    def readQueryCogs(self, pttFileName, faaFileName = None):
+        """
+        Reads COGs of a query genome the way build_cogs.py and
+        create_cog_dict.py do for the references: COGs with bad or missing
+        proteins are dropped, and so are the instances out of the length
+        filter
+        :param faaFileName: by default, the FAA file next to the PTT file
+        :return: set of COG names
+        """
+        if faaFileName is None:
+            faaFileName = defaultFaaFileName(pttFileName)
+        cogList = list(iterPttCogs(pttFileName))
+        cogPidSet = set(x[5] for x in cogList)
+        validPidSet = set()
+
+        def acceptProtein(pid, protein):
+            if pid in cogPidSet:
+                validPidSet.add(pid)
+
+        readFaaFile(faaFileName, ProteinBatchValidator(faaFileName,
+            acceptProtein, badIdSet = set(), qualityList = []))
+
+        cogSet = set()
+        for lineno, cogStart, cogLen, cogName, cogStrand, cogPid in cogList:
+            if cogPid not in validPidSet:
+                continue
+            if (self.lengthStats is not None) and \
+                (cogName in self.lengthStats):
+                mean, std = self.lengthStats[cogName]
+                if abs(cogLen - mean) > self.cogLengthFilter * std:
+                    continue
+            cogSet.add(cogName)
+        return cogSet
+
+    def queryMatrix(self, cogSetList):
+        """
+        :return: tuple (float64 array queries x COGs of the references, 1
+            if the query has the COG; int array, per query number of COGs
+            none of the genomes has)
+        """
+        x = np.zeros((len(cogSetList), len(self.cogMatrix.cogNames)))
+        unknownCounts = np.zeros(len(cogSetList), dtype=np.int64)
+        cogIndex = self.cogMatrix.cogIndex
+        for row, cogSet in enumerate(cogSetList):
+            cols = [cogIndex[c] for c in cogSet if c in cogIndex]
+            x[row, cols] = 1.
+            unknownCounts[row] = len(cogSet) - len(cols)
+        return (x, unknownCounts)
+
+    def queryDistances(self, cogSetList):
+        """
+        commonCogsDistReg() of the queries to all the references, out of
+        one product of the weighted query matrix with the reference genome x
+        COG matrix
+        :param cogSetList: list of sets of COG names of the queries
+        :return: float64 array queries x references
+        """
+        x, unknownCounts = self.queryMatrix(cogSetList)
+        weighted = x * self.invFreq
+        commonWeights = np.asarray(self.cogMatrix.matrix.dot(weighted.T),
+                                   dtype=np.float64).T
+        selfWeights = weighted.sum(axis=1) + unknownCounts * \
+            self.unknownWeight
+        lens = x.sum(axis=1) + unknownCounts
+        return commonCogsDistRegArray(commonWeights, selfWeights[:, None],
+            self.diagWeights[None, :], lens[:, None],
+            self.cogMatrix.cogCounts[None, :], self.expGenReg, self.mixReg)
+
+    def classifyDistances(self, dist):
+        """
+        Places a query by the best fit scoring of classify_genome.py. The
+        query starts in the type of its nearest reference genome; taxon
+        statistics of the query are the mean distances to all the
+        references of every taxon
+        :param dist: COG distances of the query to the references
+        :return: UtilObject with nearest (reference dir), nearestDist, orig
+            (TaxaType of the nearest reference), bestFit (sigmas),
+            bestFitType, comparedTaxons, reclassified (True if bestFit is
+            above CutOffBestFit), and type: bestFitType if reclassified,
+            orig otherwise
+        """
+        nearest = int(np.argmin(dist))
+        typeOrig = self.taxaDict[self.dirs[nearest]].type
+        count = self.memberCount
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = np.where(count > 0, self.membershipT.dot(dist) / count, 0.)
+        ancestors = self.taxaTypeTree.getAncestorIds(
+            self.taxaTypeTree.getNodeId(typeOrig))
+        bestFit, bestFitType, comparedTaxons = scoreCandidates(mean, count,
+            ancestors, typeOrig, self.candidateIds, self.taxaTypeTree,
+            self.globStdList)
+        reclassified = bestFit > CutOffBestFit
+        return UtilObject(nearest = self.dirs[nearest],
+            nearestDist = float(dist[nearest]), orig = typeOrig,
+            bestFit = bestFit, bestFitType = bestFitType,
+            comparedTaxons = comparedTaxons or [],
+            reclassified = reclassified,
+            type = bestFitType if reclassified else typeOrig)
+
+    def classify(self, cogSet):
+        """
+        :return: classifyDistances() of one query
+        """
+        return self.classifyDistances(self.queryDistances([cogSet])[0])
+
+    def classifyFiles(self, pttFileName, faaFileName = None):
+        return self.classify(self.readQueryCogs(pttFileName, faaFileName))
+
+    def readQuery(self, query):
+        """
+        :param query: PTT file, or genome directory; COGs of all the PTT
+            files of the directory are taken
+        :return: set of COG names
+        """
+        if not os.path.isdir(query):
+            return self.readQueryCogs(query)
+        pttFileNameList = sorted(glob.glob(os.path.join(query, "*.ptt")))
+        if not pttFileNameList:
+            raise IOError("No PTT files in %s" % query)
+        return set().union(*[self.readQueryCogs(x) for x in
+                             pttFileNameList])
+
+    def classifyBatch(self, queryList, workerCount = 1):
+        """
+        Classifies a batch of queries against the references. Queries are
+        read and scored by a pool of workers; their distances to the
+        references come from one product for the whole batch
+        :param queryList: list of PTT files or genome directories, see
+            readQuery()
+        :return: list of classifyDistances() results, None for the queries
+            that could not be read
+        """
+        global _workerModel
+        _workerModel = self
+        pool = multiprocessing.Pool(workerCount) if workerCount > 1 \
+            else None
+        mapFunc = pool.map if pool is not None else map
+        try:
+            print("Reading %d queries..." % len(queryList))
+            cogSetList = mapFunc(_readQuery, queryList)
+            validList = [i for i, x in enumerate(cogSetList) if x is not None]
+            print("Calculating COG distances of %d queries..." %
+                  len(validList))
+            dist = self.queryDistances([cogSetList[i] for i in validList])
+            print("Scoring...")
+            resultList = [None] * len(queryList)
+            for i, result in zip(validList, mapFunc(_classifyQuery, dist)):
+                resultList[i] = result
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+            _workerModel = None
+        return resultList
+
+
+def _readQuery(query):
+    try:
+        return _workerModel.readQuery(query)
+    except (IOError, ValueError, UtilError) as e:
+        # Malformed query files do not stop the batch
+        print("Query %s: %s" % (query, str(e)))
+        return None
+
+def _classifyQuery(dist):
+    return _workerModel.classifyDistances(dist)
+
+def queryText(name, result):
+    """
+    :return: text of classifyDistances() result, Reclassify.txt style if
+        the query is reclassified
+    """
+    if result.reclassified:
+        return reclassText(name, result.orig, result.bestFitType,
+            result.bestFit, result.comparedTaxons)
+    return "\n%s\nNearest: %s\nClassified: %s\nCOG distance: %f\n" % \
+        (name, result.nearest, repr(result.type), result.nearestDist)
+
+def resultDict(result):
+    """
+    :return: JSON serializable dictionary of classifyDistances() result
+    """
+    def typeDict(type):
+        if type is None:
+            return None
+        return dict(zip(TaxaType.hierarchy(), type.taxonValList()))
+
+    return {"nearest": result.nearest, "nearestDist": result.nearestDist,
+            "orig": typeDict(result.orig), "type": typeDict(result.type),
+            "bestFit": result.bestFit, "reclassified": result.reclassified,
+            "bestFitType": typeDict(result.bestFitType),
+            "comparedTaxons": [list(x) for x in result.comparedTaxons]}
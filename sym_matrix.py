@@ -0,0 +1,300 @@
+# This module defines symmetric genome x genome matrix with condensed
+# storage: only the upper triangle, including the diagonal, is kept as one
+# flat array, row by row. Used for taxonomy distances, COG weights and COG
+# distances, which are all symmetric by construction, except that COG
+# distances of two genomes with the same COG count depend on which one goes
+# first (see commonCogsDistReg() in common_cogs_method.py). Such elements of
+# the lower triangle are kept apart, as a sorted sparse list.
+# Rows are accessed as m[dir1], and elements as m[dir1][dir2], the same way
+# as with the dictionaries of dictionaries these matrices replace.
+# Files of a stored matrix with the base name <base>:
+#   <base>.npy - condensed data; for a stack of matrices, one row per matrix
+#   <base>_index.json - genome dirs in the row order, and for a stack, which
+#       of its rows are present
+#   <base>_lowerindex.npy, <base>_lowervalues.npy - elements of the lower
+#       triangle that differ from the upper one, if any
+
+import os
+import numpy as np
+from shared.pyutils.utils import *
+from collections import defaultdict as DefDict
+
+
+def condensedSize(n):
+    return n * (n + 1) // 2
+
+def condensedRowStarts(n):
+    """
+    :return: int64 array of n+1 offsets of the condensed rows, row i keeps
+        the elements [i, n)
+    """
+    i = np.arange(n + 1, dtype=np.int64)
+    return i * n - i * (i - 1) // 2
+
+
+class SymMatrixRow(object):
+    """
+    Read only dictionary like view of one row of SymMatrix:
+    dir2 -> element
+    """
+
+    __slots__ = ("matrix", "row")
+
+    def __init__(self, matrix, row):
+        self.matrix = matrix
+        self.row = row
+
+    def __getitem__(self, dir):
+        return self.matrix.getByIndex(self.row, self.matrix.dirIndex[dir])
+
+    def __contains__(self, dir):
+        return dir in self.matrix.dirIndex
+
+    def __len__(self):
+        return len(self.matrix.dirs)
+
+    def __iter__(self):
+        return iter(self.matrix.dirs)
+
+    def get(self, dir, default = None):
+        if dir not in self.matrix.dirIndex:
+            return default
+        return self[dir]
+
+    def keys(self):
+        return list(self.matrix.dirs)
+
+    def array(self):
+        """
+        :return: numpy array of the row, in the dirs order
+        """
+        return self.matrix.rowArray(self.row)
+
+    def values(self):
+        return self.array().tolist()
+
+    def iteritems(self):
+        return iter(zip(self.matrix.dirs, self.values()))
+
+    def items(self):
+        return zip(self.matrix.dirs, self.values())
+
+
+class SymMatrix(object):
+    """
+    Symmetric matrix indexed by genome dirs
+    Attributes:
+        dirs - list of genome dirs, in the row order
+        dirIndex - dictionary genome dir -> row
+        data - condensed upper triangle, numpy array of n*(n+1)/2 elements
+        rowStarts - offsets of the rows in data
+        lowerIndex - None, or sorted int64 array of i * n + j of the
+            elements [i][j], i > j, that differ from [j][i]
+        lowerValues - values of the lowerIndex elements
+    """
+
+    def __init__(self, dirs, data = None, dtype = np.float64,
+                 lowerIndex = None, lowerValues = None):
+        """
+        :param data: condensed upper triangle; zeros if None
+        """
+        self.dirs = list(dirs)
+        self.dirIndex = dict((d, i) for i, d in enumerate(self.dirs))
+        n = len(self.dirs)
+        if data is None:
+            data = np.zeros(condensedSize(n), dtype=dtype)
+        assert(len(data) == condensedSize(n))
+        self.data = data
+        self.rowStarts = condensedRowStarts(n)
+        self.lowerIndex = None
+        self.lowerValues = None
+        if lowerIndex is not None:
+            self.setLower(lowerIndex, lowerValues)
+
+    def __len__(self):
+        return len(self.dirs)
+
+    def __contains__(self, dir):
+        return dir in self.dirIndex
+
+    def __iter__(self):
+        return iter(self.dirs)
+
+    def __getitem__(self, dir):
+        return SymMatrixRow(self, self.dirIndex[dir])
+
+    def keys(self):
+        return list(self.dirs)
+
+    def iteritems(self):
+        for i, dir in enumerate(self.dirs):
+            yield (dir, SymMatrixRow(self, i))
+
+    def items(self):
+        return [(dir, SymMatrixRow(self, i)) for i, dir in
+                enumerate(self.dirs)]
+
+    @property
+    def dtype(self):
+        return self.data.dtype
+
+    def condensedIndex(self, i, j):
+        if i > j:
+            i, j = j, i
+        return int(self.rowStarts[i]) + j - i
+
+    def setLower(self, lowerIndex, lowerValues):
+        """
+        Sets elements of the lower triangle that differ from the upper one
+        :param lowerIndex: int array of i * n + j, i > j
+        """
+        lowerIndex = np.asarray(lowerIndex, dtype=np.int64)
+        order = np.argsort(lowerIndex, kind='mergesort')
+        self.lowerIndex = lowerIndex[order]
+        self.lowerValues = np.asarray(lowerValues,
+                                      dtype=self.data.dtype)[order]
+
+    def _lowerRange(self, i):
+        """
+        :return: tuple (start, end) of the lowerIndex elements of row i
+        """
+        n = len(self.dirs)
+        return tuple(np.searchsorted(self.lowerIndex, [i * n, i * n + i]))
+
+    def getByIndex(self, i, j):
+        if (i > j) and (self.lowerIndex is not None):
+            k = np.searchsorted(self.lowerIndex, i * len(self.dirs) + j)
+            if (k < len(self.lowerIndex)) and \
+                    (self.lowerIndex[k] == i * len(self.dirs) + j):
+                return self.lowerValues[k].item()
+        return self.data[self.condensedIndex(i, j)].item()
+
+    def get(self, dir1, dir2):
+        return self.getByIndex(self.dirIndex[dir1], self.dirIndex[dir2])
+
+    def set(self, dir1, dir2, val):
+        self.data[self.condensedIndex(self.dirIndex[dir1],
+                                      self.dirIndex[dir2])] = val
+
+    def rowArray(self, i):
+        """
+        :return: numpy array of the row i, in the dirs order
+        """
+        # Elements j < i are in the condensed rows j, column i
+        j = np.arange(i, dtype=np.int64)
+        row = np.concatenate((self.data[self.rowStarts[j] + (i - j)],
+            self.data[self.rowStarts[i]:self.rowStarts[i+1]]))
+        if self.lowerIndex is not None:
+            start, end = self._lowerRange(i)
+            row[self.lowerIndex[start:end] - i * len(self.dirs)] = \
+                self.lowerValues[start:end]
+        return row
+
+    def dense(self, dtype = None):
+        """
+        :return: full n x n numpy array
+        """
+        n = len(self.dirs)
+        m = np.empty((n, n), dtype=dtype or self.data.dtype)
+        for i in range(n):
+            row = self.data[self.rowStarts[i]:self.rowStarts[i+1]]
+            m[i, i:] = row
+            m[i:, i] = row
+        if self.lowerIndex is not None:
+            m.flat[self.lowerIndex] = self.lowerValues
+        return m
+
+    def toDictOfDicts(self):
+        """
+        :return: DefDict(dict) dir1 -> dir2 -> element
+        """
+        distDict = DefDict(dict)
+        for dir, row in self.iteritems():
+            distDict[dir] = dict(row.iteritems())
+        return distDict
+
+    @staticmethod
+    def fromDense(dirs, matrix, dtype = None):
+        """
+        :param matrix: n x n array, only its upper triangle is taken
+        """
+        n = len(dirs)
+        m = SymMatrix(dirs, dtype=dtype or matrix.dtype)
+        for i in range(n):
+            m.data[m.rowStarts[i]:m.rowStarts[i+1]] = matrix[i, i:]
+        return m
+
+    @staticmethod
+    def fromDictOfDicts(dirs, distDict, dtype = np.float64):
+        """
+        :param distDict: dir1 -> dir2 -> element; element [dirs[i]][dirs[j]]
+            with i <= j is taken
+        """
+        m = SymMatrix(dirs, dtype=dtype)
+        for i, dir1 in enumerate(m.dirs):
+            d = distDict[dir1]
+            m.data[m.rowStarts[i]:m.rowStarts[i+1]] = \
+                [d[x] for x in m.dirs[i:]]
+        return m
+
+
+def _indexFileName(fileBase):
+    return fileBase + "_index.json"
+
+def symMatrixExists(fileBase):
+    return os.path.isfile(fileBase + ".npy") and \
+        os.path.isfile(_indexFileName(fileBase))
+
+def storeSymMatrix(m, fileBase):
+    np.save(fileBase + ".npy", np.asarray(m.data))
+    hasLower = m.lowerIndex is not None
+    if hasLower:
+        np.save(fileBase + "_lowerindex.npy", m.lowerIndex)
+        np.save(fileBase + "_lowervalues.npy", m.lowerValues)
+    UtilStore({"dirs": m.dirs, "lower": hasLower}, _indexFileName(fileBase))
+
+def loadSymMatrix(fileBase, mmap = True):
+    """
+    :param mmap: if True, data is memory mapped, not read; the lower
+        triangle elements are always read
+    """
+    index = UtilLoad(_indexFileName(fileBase))
+    m = SymMatrix(index["dirs"], np.load(fileBase + ".npy",
+        mmap_mode='r' if mmap else None))
+    if index.get("lower"):
+        m.setLower(np.load(fileBase + "_lowerindex.npy"),
+                   np.load(fileBase + "_lowervalues.npy"))
+    return m
+
+def storeSymMatrixStack(matrixList, fileBase):
+    """
+    Stores a list of matrices over the same dirs as one 2D array
+    :param matrixList: list of SymMatrix's, or None for the missing ones
+    """
+    present = [m for m in matrixList if m is not None]
+    assert(present)
+    dirs = present[0].dirs
+    stack = np.lib.format.open_memmap(fileBase + ".npy", mode='w+',
+        dtype=present[0].dtype, shape=(len(matrixList),
+        condensedSize(len(dirs))))
+    for ind, m in enumerate(matrixList):
+        if m is None:
+            stack[ind] = 0
+        else:
+            assert(m.dirs == dirs)
+            stack[ind] = m.data
+    stack.flush()
+    del stack
+    UtilStore({"dirs": dirs, "steps": [m is not None for m in matrixList]},
+        _indexFileName(fileBase))
+
+def loadSymMatrixStack(fileBase, mmap = True):
+    """
+    :param mmap: if True, data is memory mapped, not read
+    :return: list of SymMatrix's, None for the missing ones; matrices share
+        the memory of one 2D array
+    """
+    index = UtilLoad(_indexFileName(fileBase))
+    stack = np.load(fileBase + ".npy", mmap_mode='r' if mmap else None)
+    return [SymMatrix(index["dirs"], stack[ind]) if present else None
+            for ind, present in enumerate(index["steps"])]
@@ -4,7 +4,7 @@
 import re
 import sys
 import operator
-import copy
+import numpy as np
 from filedefs import *
 from shared.pyutils.utils import *
 from shared.pyutils.UtilNormDistrib import *
@@ -121,70 +121,103 @@ class TaxaType(UtilObject):
     """
     This class describes a taxonomy classification of a
         Prokaryotic organism
+    Instances are immutable and interned: newTaxaType() returns the same
+    instance for the same taxons. Key, depth, hash and the parent instance
+    are calculated once, at construction
     Attributes:
         See hierarchy()
     """
 
+    # Rank values stay in __dict__, so that the stored format does not
+    # change; the cached fields are slots
+    __slots__ = ("_vals", "_key", "_depth", "_hash", "_parent")
+
     taxonNames_ = ["superkingdom", "phylum", "class", "order", "family",
                    "genus", "species group", "species", "subspecies"]
 
+    # Intern table: key -> TaxaType
+    internDict_ = {}
+
     def __init__(self, **kwargs):
         if not self.buildFromDict(kwargs):
             self.__dict__.update(kwargs)
+        self._initCache()
+
+    def _initCache(self):
+        vals = tuple(self.__dict__[n] for n in TaxaType.hierarchy())
+        depth = TaxaType.hierarchySize()
+        while (depth > 0) and (vals[depth-1] == ""):
+            depth -= 1
+        key = "_".join(vals)
+        object.__setattr__(self, "_vals", vals)
+        object.__setattr__(self, "_key", key)
+        object.__setattr__(self, "_depth", depth)
+        object.__setattr__(self, "_hash", hash(key))
+        if depth == 0:
+            parent = self
+        else:
+            parent = TaxaType.newTaxaType(*(vals[:depth-1] +
+                ("",) * (TaxaType.hierarchySize() - depth + 1)))
+        object.__setattr__(self, "_parent", parent)
+        TaxaType.internDict_.setdefault(key, self)
+
+    def __setattr__(self, name, value):
+        if getattr(self, "_key", None) is not None:
+            raise AttributeError("TaxaType is immutable")
+        object.__setattr__(self, name, value)
+
+    def __delattr__(self, name):
+        raise AttributeError("TaxaType is immutable")
+
+    def __reduce__(self):
+        return (_internTaxaType, self._vals)
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
 
     def taxonValList(self):
-        return [getattr(self, n) for n in TaxaType.hierarchy()]
+        return list(self._vals)
 
     def taxonValListReversed(self):
-        return [getattr(self, n) for n in reversed(TaxaType.hierarchy())]
+        return list(reversed(self._vals))
 
     @property
     def key(self):
-        return "_".join(self.taxonValList())
+        return self._key
 
     def distance(self, other):
         count = TaxaType.hierarchySize()
-        for x, y in zip(self.taxonValList(), other.taxonValList()):
+        for x, y in zip(self._vals, other._vals):
             if x != y:
                 return count
             count -= 1
         return 0
 
     def depth(self):
-        it = (idx for (idx,val) in enumerate(self.taxonValListReversed()) \
-            if val != "")
-        size = TaxaType.hierarchySize()
-        return size - next(it, size)
+        return self._depth
 
     def parent(self):
-        depth = self.depth()
-        if depth != 0:
-            parent = copy.deepcopy(self)
-            setattr(parent, TaxaType.hierarchy()[depth-1], "")
-            return parent
-        else:
-            return self
+        return self._parent
 
     def isAncestor(self, anc):
-        depth = anc.depth()
-        if (depth > self.depth()):
+        depth = anc._depth
+        if (depth > self._depth):
             return False
-        for i in range(depth):
-            name = TaxaType.hierarchy()[i]
-            if getattr(self, name) != getattr(anc, name):
-                return False
-        return True
+        return self._vals[:depth] == anc._vals[:depth]
 
     def commonAncestor(self, other):
         type1 = self
         type2 = other
         while type1 != type2:
-            depth1 = type1.depth()
-            depth2 = type2.depth()
+            depth1 = type1._depth
+            depth2 = type2._depth
             if depth1 >= depth2:
-                type1 = type1.parent()
+                type1 = type1._parent
             if depth2 >= depth1:
-                type2 = type2.parent()
+                type2 = type2._parent
         return type1
 
     @staticmethod
@@ -197,12 +230,25 @@ class TaxaType(UtilObject):
 
     @staticmethod
     def newTaxaType(*taxons):
-        return TaxaType(**dict(zip(TaxaType.hierarchy(), taxons)))
+        type = TaxaType.internDict_.get("_".join(taxons))
+        if type is None:
+            type = TaxaType(**dict(zip(TaxaType.hierarchy(), taxons)))
+        return type
+
+    @staticmethod
+    def intern(type):
+        """
+        :return: the interned instance equal to type, e.g. to a loaded one
+        """
+        if getattr(type, "_key", None) is None:
+            # Restored without calling the constructor
+            type._initCache()
+        return TaxaType.internDict_.setdefault(type._key, type)
 
     def __repr__(self):
         s = "{"
-        for n in TaxaType.hierarchy():
-            s += " " + n + ": " + getattr(self, n) + " "
+        for n, val in zip(TaxaType.hierarchy(), self._vals):
+            s += " " + n + ": " + val + " "
         s += " }"
         return s
 
@@ -210,12 +256,49 @@ class TaxaType(UtilObject):
         return self.__repr__()
 
     def __eq__(self, other):
-        return (self.key == other.key)
+        return (self is other) or (self._key == other._key)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return self._hash
 
     @staticmethod
     def maxDistance():
         return TaxaType.hierarchySize()
 
+def _internTaxaType(*taxons):
+    # Module level, so that pickle finds it by name
+    return TaxaType.newTaxaType(*taxons)
+
+def encodeTaxaTypes(typeList):
+    """
+    Encodes TaxaType's as vectors of integer codes of their taxons, one
+    code per taxon name and rank
+    :return: int32 array len(typeList) x TaxaType.hierarchySize()
+    """
+    codes = np.empty((len(typeList), TaxaType.hierarchySize()),
+                     dtype=np.int32)
+    codeDicts = [{} for _ in TaxaType.hierarchy()]
+    for ind, type in enumerate(typeList):
+        codes[ind] = [d.setdefault(x, len(d)) for d, x in
+                      zip(codeDicts, type._vals)]
+    return codes
+
+def taxaTypeDistances(codes1, codes2):
+    """
+    TaxaType.distance() of all the pairs of encoded TaxaType's
+    :param codes1: array of encodeTaxaTypes()
+    :param codes2: array of encodeTaxaTypes(), with the same taxon codes
+    :return: int8 array len(codes1) x len(codes2)
+    """
+    equal = codes1[:, None, :] == codes2[None, :, :]
+    commonCount = np.cumprod(equal, axis=2, dtype=np.int8).sum(axis=2,
+                                                             dtype=np.int8)
+    return (TaxaType.hierarchySize() - commonCount).astype(np.int8)
+
+
 class Taxa(UtilObject):
     """
     This class describes a specific instance of a Prokaryotic organism
@@ -226,9 +309,9 @@ class Taxa(UtilObject):
     """
 
     def __init__(self, **kwargs):
-        if self.buildFromDict(kwargs):
-            return
-        self.__dict__.update(kwargs)
+        if not self.buildFromDict(kwargs):
+            self.__dict__.update(kwargs)
+        self._type = TaxaType.intern(self._type)
 
     @property
     def key(self):
@@ -263,6 +346,9 @@ class TaxaTypeNode(UtilObject):
     def __eq__(self, other):
         return (self.type == other.type)
 
+    def __hash__(self):
+        return hash(self.type)
+
     def __repr__(self):
         return repr(self.type)
 
@@ -280,7 +366,16 @@ class TaxaTypeTree(UtilObject):
     """
     This class represents a tree of TaxaTypeNodes. Basically, it is just
     a list, indexed by depth, of dictionaries mapping TaxaTypes into
-    TaxaTypeNodes
+    TaxaTypeNodes.
+    Nodes are also numbered, in the order of levels, and the lowest common
+    ancestors of the nodes are answered in O(1) out of a sparse table over
+    the Euler tour of the tree, with a virtual root of depth 0 above the
+    top nodes:
+        nodeTypes - list of TaxaType's of the node ids
+        nodeIndex - dictionary TaxaType key -> node id
+        nodeDepth - int array of node depths, the root included
+        nodeParent - int array of parent node ids, -1 for the root
+        rootId - node id of the root
     """
     def __init__(self, taxaDict):
         self.levels = []
@@ -292,8 +387,10 @@ class TaxaTypeTree(UtilObject):
             childNode = None
             while True:
                 d = self.levels[type.depth()]
-                node = d.get(type, TaxaTypeNode(type))
-                d[type] = node
+                node = d.get(type)
+                if node is None:
+                    node = TaxaTypeNode(type)
+                    d[type] = node
                 node.addDir(dir)
                 if childNode:
                     node.addChild(childNode)
@@ -301,6 +398,106 @@ class TaxaTypeTree(UtilObject):
                 type = type.parent()
                 if type.depth() == 0:
                     break
+        self._buildLcaTable()
+
+    def _buildLcaTable(self):
+        self.nodeTypes = []
+        for d in self.levels:
+            self.nodeTypes.extend(node.type for node in d.values())
+        self.nodeIndex = dict((t.key, i) for i, t in
+                              enumerate(self.nodeTypes))
+        rootType = TaxaType.newTaxaType(*([""] * TaxaType.hierarchySize()))
+        self.rootId = self.nodeIndex.get(rootType.key, len(self.nodeTypes))
+        nodeCount = max(self.rootId + 1, len(self.nodeTypes))
+        self.nodeDepth = np.zeros(nodeCount, dtype=np.int32)
+        self.nodeParent = np.full(nodeCount, -1, dtype=np.int32)
+        childList = [[] for _ in range(nodeCount)]
+        for id, type in enumerate(self.nodeTypes):
+            self.nodeDepth[id] = type.depth()
+            if id == self.rootId:
+                continue
+            parent = type.parent()
+            parentId = self.rootId if parent.depth() == 0 else \
+                self.nodeIndex[parent.key]
+            self.nodeParent[id] = parentId
+            childList[parentId].append(id)
+
+        # Euler tour, iterative
+        euler = []
+        self.nodeFirst = np.zeros(nodeCount, dtype=np.int64)
+        stack = [(self.rootId, 0)]
+        while stack:
+            id, childInd = stack.pop()
+            if childInd == 0:
+                self.nodeFirst[id] = len(euler)
+            euler.append(id)
+            if childInd < len(childList[id]):
+                stack.append((id, childInd + 1))
+                stack.append((childList[id][childInd], 0))
+        euler = np.array(euler, dtype=np.int32)
+
+        # Sparse table of the minimum depth node over 2^k long ranges
+        self.lcaTable = [euler]
+        k = 1
+        while (1 << k) <= len(euler):
+            prev = self.lcaTable[-1]
+            half = 1 << (k - 1)
+            left = prev[:len(prev) - half]
+            right = prev[half:]
+            self.lcaTable.append(np.where(self.nodeDepth[left] <=
+                self.nodeDepth[right], left, right))
+            k += 1
+
+    def getNodeId(self, type):
+        return self.nodeIndex[type.key]
+
+    def lcaArray(self, id, ids):
+        """
+        :param id: node id
+        :param ids: array of node ids
+        :return: int array of the lowest common ancestors of id and ids
+        """
+        first = self.nodeFirst[np.asarray(ids)]
+        left = np.minimum(first, self.nodeFirst[id])
+        right = np.maximum(first, self.nodeFirst[id])
+        k = np.zeros(len(left), dtype=np.int64)
+        length = right - left + 1
+        while True:
+            more = (1 << (k + 1)) <= length
+            if not more.any():
+                break
+            k += more
+        result = np.empty(len(left), dtype=np.int32)
+        for level in np.unique(k):
+            sel = k == level
+            table = self.lcaTable[level]
+            a = table[left[sel]]
+            b = table[right[sel] - (1 << level) + 1]
+            result[sel] = np.where(self.nodeDepth[a] <= self.nodeDepth[b],
+                                   a, b)
+        return result
+
+    def getAncestorIds(self, id):
+        """
+        :return: int array of TaxaType.hierarchySize()+1 node ids of the
+            ancestors of the node by depth, the node included, -1 for the
+            depths without a node
+        """
+        ancestors = np.full(TaxaType.hierarchySize() + 1, -1, dtype=np.int32)
+        while 0 <= id < len(self.nodeTypes):
+            ancestors[self.nodeDepth[id]] = id
+            id = self.nodeParent[id]
+        return ancestors
+
+    def lca(self, id1, id2):
+        return int(self.lcaArray(id1, [id2])[0])
+
+    def commonAncestorDepth(self, type1, type2):
+        """
+        :return: depth of TaxaType.commonAncestor() of two types of the tree
+        """
+        return int(self.nodeDepth[self.lca(self.getNodeId(type1),
+                                           self.getNodeId(type2))])
 
     def getDirSet(self, type):
         return self.levels[type.depth()][type].dirs
@@ -321,5 +518,21 @@ class TaxaTypeTree(UtilObject):
         return s
 
 
-
-
+if __name__ == "__main__":
+
+    # Self check: pickled TaxaType's and Taxa's, e.g. passed to worker
+    # processes, come back as the interned instances
+    import pickle
+    import cPickle
+    type = TaxaType.newTaxaType("bacteria", "proteobacteria",
+        "gammaproteobacteria", "enterobacterales", "enterobacteriaceae",
+        "escherichia", "", "escherichia coli", "")
+    for module in [pickle, cPickle]:
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            assert(module.loads(module.dumps(type, protocol)) is type)
+            taxa = module.loads(module.dumps(Taxa(_name = "escherichia coli",
+                _type = type), protocol))
+            assert(taxa.type is type)
+            assert(module.loads(module.dumps(type.parent(), protocol)) is
+                   type.parent())
+    print("TaxaType pickling OK")
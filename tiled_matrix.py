@@ -0,0 +1,210 @@
+# This module calculates symmetric genome x genome matrices that do not fit
+# in memory. Matrices are calculated tile by tile, only the tiles on and
+# above the diagonal, and every tile is written into a disk backed full
+# N x N array together with its mirror. Tile size is chosen so that the peak
+# memory stays within a given budget. Rows of the results are contiguous on
+# disk, so they are cheap to read one by one.
+# Unlike SymMatrix, the full N x N array is stored, twice the size of the
+# condensed upper triangle. A row of the condensed layout is scattered over
+# N places, so reading rows out of core (buildTaxonStats, the correlations)
+# would mean N seeks per row; with the full array it is one read. Every
+# pair is still calculated once, the tile is written with its mirror. The
+# few elements that are not symmetric (COG distances of genomes with equal
+# COG counts) are overwritten afterwards, see setTiledElements().
+# Files of a stored stack of matrices with the base name <base>:
+#   <base>.npy - array steps x N x N
+#   <base>_index.json - genome dirs in the row order, and the steps stored
+
+import os
+import numpy as np
+from shared.pyutils.utils import *
+from sym_matrix import SymMatrixRow
+from taxonomy import taxaTypeDistances
+
+
+class TiledSymMatrix(object):
+    """
+    Disk backed symmetric matrix indexed by genome dirs, with the same
+    access interface as SymMatrix: m[dir1][dir2], rows, iteritems()
+    Attributes:
+        dirs - list of genome dirs, in the row order
+        dirIndex - dictionary genome dir -> row
+        data - full N x N array, usually memory mapped; both triangles are
+            stored, so every row is contiguous
+    """
+
+    def __init__(self, dirs, data):
+        self.dirs = list(dirs)
+        self.dirIndex = dict((d, i) for i, d in enumerate(self.dirs))
+        assert(data.shape == (len(self.dirs), len(self.dirs)))
+        self.data = data
+
+    def __len__(self):
+        return len(self.dirs)
+
+    def __contains__(self, dir):
+        return dir in self.dirIndex
+
+    def __iter__(self):
+        return iter(self.dirs)
+
+    def __getitem__(self, dir):
+        return SymMatrixRow(self, self.dirIndex[dir])
+
+    def keys(self):
+        return list(self.dirs)
+
+    def iteritems(self):
+        for i, dir in enumerate(self.dirs):
+            yield (dir, SymMatrixRow(self, i))
+
+    def items(self):
+        return [(dir, SymMatrixRow(self, i)) for i, dir in
+                enumerate(self.dirs)]
+
+    @property
+    def dtype(self):
+        return self.data.dtype
+
+    def getByIndex(self, i, j):
+        return self.data[i, j].item()
+
+    def get(self, dir1, dir2):
+        return self.getByIndex(self.dirIndex[dir1], self.dirIndex[dir2])
+
+    def rowArray(self, i):
+        return np.asarray(self.data[i])
+
+    def diagonal(self, blockSize = 4096):
+        """
+        :return: numpy array of the diagonal, read by blocks of rows
+        """
+        n = len(self.dirs)
+        diag = np.empty(n, dtype=self.data.dtype)
+        for start in range(0, n, blockSize):
+            end = min(start + blockSize, n)
+            block = np.asarray(self.data[start:end, start:end])
+            diag[start:end] = np.diagonal(block)
+        return diag
+
+    def dense(self):
+        return np.asarray(self.data)
+
+
+def _indexFileName(fileBase):
+    return fileBase + "_index.json"
+
+def tiledMatrixExists(fileBase):
+    return os.path.isfile(fileBase + ".npy") and \
+        os.path.isfile(_indexFileName(fileBase))
+
+def loadTiledMatrices(fileBase):
+    """
+    :return: tuple (list of steps, list of TiledSymMatrix's of the steps),
+        matrices are memory mapped
+    """
+    index = UtilLoad(_indexFileName(fileBase))
+    stack = np.load(fileBase + ".npy", mmap_mode='r')
+    return (index["steps"], [TiledSymMatrix(index["dirs"], stack[ind]) for
+                             ind in range(len(index["steps"]))])
+
+def loadTiledMatrix(fileBase):
+    return loadTiledMatrices(fileBase)[1][0]
+
+def tileSize(n, stepCount, elementSize, memoryBudget, rowBytes = 0):
+    """
+    :param elementSize: bytes per element of the result
+    :param memoryBudget: bytes available for a tile
+    :param rowBytes: additional bytes per tile row and column, e.g. for the
+        dense rows of the genome x COG matrix
+    :return: tile side, so that the tile, its mirror and the temporary
+        arrays stay within the budget
+    """
+    # Tile and its mirror, plus float64 temporaries of the calculation
+    perElement = stepCount * 2 * elementSize + 4 * 8
+    size = int(np.sqrt(memoryBudget / float(perElement)))
+    while (size > 1) and (size * size * perElement + 2 * size * rowBytes >
+                          memoryBudget):
+        size = size * 9 // 10
+    return max(1, min(size, n))
+
+def computeTiled(fileBase, dirs, steps, dtype, tileFunc, memoryBudget,
+                 rowBytes = 0):
+    """
+    Calculates a stack of symmetric matrices tile by tile into
+    <base>.npy, and writes the index
+    :param steps: list of the step ids of the stack, stored in the index
+    :param tileFunc: function (i0, i1, j0, j1) -> array steps x (i1-i0) x
+        (j1-j0) of the elements [i0:i1, j0:j1]; called for j0 >= i0 only.
+        On the diagonal tiles only the elements with i <= j are taken
+    :return: list of TiledSymMatrix's, memory mapped
+    """
+    n = len(dirs)
+    size = tileSize(n, len(steps), np.dtype(dtype).itemsize, memoryBudget,
+                    rowBytes)
+    print("Calculating %d x %d matrices %s in tiles of %d" % (n, n,
+        fileBase, size))
+    stack = np.lib.format.open_memmap(fileBase + ".npy", mode='w+',
+        dtype=dtype, shape=(len(steps), n, n))
+    for i0 in range(0, n, size):
+        i1 = min(i0 + size, n)
+        print("\rRows %d-%d" % (i0, i1)),
+        for j0 in range(i0, n, size):
+            j1 = min(j0 + size, n)
+            tile = np.asarray(tileFunc(i0, i1, j0, j1), dtype=dtype)
+            if i0 == j0:
+                upper = np.triu(np.ones((i1 - i0, j1 - j0), dtype=bool))
+                tile = np.where(upper, tile, tile.transpose(0, 2, 1))
+            stack[:, i0:i1, j0:j1] = tile
+            if i0 != j0:
+                stack[:, j0:j1, i0:i1] = tile.transpose(0, 2, 1)
+        stack.flush()
+    print
+    del stack
+    UtilStore({"dirs": list(dirs), "steps": list(steps)},
+              _indexFileName(fileBase))
+    return loadTiledMatrices(fileBase)[1]
+
+def setTiledElements(fileBase, step, rows, cols, values):
+    """
+    Overwrites elements [rows, cols] of a stored matrix of the stack, e.g.
+    the lower triangle elements of a matrix that is not fully symmetric
+    :return: TiledSymMatrix of the step, memory mapped
+    """
+    stack = np.load(fileBase + ".npy", mmap_mode='r+')
+    stack[step, rows, cols] = values
+    stack.flush()
+    del stack
+    return loadTiledMatrices(fileBase)[1][step]
+
+def tiledWeightStack(cogMatrix, expCogRegList, steps, fileBase,
+                     memoryBudget):
+    """
+    Out of core CogMatrix.weightStack(): tiles are products of dense blocks
+    of rows of the sparse genome x COG matrix
+    :param steps: step ids of expCogRegList, stored in the index
+    :return: list of TiledSymMatrix's
+    """
+    invFreqList = [1. / (cogMatrix.cogFreq + x) for x in expCogRegList]
+
+    def tileFunc(i0, i1, j0, j1):
+        left = cogMatrix.dense(np.float64, slice(i0, i1))
+        right = left if (j0, j1) == (i0, i1) else \
+            cogMatrix.dense(np.float64, slice(j0, j1))
+        return np.array([np.dot(left * invFreq, right.T) for invFreq in
+                         invFreqList])
+
+    return computeTiled(fileBase, cogMatrix.dirs, steps, np.float64,
+        tileFunc, memoryBudget, rowBytes = len(cogMatrix.cogNames) * 8)
+
+def tiledTaxDist(codes, dirs, fileBase, memoryBudget):
+    """
+    Out of core taxonomy distances
+    :param codes: encodeTaxaTypes() of the dirs
+    :return: TiledSymMatrix of int8 distances
+    """
+    def tileFunc(i0, i1, j0, j1):
+        return taxaTypeDistances(codes[i0:i1], codes[j0:j1])[None]
+
+    return computeTiled(fileBase, dirs, [0], np.int8, tileFunc,
+        memoryBudget, rowBytes = codes.shape[1] * 4 * 8)[0]